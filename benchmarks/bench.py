@@ -0,0 +1,160 @@
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmarks PushBaby against a local FakeGateway.
+
+Run from the top of the source tree with:
+    python -m benchmarks.bench [-n NUM_PUSHES] [--tls]
+"""
+
+from __future__ import print_function
+
+import gevent
+
+import argparse
+import shutil
+import tempfile
+import time
+
+from pushbaby import PushBaby, PreparedPayload
+from pushbaby.fakegateway import FakeGateway, make_self_signed_cert
+from pushbaby.metrics import MemoryMetricsSink
+
+
+PAYLOADS = {
+    'short alert': {'aps': {'alert': u'You have a new message', 'badge': 3, 'sound': 'default'}},
+    'long chat message': {
+        'aps': {
+            'alert': {
+                'loc-key': 'MSG_FROM_USER',
+                'loc-args': [u'Alice', u'\U0001F414 ' + u'lorem ipsum dolor sit amet ' * 400],
+            },
+            'badge': 1,
+        },
+        'room_id': '!abcdefghijklmnop:example.com',
+    },
+    'multibyte body': {'aps': {'alert': {'body': u'\u4e2d\u6587 \U0001F430' * 1000}}},
+}
+
+
+def percentile(values, pc):
+    values = sorted(values)
+    if len(values) == 0:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * pc / 100.0))]
+
+
+def report(name, num, elapsed, latencies=None):
+    line = "%-28s %8d pushes %8.3fs %10.0f pushes/sec" % (name, num, elapsed, num / elapsed)
+    if latencies:
+        line += "  p50 %.3fms p99 %.3fms" % (
+            percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000
+        )
+    print(line)
+
+
+def bench_encode(num):
+    for name, payload in sorted(PAYLOADS.items()):
+        start = time.time()
+        for _ in range(num):
+            PreparedPayload(payload)
+        elapsed = time.time() - start
+        print("encode %-21s %8d times %8.3fs %10.1fus each" % (name, num, elapsed, elapsed / num * 1e6))
+
+
+def wait_for(gateway, num):
+    while gateway.num_pushes < num:
+        gevent.sleep(0.01)
+
+
+def new_pushbaby(gateway, certfile, keyfile, metrics):
+    return PushBaby(
+        certfile=certfile, keyfile=keyfile, platform=gateway.get_addr(),
+        feedback_address=('localhost', 0), metrics=metrics
+    )
+
+
+def bench_send(gateway, certfile, keyfile, num):
+    metrics = MemoryMetricsSink()
+    pb = new_pushbaby(gateway, certfile, keyfile, metrics)
+    payload = PAYLOADS['short alert']
+    target = gateway.num_pushes + num
+    latencies = []
+    start = time.time()
+    for i in range(num):
+        t = time.time()
+        pb.send(payload, ('token%d' % i).encode('ascii'))
+        latencies.append(time.time() - t)
+    wait_for(gateway, target)
+    report("send", num, time.time() - start, latencies)
+
+    footprint = pb.in_flight_footprint()
+    in_flight = sum(len(c.sent) for c in pb.conns)
+    if in_flight:
+        print("memory per in-flight push    %8d bytes (%d in flight)" % (footprint // in_flight, in_flight))
+    print("handshake                    p50 %.3fms" % (
+        percentile(metrics.observations['handshake_seconds'], 50) * 1000
+    ))
+
+
+def bench_send_async(gateway, certfile, keyfile, num):
+    pb = new_pushbaby(gateway, certfile, keyfile, None)
+    payload = PreparedPayload(PAYLOADS['short alert'])
+    target = gateway.num_pushes + num
+    start = time.time()
+    for i in range(num):
+        pb.send_async(payload, ('token%d' % i).encode('ascii'))
+    wait_for(gateway, target)
+    report("send_async (prepared)", num, time.time() - start)
+
+
+def bench_send_many(gateway, certfile, keyfile, num):
+    pb = new_pushbaby(gateway, certfile, keyfile, None)
+    payload = PreparedPayload(PAYLOADS['short alert'])
+    target = gateway.num_pushes + num
+    start = time.time()
+    pb.send_many({'payload': payload, 'token': ('token%d' % i).encode('ascii')} for i in range(num))
+    wait_for(gateway, target)
+    report("send_many (prepared)", num, time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark PushBaby against a local fake gateway")
+    parser.add_argument('-n', type=int, default=20000, help="Number of pushes to send in each benchmark")
+    parser.add_argument('--tls', action='store_true', help="Use TLS with a self-signed certificate")
+    args = parser.parse_args()
+
+    bench_encode(max(1, args.n // 20))
+
+    certdir = None
+    certfile = keyfile = None
+    if args.tls:
+        certdir = tempfile.mkdtemp()
+        certfile, keyfile = make_self_signed_cert(certdir)
+
+    gateway = FakeGateway(certfile=certfile, keyfile=keyfile, record=False)
+    gateway.start()
+    try:
+        bench_send(gateway, certfile, keyfile, args.n)
+        bench_send_async(gateway, certfile, keyfile, args.n)
+        bench_send_many(gateway, certfile, keyfile, args.n)
+    finally:
+        gateway.stop()
+        if certdir:
+            shutil.rmtree(certdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -12,17 +12,29 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import gevent
+import gevent.event
+import gevent.ssl
+
 import logging
-import random
 
-from pushbaby.pushconnection import PushConnection
+import pushbaby.errors
+
+from pushbaby.pushpool import PushPool
+from pushbaby.pushconnection import PushConnection, PushExpiredException
 from pushbaby.feedbackconnection import FeedbackConnection
+from pushbaby.feedbackpoller import FeedbackPoller
+from pushbaby.truncate import BodyTooLongException
+from pushbaby.preparedpayload import PreparedPayload
+from pushbaby.timerwheel import TimerWheel
+from pushbaby.journal import Journal
+from pushbaby.pushhub import PushHub
 
 
 logger = logging.getLogger(__name__)
 
 
-class PushBaby:
+class PushBaby(PushPool):
     """
     This class is all that you should need to use in the majority of cases.
     Sending a push can be achieved using the send() method.
@@ -33,17 +45,32 @@ class PushBaby:
 
         pb = PushBaby(cerfile='mycert.pem')
         pb.on_push_failed = on_push_failed
+
+    Pushes with an expiration that passes whilst they're waiting to be
+    written are dropped rather than sent. To hear about them, set
+    'on_push_expired':
+
+        def on_push_expired(token, identifier):
+            [handle expired push]
+
+    To have feedback fetched for you periodically, set 'on_feedback' and
+    start the feedback poller:
+
+        def on_feedback(feedback_items):
+            [handle list of FeedbackItems]
+
+        pb.on_feedback = on_feedback
+        pb.start_feedback_poller()
     """
-    ADDRESSES = {
-        'prod': ('gateway.push.apple.com', 2195),
-        'sandbox': ('gateway.sandbox.push.apple.com', 2195)
-    }
-    FEEDBACK_ADDRESSES = {
-        'prod': ('feedback.push.apple.com', 2196),
-        'sandbox': ('feedback.sandbox.push.apple.com', 2196)
-    }
+    # How long to wait before trying again if opening a warm connection fails
+    WARM_RETRY_SEC = 5
 
-    def __init__(self, certfile, keyfile=None, platform='sandbox', feedback_address=None):
+    def __init__(self, certfile, keyfile=None, platform='sandbox', feedback_address=None,
+                 min_connections=1, max_connections=4, max_queue_size=None, max_in_flight=None,
+                 bad_token_cache_size=None, bad_token_ttl=None, metrics=None,
+                 warm_connections=0, priority_weights=None,
+                 max_rate=None, max_rate_per_connection=None, adaptive_rate=False,
+                 journal=None, hub=None):
         """
         Args:
             certfile: Path to a certificate file in PEM format
@@ -51,76 +78,393 @@ class PushBaby:
             keyfile: Path to the private key file in PEM format
             platform: The platform to use ('sandbox' or 'prod')
                       or a tuple of hostname and port.
+            min_connections: Number of useable connections to keep in the pool
+                      while sending.
+            max_connections: Maximum number of useable connections to open
+                      when sends start to queue up.
+            max_queue_size: Maximum number of pushes waiting to be written on
+                      each connection, after which sending blocks. None for
+                      no limit.
+            max_in_flight: Maximum number of pushes each connection remembers
+                      in case it has to resend them. Beyond this, we stop
+                      waiting to hear about the oldest: their send_async()
+                      results are set to UNKNOWN and they can't be resent if
+                      they fail. Up to as many again stay unsettled in the
+                      journal until we can tell whether they were accepted.
+                      None for no limit.
+            bad_token_cache_size: If set, remember up to this many tokens that
+                      the gateway or feedback service has said are invalid and
+                      refuse to send to them (see bad_tokens).
+            bad_token_ttl: Number of seconds to remember invalid tokens for,
+                      or None to remember them until they're evicted.
+            metrics: A MetricsSink to report counters and timings to.
+            warm_connections: Number of connections to keep open even when
+                      idle, opening a replacement in the background whenever
+                      one is retired, so sends don't have to wait for a
+                      connection to be established. Not allowed with a hub,
+                      whose budget they'd hold on to.
+            priority_weights: dict of APNS priority to weight. Each connection
+                      queues pushes in a lane per priority and, when they back
+                      up, writes this many from each lane in turn, highest
+                      priority first. Defaults to 4 pushes of priority 10 for
+                      each of priority 5.
+            max_rate: Maximum number of pushes per second to write over all
+                      connections, or None for no limit.
+            max_rate_per_connection: Maximum number of pushes per second to
+                      write on each connection, or None for no limit.
+            adaptive_rate: If True, slow down (from max_rate) when the gateway
+                      shows signs of being overloaded by sending SHUTDOWN or
+                      PROCESSING errors or resetting connections, and speed
+                      back up as pushes are accepted. Needs max_rate.
+            journal: A Journal to record pushes and their outcomes in, so
+                      pushes that hadn't settled when the process died can
+                      be sent again with recover().
+            hub: The PushHub this is sending for, if any, whose timers and
+                      connection budget to share (see PushHub.add_app()).
         """
-        self.fbaddress = None
-        if isinstance(platform, str):
-            if platform in PushBaby.ADDRESSES:
-                self.address = PushBaby.ADDRESSES[platform]
-                self.fbaddress = PushBaby.FEEDBACK_ADDRESSES[platform]
-            else:
-                self.address = (platform, 2195)
-        else:
-            self.address = platform
-
-        if feedback_address:
-            self.fbaddress = feedback_address
+        if warm_connections < 0 or warm_connections > max_connections:
+            raise ValueError("Need 0 <= warm_connections <= max_connections")
+        if hub is not None and warm_connections > 0:
+            raise ValueError("warm_connections can't be used with a PushHub")
+        PushPool.__init__(
+            self, certfile, keyfile=keyfile, platform=platform, feedback_address=feedback_address,
+            min_connections=min_connections, max_connections=max_connections, max_in_flight=max_in_flight,
+            bad_token_cache_size=bad_token_cache_size, bad_token_ttl=bad_token_ttl, metrics=metrics,
+            max_rate=max_rate, max_rate_per_connection=max_rate_per_connection, adaptive_rate=adaptive_rate
+        )
+        self.max_queue_size = max_queue_size
+        self.warm_connections = warm_connections
+        self.priority_weights = priority_weights
+        self.hub = hub
+        # shared by all our connections for retiring them when idle, and by
+        # every app of a hub
+        self.timers = hub.timers if hub is not None else TimerWheel()
+        # the last TLS session for each address, to resume when reconnecting
+        self.tls_sessions = {}
+        self.journal = journal
+        self.on_feedback = None
+        self.feedback_poller = None
+        # timer for trying again to open warm connections
+        self.warm_retry_timer = None
+        self._replenish()
 
-        if not self.fbaddress:
-            logger.warn(
-                "gateway address manually configured but no feedback_address " +
-                "supplied. Fetching feedback will not work"
+    def _wrap_socket(self, sock, address):
+        """
+        Sets up TLS on a newly connected socket, using an SSLContext shared
+        by all our connections so the certificate is only loaded once, and
+        resuming our last session with that address if we can.
+        """
+        if self.ssl_context is None:
+            # PROTOCOL_TLS_CLIENT is from Python 3.6
+            ctx = gevent.ssl.SSLContext(
+                getattr(gevent.ssl, 'PROTOCOL_TLS_CLIENT', gevent.ssl.PROTOCOL_SSLv23)
             )
+            # As before: the gateway's certificate isn't checked, only ours
+            # is, by the gateway
+            ctx.check_hostname = False
+            ctx.verify_mode = gevent.ssl.CERT_NONE
+            ctx.load_cert_chain(self.certfile, keyfile=self.keyfile)
+            self.ssl_context = ctx
 
-        self.sock = None
-        self.certfile = certfile
-        self.keyfile = keyfile
-        self.conns = []
-        self.on_push_failed = None
-        self.on_feedback = None
+        # TLS sessions can only be resumed from Python 3.6
+        if not hasattr(gevent.ssl.SSLSocket, 'session'):
+            return self.ssl_context.wrap_socket(sock)
+
+        sslsock = self.ssl_context.wrap_socket(sock, session=self.tls_sessions.get(address))
+        if sslsock.session_reused:
+            logger.debug("Resumed TLS session with %s", address)
+        self._save_tls_session(sslsock, address)
+        return sslsock
+
+    def _save_tls_session(self, sock, address):
+        """
+        Remembers the TLS session of a connection to address, to resume the
+        next time we connect. With TLS 1.3 the session ticket only arrives
+        after the handshake, so connections call this again when they close.
+        """
+        session = getattr(sock, 'session', None)
+        if session is None:
+            return
+        if sock.version() == 'TLSv1.3' and not session.has_ticket:
+            # can't be resumed: keep the one we had
+            return
+        self.tls_sessions[address] = session
 
     def send(self, payload, token, expiration=None, priority=None, identifier=None):
         """
         Attempts to send a push message. On network failures, progagates the exception.
-        It is advised to make all text in the payload dictionary unicode objects and not
-        mix unicode objects and str objects. If str objects are used, they must be
-        in UTF-8 encoding.
+        It is advised to make all text in the payload dictionary text (unicode) objects and
+        not mix them with bytes. If bytes are used, they must be in UTF-8 encoding.
         Args:
-            payload (dict): The dictionary payload of the push to send
-            token (str): token to send the push to (raw, unencoded bytes)
+            payload (dict): The dictionary payload of the push to send, or a
+                        PreparedPayload to send the same payload to many tokens
+            token (bytes): token to send the push to (raw, unencoded bytes)
             expiration (int, seconds): When the message becomes irrelevant (time in seconds, as from time.time())
             priority (int): Integer priority for the message as per Apple's documentation
             identifier (any): optional identifier that will be returned if the push fails.
                         This is opaque to the library and not limited to 4 bytes.
+        Throws:
+            BodyTooLongException: If the payload body is too long and cannot be truncated to fit
+            InvalidTokenException: If the token is in the bad token cache
+            PushBabyClosedException: If drain() or close() has been called
+        """
+        self._check_not_closing()
+        if self._is_bad_token(token):
+            raise InvalidTokenException()
+
+        payload, jid = self._journal_push(payload, token, expiration, priority, identifier)
+        try:
+            return self._send_with_retry(
+                lambda conn: conn.send(
+                    payload, token, expiration=expiration, priority=priority, identifier=identifier,
+                    jid=jid
+                )
+            )
+        except:
+            self._abandon(jid)
+            raise
+
+    def send_async(self, payload, token, expiration=None, priority=None, identifier=None):
+        """
+        Like send() but returns as soon as the push has been queued rather than
+        waiting for it to be written to the network. If max_queue_size is set,
+        this blocks while the queue is full.
+        Returns:
+            A gevent AsyncResult that is set once we know whether the push was
+            delivered: to NO_ERROR if it was accepted or to the status code
+            (see pushbaby.errors) if it failed. Pushes that are automatically
+            retried keep the same AsyncResult. If the connection dies before
+            we find out, the AsyncResult is set to a ConnectionDeadException.
+            If the push expires before it can be written, it is set to a
+            PushExpiredException.
+            If we stop waiting to hear about it because of max_in_flight, it
+            is set to UNKNOWN: it may or may not have been delivered.
+            If the token is in the bad token cache, the AsyncResult is set to
+            INVALID_TOKEN straight away.
         Throws:
             BodyTooLongException: If the payload body is too long and cannot be truncated to fit
         """
+        self._check_not_closing()
+        return self._send_async(payload, token, expiration, priority, identifier, gevent.event.AsyncResult())
 
-        # we only use one conn at a time currently but we may as well do this...
-        created_conn = False
-        while not created_conn:
-            if len(self.conns) == 0:
-                self.conns.append(PushConnection(self, self.address, self.certfile, self.keyfile))
-                created_conn = True
-            conn = random.choice(self.conns)
+    def _send_async(self, payload, token, expiration, priority, identifier, result):
+        if self._is_bad_token(token):
+            result.set(pushbaby.errors.INVALID_TOKEN)
+            return result
+        payload, jid = self._journal_push(payload, token, expiration, priority, identifier)
+        try:
+            return self._send_with_retry(
+                lambda conn: conn.send_async(
+                    payload, token, expiration=expiration, priority=priority, identifier=identifier,
+                    result=result, jid=jid
+                )
+            )
+        except:
+            self._abandon(jid)
+            raise
+
+    def send_many(self, pushes):
+        """
+        Sends many pushes, writing them to the network in batches rather than
+        one at a time. This is much more efficient than calling send() for
+        each push when sending to lots of devices at once.
+        Args:
+            pushes (iterable): dicts with the arguments to send() for each push,
+                        ie. 'payload', 'token' and optionally 'expiration',
+                        'priority' and 'identifier'
+        Returns:
+            A list with an entry for each push: None if it was sent or the
+            exception (ie. BodyTooLongException or InvalidTokenException)
+            if it could not be.
+        """
+        self._check_not_closing()
+        results = []
+        for batch, batch_indexes in self._batches(pushes, results):
+            self._send_batch(batch, batch_indexes, results)
+        return results
+
+    def _send_batch(self, batch, batch_indexes, results):
+        try:
+            batch_results = self._send_with_retry(lambda conn: conn.send_many(batch))
+        except:
+            for push in batch:
+                self._abandon(push.get('jid'))
+            raise
+        for i, res in zip(batch_indexes, batch_results):
+            results[i] = res
+
+    def recover(self):
+        """
+        Sends again the pushes that the journal says hadn't settled when
+        the process last stopped, ie. that were still queued or that we were
+        still waiting to hear about. Call this once, at startup. Pushes we
+        were waiting to hear about may have been delivered already, so some
+        devices may get them twice.
+        Returns:
+            The number of pushes resent
+        """
+        if self.journal is None:
+            raise Exception("Attempted to recover pushes but no journal supplied")
+        self._check_not_closing()
+        pushes = []
+        for jp in self.journal.recovered():
+            if self._is_bad_token(jp.token):
+                self.journal.record_settled(jp.jid, pushbaby.errors.INVALID_TOKEN)
+                continue
+            pushes.append({
+                'payload': jp.payload,
+                'token': jp.token,
+                'expiration': jp.expiration,
+                'priority': jp.priority,
+                'identifier': jp.identifier,
+                'jid': jp.jid,
+            })
+        logger.info("Resending %d pushes recovered from the journal", len(pushes))
+        for i in range(0, len(pushes), PushBaby.SEND_MANY_BATCH_SIZE):
+            batch = pushes[i:i + PushBaby.SEND_MANY_BATCH_SIZE]
+            self._send_batch(batch, range(len(batch)), [None] * len(batch))
+        return len(pushes)
+
+    def _resend(self, sms):
+        """
+        Resends pushes that a connection sent but which the gateway didn't
+        process, in order and in as few batches as possible.
+        Args:
+            sms (list): PushConnection.SentMessage objects, in the order they
+                        were originally sent
+        """
+        for batch in self._resend_batches(sms):
+            try:
+                self._send_with_retry(lambda conn: conn.resend_many(batch))
+            except:
+                logger.exception("Failed to resend %d pushes", len(batch))
+                self._note_lost()
+                for sm in batch:
+                    sm.fail(SendFailedException())
+
+    def _send_with_retry(self, sendfn):
+        """
+        Calls sendfn with a connection from the pool, trying again on another
+        connection if that one has died.
+        """
+        for conn in self._connections_to_try():
             try:
-                conn.send(payload, token, expiration=expiration, priority=priority, identifier=identifier)
-                return
+                return sendfn(conn)
+            except BodyTooLongException:
+                raise
             except:
-                logger.info("Connection died: removing")
+                # on to the next one
+                continue
+
+    def _can_grow(self):
+        # don't take other apps' connections just to go faster
+        return self.hub is None or self.hub._has_room()
+
+    def _new_connection(self):
+        return PushConnection(
+            self, self.address, self.certfile, self.keyfile,
+            max_queue_size=self.max_queue_size, max_in_flight=self.max_in_flight,
+            priority_weights=self.priority_weights, max_rate=self.max_rate_per_connection
+        )
+
+    def _acquire_slot(self, conn):
+        """
+        Called before conn opens, to keep within the hub's connection budget.
+        """
+        if self.hub is not None:
+            self.hub._acquire_slot(conn)
+
+    def _release_slot(self, conn):
+        if self.hub is not None:
+            self.hub._release_slot(conn)
+
+    def _replenish(self):
+        """
+        Opens connections in the background until there are warm_connections
+        fresh ones. Called whenever a connection is retired or closed, other
+        than by draining it.
+        """
+        if self.closing or self.warm_connections == 0:
+            return
+        self.conns = [c for c in self.conns if c.alive]
+        fresh = [c for c in self.conns if c.is_fresh()]
+        for _ in range(self.warm_connections - len(fresh)):
+            logger.info("Opening warm connection (%d fresh in pool)", len(fresh))
+            conn = self._new_connection()
+            # add it now so it's counted if we're called again before it's open
+            self.conns.append(conn)
+            gevent.spawn(self._warm, conn)
+
+    def _is_warm(self, conn):
+        """
+        Returns True if conn is one of the warm_connections we keep open when
+        idle: the oldest fresh ones. Retiring those when idle would only have
+        _replenish() open replacements.
+        """
+        if self.warm_connections == 0:
+            return False
+        fresh = [c for c in self.conns if c.is_fresh()]
+        return conn in fresh[:self.warm_connections]
+
+    def _warm(self, conn):
+        try:
+            conn.open()
+        except:
+            logger.exception("Failed to open warm connection: retrying in %d seconds", PushBaby.WARM_RETRY_SEC)
+            if conn in self.conns:
                 self.conns.remove(conn)
-        raise SendFailedException()
+            if self.warm_retry_timer is None:
+                self.warm_retry_timer = self.timers.schedule(PushBaby.WARM_RETRY_SEC, self._retry_warm)
+
+    def _retry_warm(self):
+        self.warm_retry_timer = None
+        self._replenish()
+
+    def drain(self, timeout=None):
+        """
+        Shuts down gracefully: stops accepting new pushes, waits for all queued
+        pushes to be written and for the gateway to have processed them (or
+        failed them, in which case on_push_failed is called and any retries
+        are sent as normal), then closes all connections.
 
-    def messages_in_flight(self):
+        Rather than waiting to see if errors arrive, this sends a push the
+        gateway will reject after the last push on each connection: once that
+        fails, we know everything before it was accepted.
+
+        Blocks the current greenlet until done or the timeout expires.
+        Args:
+            timeout (float, seconds): Maximum time to wait, or None to wait
+                        as long as it takes.
+        Returns:
+            True if every push was written and processed, False if we gave
+            up waiting or on any push (eg. because a connection dropped
+            before the gateway told us what happened to it).
         """
-        Returns True if there are messages waiting to be sent or that we're
-        still waiting to see if errors occur for.
-        This can be used to determine whether it is safe to shut down the
-        application.
+        deadline = self._start_drain(timeout)
+        while True:
+            conns, remaining = self._drain_step(deadline)
+            if len(conns) == 0:
+                break
+            gevent.wait([c.closed_event for c in conns], timeout=remaining)
+        return self._finish_drain()
+
+    def close(self):
         """
-        for c in self.conns:
-            if c.messages_in_flight():
-                return True
-        return False
+        Closes all connections straight away. Pushes that are queued or that
+        we don't yet know the fate of are failed with ConnectionDeadException
+        (see send_async()), but stay in the journal, if there is one, to be
+        resent by recover(). Use drain() to shut down gracefully.
+        """
+        self.closing = True
+        self.stop_feedback_poller()
+        if self.warm_retry_timer is not None:
+            self.timers.cancel(self.warm_retry_timer)
+            self.warm_retry_timer = None
+        if self.journal is not None:
+            # before closing the connections, so that pushes we've not heard
+            # about are left in the journal to be recovered
+            self.journal.close()
+        self._close_connections()
 
     def get_all_feedback(self):
         """
@@ -139,6 +483,50 @@ class PushBaby:
         fbconn = FeedbackConnection(self, self.fbaddress, self.certfile, self.keyfile)
         return fbconn.get_all()
 
+    def iter_feedback(self):
+        """
+        Connects to the feedback service and yields FeedbackItem objects as
+        they are received, so large amounts of feedback can be processed
+        without holding it all in memory.
+
+        Network errors are handled as in get_all_feedback(): if one occurs
+        before any feedback is received, it is propagated to the caller.
+        Otherwise the iteration simply ends.
+        """
+        if not self.fbaddress:
+            raise Exception("Attempted to fetch feedback but no feedback_address supplied")
+
+        fbconn = FeedbackConnection(self, self.fbaddress, self.certfile, self.keyfile)
+        return fbconn.iter_items()
+
+    def start_feedback_poller(self, interval=3600, jitter=0.1):
+        """
+        Starts fetching feedback in the background every interval seconds,
+        passing it to on_feedback in lists of FeedbackItems. Tokens are only
+        reported again if newer feedback arrives for them. Connection errors
+        are retried sooner, backing off up to the interval.
+        Args:
+            interval (int, seconds): How often to poll for feedback
+            jitter (float): Fraction of the interval to randomly vary each wait by
+        """
+        if not self.fbaddress:
+            raise Exception("Attempted to fetch feedback but no feedback_address supplied")
+        if self.feedback_poller is None:
+            self.feedback_poller = FeedbackPoller(self, interval, jitter)
+        self.feedback_poller.start()
+
+    def stop_feedback_poller(self):
+        if self.feedback_poller is not None:
+            self.feedback_poller.stop()
+
 
 class SendFailedException(Exception):
     pass
+
+
+class InvalidTokenException(Exception):
+    pass
+
+
+class PushBabyClosedException(Exception):
+    pass
@@ -0,0 +1,529 @@
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+PushBaby for applications running on an asyncio event loop rather than
+gevent, so they don't need a second event loop (and thread hops) to send
+pushes. Framing, retries, failure handling and truncation are the same code
+as the gevent PushBaby's (see pushbaby.pushprotocol), so pushes behave the
+same way whichever you use. Needs Python 3.7 or later.
+"""
+
+import asyncio
+import errno
+import logging
+import ssl
+import time
+
+import pushbaby.errors
+from pushbaby import SendFailedException, InvalidTokenException
+from pushbaby.feedback import parse_items
+from pushbaby.pushpool import PushPool
+from pushbaby.pushprotocol import PushProtocol, ERROR_RESPONSE, ConnectionDeadException
+from pushbaby.truncate import BodyTooLongException
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncPushBaby(PushPool):
+    """
+    The asyncio equivalent of PushBaby. Methods that talk to the network
+    are coroutines, and send_async() returns an asyncio Future; everything
+    else, including on_push_failed and on_push_expired, works as it does
+    for PushBaby:
+
+        pb = AsyncPushBaby(certfile='mycert.pem')
+        pb.on_push_failed = on_push_failed
+        await pb.send({'aps': {'alert': u'Hello'}}, token)
+
+    Call its methods, including send_async(), from code running on the
+    event loop. It doesn't (yet) support warm connections, priority lanes,
+    the journal, the feedback poller, or resending pushes the gateway never
+    acknowledged when a connection drops.
+
+    Unlike PushBaby, it checks the gateway's certificate against the
+    system's trusted CAs.
+    """
+    def __init__(self, certfile, keyfile=None, platform='sandbox', feedback_address=None,
+                 min_connections=1, max_connections=4, max_in_flight=None,
+                 bad_token_cache_size=None, bad_token_ttl=None, metrics=None,
+                 max_rate=None, max_rate_per_connection=None, adaptive_rate=False):
+        """
+        Args:
+            As for PushBaby
+        """
+        PushPool.__init__(
+            self, certfile, keyfile=keyfile, platform=platform, feedback_address=feedback_address,
+            min_connections=min_connections, max_connections=max_connections, max_in_flight=max_in_flight,
+            bad_token_cache_size=bad_token_cache_size, bad_token_ttl=bad_token_ttl, metrics=metrics,
+            max_rate=max_rate, max_rate_per_connection=max_rate_per_connection, adaptive_rate=adaptive_rate
+        )
+        # the loop only keeps weak references to tasks, so we keep the ones
+        # we start in the background until they're done
+        self.tasks = set()
+
+    def _get_ssl_context(self):
+        if self.ssl_context is None:
+            ctx = ssl.create_default_context()
+            ctx.load_cert_chain(self.certfile, keyfile=self.keyfile)
+            self.ssl_context = ctx
+        return self.ssl_context
+
+    def _spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def send(self, payload, token, expiration=None, priority=None, identifier=None):
+        """
+        Sends a push, returning once it has been written. See PushBaby.send().
+        Throws:
+            BodyTooLongException: If the payload body is too long and cannot be truncated to fit
+            InvalidTokenException: If the token is in the bad token cache
+            PushBabyClosedException: If drain() or close() has been called
+        """
+        self._check_not_closing()
+        if self._is_bad_token(token):
+            raise InvalidTokenException()
+        payload = self._prepare(payload)
+        await self._send_with_retry(
+            lambda conn: conn.send(payload, token, expiration, priority, identifier)
+        )
+
+    def send_async(self, payload, token, expiration=None, priority=None, identifier=None):
+        """
+        Sends a push in the background.
+        Returns:
+            An asyncio Future that is set once we know whether the push was
+            delivered, as for the AsyncResult from PushBaby.send_async().
+        Throws:
+            BodyTooLongException: If the payload body is too long and cannot be truncated to fit
+        """
+        self._check_not_closing()
+        future = asyncio.get_running_loop().create_future()
+        if self._is_bad_token(token):
+            future.set_result(pushbaby.errors.INVALID_TOKEN)
+            return future
+        payload = self._prepare(payload)
+        self._spawn(self._send_async(payload, token, expiration, priority, identifier, _FutureResult(future)))
+        return future
+
+    async def _send_async(self, payload, token, expiration, priority, identifier, result):
+        try:
+            await self._send_with_retry(
+                lambda conn: conn.send(payload, token, expiration, priority, identifier, result)
+            )
+        except Exception:
+            logger.exception("Caught exception sending push")
+            if not result.ready():
+                result.set_exception(ConnectionDeadException())
+
+    async def send_many(self, pushes):
+        """
+        Sends many pushes, writing them to the network in batches. See
+        PushBaby.send_many().
+        Returns:
+            A list with an entry for each push: None if it was sent or the
+            exception (ie. BodyTooLongException or InvalidTokenException)
+            if it could not be.
+        """
+        self._check_not_closing()
+        results = []
+        for batch, _ in self._batches(pushes, results):
+            await self._send_with_retry(lambda conn: conn.send_many(batch))
+        return results
+
+    async def _resend(self, sms):
+        """
+        Resends pushes that a connection sent but which the gateway didn't
+        process, as PushBaby._resend().
+        """
+        for batch in self._resend_batches(sms):
+            try:
+                await self._send_with_retry(lambda conn: conn.resend_many(batch))
+            except Exception:
+                logger.exception("Failed to resend %d pushes", len(batch))
+                self._note_lost()
+                for sm in batch:
+                    sm.fail(SendFailedException())
+
+    async def _send_with_retry(self, sendfn):
+        """
+        Awaits sendfn with a connection from the pool, trying again on
+        another connection if that one has died.
+        """
+        for conn in self._connections_to_try():
+            try:
+                return await sendfn(conn)
+            except BodyTooLongException:
+                raise
+            except Exception:
+                # on to the next one
+                continue
+
+    def _new_connection(self):
+        return AsyncPushConnection(
+            self, self.address, self.certfile, self.keyfile,
+            max_in_flight=self.max_in_flight, max_rate=self.max_rate_per_connection
+        )
+
+    async def drain(self, timeout=None):
+        """
+        Shuts down gracefully, as PushBaby.drain().
+        Returns:
+            True if every push was written and processed, False if we gave
+            up waiting or on any push.
+        """
+        deadline = self._start_drain(timeout)
+        while True:
+            conns, remaining = self._drain_step(deadline)
+            if len(conns) == 0:
+                break
+            waits = [asyncio.ensure_future(c.closed_event.wait()) for c in conns]
+            (_, pending) = await asyncio.wait(waits, timeout=remaining)
+            for w in pending:
+                w.cancel()
+
+        return self._finish_drain()
+
+    def close(self):
+        """
+        Closes all connections straight away, as PushBaby.close().
+        """
+        self.closing = True
+        self._close_connections()
+
+    async def get_all_feedback(self):
+        """
+        Connects to the feedback service and returns any feedback that is sent
+        as a list of FeedbackItem objects. Errors are handled as in
+        PushBaby.get_all_feedback().
+        """
+        if not self.fbaddress:
+            raise Exception("Attempted to fetch feedback but no feedback_address supplied")
+
+        fbconn = AsyncFeedbackConnection(self, self.fbaddress, self.certfile, self.keyfile)
+        return await fbconn.get_all()
+
+
+class AsyncPushConnection(PushProtocol, asyncio.Protocol):
+    """
+    A connection to the push gateway that does its I/O on an asyncio event
+    loop. Frames are written straight to the transport, which buffers them,
+    so there's no send queue: senders only wait for the connection to open,
+    for the rate limit and, if the transport's buffer is full, for it to
+    empty.
+    """
+    def __init__(self, pushbaby, address, certfile, keyfile, max_in_flight=None, max_rate=None):
+        PushProtocol.__init__(self, pushbaby, max_in_flight=max_in_flight, max_rate=max_rate)
+        self.address = address
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.loop = None
+        self.transport = None
+        # what we've read of the next error response
+        self.buf = bytearray()
+        self.open_event = None
+        self.closed_event = asyncio.Event()
+        # cleared while the transport wants us to stop writing
+        self.write_ready = asyncio.Event()
+        self.write_ready.set()
+        # number of pushes waiting to be written
+        self.waiting = 0
+        # how long the transport's buffer can stay full before we give up on
+        # the connection, where TCP_USER_TIMEOUT can't do that for us
+        self.write_timeout = None
+
+    # asyncio.Protocol
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.buf.extend(data)
+        while self.alive and len(self.buf) >= ERROR_RESPONSE.size:
+            response = bytes(self.buf[:ERROR_RESPONSE.size])
+            del self.buf[:ERROR_RESPONSE.size]
+            self._handle_error_response(response)
+
+    def connection_lost(self, exc):
+        if not self.alive:
+            # we closed it ourselves
+            return
+        if exc is None or getattr(exc, 'errno', None) == errno.ECONNRESET:
+            logger.info("Connection closed remotely")
+            if self.useable:
+                # not because of an error we were sent
+                self._rate_backoff()
+        else:
+            logger.error("Connection lost: %s", exc)
+        self._close_connection()
+
+    def pause_writing(self):
+        self.write_ready.clear()
+
+    def resume_writing(self):
+        self.write_ready.set()
+
+    # PushProtocol
+
+    def _close_connection(self):
+        if self.alive:
+            self.pushbaby.metrics.increment('connections_closed')
+        self.alive = False
+        self.useable = False
+        if self.lifecycle_timer is not None:
+            self.lifecycle_timer.cancel()
+            self.lifecycle_timer = None
+        if self.transport is not None:
+            self.transport.close()
+        self._fail_in_flight()
+        self.closed_event.set()
+        # let anyone waiting to write find out
+        self.write_ready.set()
+
+    def _retire_connection(self):
+        if self.useable:
+            self.pushbaby.metrics.increment('connections_retired')
+        self.useable = False
+        self.retired_at = time.time()
+
+    def _schedule_lifecycle(self, delay):
+        if self.lifecycle_timer is not None:
+            self.lifecycle_timer.cancel()
+        self.lifecycle_timer = self.loop.call_later(delay, self._lifecycle)
+
+    def _resend_later(self, sms):
+        self.pushbaby._spawn(self.pushbaby._resend(sms))
+
+    async def _open_connection(self):
+        logger.info("Establishing new connection to %s", self.address)
+        self.loop = asyncio.get_running_loop()
+        start = time.time()
+        # We use a non-ssled connection if both certfile and keyfile
+        # are None, as PushBaby does. This is useful only for testing.
+        sslctx = None
+        if self.certfile or self.keyfile:
+            sslctx = self.pushbaby._get_ssl_context()
+        await asyncio.wait_for(
+            self.loop.create_connection(lambda: self, self.address[0], self.address[1], ssl=sslctx),
+            PushProtocol.CONN_TIMEOUT
+        )
+        if not self.alive:
+            # closed whilst we were connecting
+            self.transport.close()
+            raise ConnectionDeadException()
+        sock = self.transport.get_extra_info('socket')
+        self._set_keepalive(sock)
+        if not self._set_user_timeout(sock):
+            self.write_timeout = PushProtocol.CONN_TIMEOUT
+        self.pushbaby.metrics.observe('handshake_seconds', time.time() - start)
+        self.pushbaby.metrics.increment('connections_opened')
+        self.opened_at = time.time()
+        self._schedule_lifecycle(PushProtocol.MAX_CONN_IDLE_SEC)
+
+    async def _ensure_open(self):
+        if not self.alive or not self.useable or self.draining:
+            raise ConnectionDeadException()
+        if self.transport is None:
+            # Another send may start whilst the connection is being opened:
+            # wait for that rather than opening it again
+            if self.open_event is None:
+                self.open_event = asyncio.Event()
+                try:
+                    await self._open_connection()
+                except Exception:
+                    logger.exception("Caught exception opening connection")
+                    self.alive = False
+                    self.useable = False
+                    # Don't raise ConnectionDeadException here: this is reserved
+                    # for connections which did work and now don't. Raising it
+                    # when the connection has never worked will cause loops.
+                    raise
+                finally:
+                    self.open_event.set()
+            else:
+                await self.open_event.wait()
+                if self.transport is None:
+                    raise ConnectionDeadException()
+
+    def is_open(self):
+        return self.alive and self.transport is not None
+
+    def queue_depth(self):
+        """
+        Returns the number of pushes waiting to be written.
+        """
+        return self.waiting
+
+    def load(self):
+        """
+        Returns the number of pushes waiting to be written plus the number
+        we're still waiting to see if errors occur for.
+        """
+        return self.waiting + len(self.sent)
+
+    def messages_in_flight(self):
+        self.prune_sent()
+        return self.waiting > 0 or len(self.sent) > 0
+
+    def drain(self):
+        """
+        Stops taking new pushes and closes the connection once the gateway
+        has processed the ones already written. Wait on closed_event to find
+        out when that is.
+        """
+        if self.draining or not self.alive:
+            return
+        self.draining = True
+        self._retire_connection()
+        if self.transport is None or len(self.sent) == 0:
+            # nothing to wait for
+            self._close_connection()
+            return
+        self.transport.write(self._pack_probe())
+
+    async def send(self, payload, token, expiration=None, priority=None, identifier=None, result=None):
+        """
+        Args:
+            payload (PreparedPayload): The payload of the push to send
+            result (object): Set when the push succeeds or fails, with the
+                        interface of a gevent AsyncResult
+        """
+        await self._reallysend_many([self._push(payload, token, expiration, priority, identifier, result)])
+
+    async def send_many(self, pushes):
+        """
+        Args:
+            pushes: list of dicts, each with the keyword arguments to send()
+        """
+        await self._reallysend_many([
+            self._push(
+                push['payload'], push['token'],
+                push.get('expiration'), push.get('priority'), push.get('identifier')
+            )
+            for push in pushes
+        ])
+
+    async def resend_many(self, sms):
+        """
+        Sends SentMessages from another connection again, in order.
+        """
+        await self._reallysend_many([
+            self._push(sm.payload, sm.token, sm.expiration, sm.priority, sm.identifier, sm.result)
+            for sm in sms
+        ])
+
+    async def _reallysend_many(self, pushes):
+        self.waiting += len(pushes)
+        try:
+            await self._ensure_open()
+            wait = self._rate_wait(len(pushes))
+            if wait > 0:
+                await asyncio.sleep(wait)
+        finally:
+            self.waiting -= len(pushes)
+        if not self.alive or not self.useable:
+            raise ConnectionDeadException()
+
+        pushes = self._drop_expired(pushes)
+        if len(pushes) == 0:
+            return
+
+        # Nothing between packing and writing yields to the loop, so pushes
+        # are written in the order their seqs were given out
+        (seqs, frames) = self._pack_pushes(pushes)
+        self.transport.write(frames)
+        self._record_sent(seqs, pushes)
+        # don't let the transport's buffer grow without limit
+        try:
+            await asyncio.wait_for(self.write_ready.wait(), self.write_timeout)
+        except asyncio.TimeoutError:
+            logger.error("Timed out writing to the gateway: closing connection")
+            self._close_connection()
+
+
+class AsyncFeedbackConnection:
+    # How much we try to read from the network at once
+    RECV_SIZE = 65536
+    TIMEOUT = 10.0
+
+    def __init__(self, pushbaby, address, certfile, keyfile):
+        self.pushbaby = pushbaby
+        self.address = address
+        self.certfile = certfile
+        self.keyfile = keyfile
+
+    async def get_all(self):
+        logger.info("Establishing new feedback connection to %s", self.address)
+        sslctx = None
+        if self.certfile or self.keyfile:
+            sslctx = self.pushbaby._get_ssl_context()
+        (reader, writer) = await asyncio.wait_for(
+            asyncio.open_connection(self.address[0], self.address[1], ssl=sslctx),
+            AsyncFeedbackConnection.TIMEOUT
+        )
+
+        buf = bytearray()
+        feedback = []
+        try:
+            while True:
+                try:
+                    gotdata = await asyncio.wait_for(
+                        reader.read(AsyncFeedbackConnection.RECV_SIZE), AsyncFeedbackConnection.TIMEOUT
+                    )
+                except OSError as e:
+                    # (including ssl.SSLError)
+                    if not e.errno == errno.ECONNRESET:
+                        logger.exception("Caught exception whilst getting feedback")
+                        # If we've already got feedback, stop here: we won't get it again
+                        if len(feedback) == 0:
+                            raise
+                    break
+                # NB. as with FeedbackConnection, timeouts are fatal
+                if len(gotdata) == 0:
+                    break
+                buf.extend(gotdata)
+
+                (items, offset) = parse_items(buf)
+                del buf[:offset]
+                for item in items:
+                    # the device has told Apple this token is no longer valid
+                    self.pushbaby._add_bad_token(item.token)
+                    feedback.append(item)
+        finally:
+            writer.close()
+        logger.info("Returning %d feedback items", len(feedback))
+        return feedback
+
+
+class _FutureResult(object):
+    """
+    Lets a SentMessage settle an asyncio Future as it would a gevent AsyncResult.
+    """
+    __slots__ = ('future',)
+
+    def __init__(self, future):
+        self.future = future
+
+    def ready(self):
+        return self.future.done()
+
+    def set(self, value):
+        self.future.set_result(value)
+
+    def set_exception(self, ex):
+        self.future.set_exception(ex)
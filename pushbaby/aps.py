@@ -13,6 +13,7 @@
 # limitations under the License.
 
 import json.encoder
+import sys
 
 # May as well cache a JSON encoder because we'll be
 # using the same altered configuration each time
@@ -31,12 +32,17 @@ import json.encoder
 # In reality, we always convert text we know about
 # to unicode in truncation so this shouldn't be an
 # issue, but it could break if Apple add other
-# text fields we don't handle
-jsonencoder = json.encoder.JSONEncoder(
-    ensure_ascii=False,
-    encoding='utf8',  # 'utf8' != 'utf-8' here, see above
-    separators=(',', ':')
-)
+# text fields we don't handle.
+#
+# Python 3's encoder only deals in text (and uses the C accelerator
+# regardless) so it has no encoding argument.
+_encoder_args = {
+    'ensure_ascii': False,
+    'separators': (',', ':'),
+}
+if sys.version_info[0] < 3:
+    _encoder_args['encoding'] = 'utf8'  # 'utf8' != 'utf-8' here, see above
+jsonencoder = json.encoder.JSONEncoder(**_encoder_args)
 
 
 def json_for_payload(payload):
@@ -0,0 +1,55 @@
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import time
+
+
+class BadTokenCache:
+    """
+    A bounded set of tokens we know to be invalid, so we can refuse to send
+    to them rather than have the gateway drop our connection. The least
+    recently used tokens are evicted once it's full and, if ttl is set,
+    tokens are forgotten after that many seconds.
+    """
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        # token -> time it was added, least recently used first
+        self.tokens = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def __contains__(self, token):
+        added = self.tokens.pop(token, None)
+        if added is None:
+            return False
+        if self.ttl is not None and added < time.time() - self.ttl:
+            return False
+        # put it back at the most recently used end
+        self.tokens[token] = added
+        return True
+
+    def add(self, token):
+        self.tokens.pop(token, None)
+        self.tokens[token] = time.time()
+        while len(self.tokens) > self.max_size:
+            self.tokens.popitem(last=False)
+
+    def discard(self, token):
+        """
+        Forgets a token, eg. because the device has registered it again.
+        """
+        self.tokens.pop(token, None)
@@ -0,0 +1,219 @@
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gevent
+import gevent.queue
+import gevent.socket
+import gevent.ssl
+
+import logging
+import os
+import struct
+import subprocess
+
+
+logger = logging.getLogger(__name__)
+
+FRAME_HEADER = struct.Struct("!BI")
+ITEM_HEADER = struct.Struct("!BH")
+
+
+class FakeGateway:
+    """
+    A fake APNS gateway that speaks the binary protocol, for testing and
+    benchmarking. It accepts any number of connections and records the
+    pushes it receives. It can use TLS, reject pushes, add latency and
+    throttle how fast it reads.
+
+    Point a PushBaby at it with platform=gateway.get_addr() (and
+    certfile=None if the gateway isn't using TLS).
+    """
+    def __init__(self, certfile=None, keyfile=None, latency=0, read_rate=None, record=True):
+        """
+        Args:
+            certfile: Certificate for the server side of TLS connections,
+                      or None to not use TLS.
+            keyfile: Private key for certfile.
+            latency (float, seconds): How long to wait before processing each
+                      push.
+            read_rate (int, bytes per second): Maximum rate to read from each
+                      connection, or None for as fast as possible.
+            record (bool): Whether to keep received pushes for get_push().
+                      Turn this off when sending large numbers of pushes.
+        """
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.latency = latency
+        self.read_rate = read_rate
+        self.record = record
+        self.sock = None
+        self.listen_greenlet = None
+        self.client_greenlets = set()
+        self.client_socks = set()
+        self.pushes = gevent.queue.Queue()
+        self.num_pushes = 0
+        self.reject_code = None
+        # seq -> status to reject that push with
+        self.fail_seqs = {}
+        self.ssl_context = None
+        if certfile:
+            self.ssl_context = gevent.ssl.SSLContext(
+                getattr(gevent.ssl, 'PROTOCOL_TLS_SERVER', gevent.ssl.PROTOCOL_SSLv23)
+            )
+            self.ssl_context.load_cert_chain(certfile, keyfile=keyfile)
+
+    def start(self):
+        self.sock = gevent.socket.socket(gevent.socket.AF_INET, gevent.socket.SOCK_STREAM)
+        self.sock.setsockopt(gevent.socket.SOL_SOCKET, gevent.socket.SO_REUSEADDR, 1)
+        self.sock.bind(('localhost', 0))
+        self.sock.listen(128)
+        self.listen_greenlet = gevent.spawn(self._listen_loop)
+
+    def stop(self):
+        self.listen_greenlet.kill()
+        gevent.killall(list(self.client_greenlets))
+        for cs in list(self.client_socks):
+            cs.close()
+        self.sock.close()
+
+    def get_addr(self):
+        return self.sock.getsockname()
+
+    def set_reject_code(self, rc):
+        """
+        Rejects every push received from now on with the given status (or
+        stop rejecting them if None), closing the connection as APNS does.
+        """
+        self.reject_code = rc
+
+    def fail_seq(self, seq, status):
+        """
+        Rejects the push with the given seq (on whichever connection it
+        arrives) with the given status.
+        """
+        self.fail_seqs[seq] = status
+
+    def get_push(self, timeout=1):
+        """
+        Returns the next push received as a dict of 'token', 'payload',
+        'seq' and 'expiration' and 'priority' if they were given.
+        """
+        return self.pushes.get(timeout=timeout)
+
+    def _listen_loop(self):
+        while True:
+            (clisock, addr) = self.sock.accept()
+            g = gevent.spawn(self._client_loop, clisock)
+            self.client_greenlets.add(g)
+            g.link(self.client_greenlets.discard)
+
+    def _client_loop(self, cs):
+        if self.ssl_context:
+            cs = self.ssl_context.wrap_socket(cs, server_side=True)
+        self.client_socks.add(cs)
+        try:
+            reader = _Reader(cs, self.read_rate)
+            while True:
+                header = reader.read(FRAME_HEADER.size)
+                if header is None:
+                    break
+                (command, framelen) = FRAME_HEADER.unpack(header)
+                if command != 2:
+                    logger.error("Got unknown command: %d", command)
+                    break
+                frame = reader.read(framelen)
+                if frame is None:
+                    break
+                push = _parse_frame(frame)
+                if self.latency:
+                    gevent.sleep(self.latency)
+                if not push.get('token'):
+                    # missing token: not a push we count
+                    status = 2
+                else:
+                    self.num_pushes += 1
+                    if self.record:
+                        self.pushes.put(push)
+                    status = self.fail_seqs.pop(push['seq'], self.reject_code)
+                if status is not None:
+                    cs.sendall(struct.pack("!BBI", 8, status, push['seq']))
+                    break
+        except gevent.socket.error:
+            pass
+        finally:
+            self.client_socks.discard(cs)
+            cs.close()
+
+
+class _Reader:
+    def __init__(self, sock, rate):
+        self.sock = sock
+        self.rate = rate
+        self.buf = bytearray()
+
+    def read(self, n):
+        """
+        Returns exactly n bytes, or None if the connection is closed first.
+        """
+        while len(self.buf) < n:
+            if self.rate:
+                data = self.sock.recv(min(65536, max(1, self.rate // 10)))
+                gevent.sleep(float(len(data)) / self.rate)
+            else:
+                data = self.sock.recv(65536)
+            if len(data) == 0:
+                return None
+            self.buf.extend(data)
+        ret = bytes(self.buf[:n])
+        del self.buf[:n]
+        return ret
+
+
+def _parse_frame(frame):
+    offset = 0
+    push = {}
+    while offset < len(frame):
+        (itemid, itemdatalen) = ITEM_HEADER.unpack_from(frame, offset)
+        offset += ITEM_HEADER.size
+        itemdata = frame[offset:offset + itemdatalen]
+        offset += itemdatalen
+        if itemid == 1:
+            push['token'] = itemdata
+        elif itemid == 2:
+            push['payload'] = itemdata
+        elif itemid == 3:
+            push['seq'] = struct.unpack("!I", itemdata)[0]
+        elif itemid == 4:
+            push['expiration'] = struct.unpack("!I", itemdata)[0]
+        elif itemid == 5:
+            push['priority'] = struct.unpack("!B", itemdata)[0]
+    return push
+
+
+def make_self_signed_cert(directory):
+    """
+    Generates a self-signed certificate and key for a FakeGateway using
+    TLS, using the openssl command line tool. The same files can be used
+    as the client certificate.
+    Returns:
+        A tuple of the paths to the certificate and the key
+    """
+    certfile = os.path.join(directory, 'fakegateway.crt')
+    keyfile = os.path.join(directory, 'fakegateway.key')
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call([
+            'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+            '-subj', '/CN=localhost', '-keyout', keyfile, '-out', certfile,
+        ], stdout=devnull, stderr=devnull)
+    return certfile, keyfile
@@ -12,8 +12,34 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import struct
+
+
+# timestamp and token length of each feedback item
+ITEM_HEADER = struct.Struct("!IH")
+
 
 class FeedbackItem:
     def __init__(self, token, ts):
         self.token = token
         self.ts = ts
+
+
+def parse_items(buf):
+    """
+    Parses as many feedback items as have arrived in full from the start
+    of buf.
+    Returns:
+        A tuple of the list of FeedbackItems and the number of bytes of buf
+        they took up
+    """
+    items = []
+    offset = 0
+    while len(buf) - offset >= ITEM_HEADER.size:
+        (ts, toklen) = ITEM_HEADER.unpack_from(buf, offset)
+        end = offset + ITEM_HEADER.size + toklen
+        if len(buf) < end:
+            break
+        items.append(FeedbackItem(bytes(buf[offset + ITEM_HEADER.size:end]), float(ts)))
+        offset = end
+    return items, offset
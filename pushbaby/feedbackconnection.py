@@ -19,16 +19,18 @@ import gevent.event
 import gevent.queue
 
 import logging
-import struct
 import errno
 
-from .feedback import FeedbackItem
+from .feedback import parse_items
 
 
 logger = logging.getLogger(__name__)
 
 
 class FeedbackConnection:
+    # How much we try to read from the network at once
+    RECV_SIZE = 65536
+
     def __init__(self, pushbaby, address, certfile, keyfile):
         self.pushbaby = pushbaby
         self.address = address
@@ -37,56 +39,59 @@ class FeedbackConnection:
         self.sock = None
 
     def get_all(self):
+        feedback = list(self.iter_items())
+        logger.info("Returning %d feedback items", len(feedback))
+        return feedback
+
+    def iter_items(self):
+        """
+        Yields FeedbackItems as they arrive from the feedback service.
+        Reads from the network in large chunks, parsing as many items as
+        have arrived in full out of each one.
+        """
         if not self.sock:
             self._open_connection()
 
-        feedback = []
-        connection_alive = True
+        buf = bytearray()
+        num_items = 0
         try:
-            while connection_alive:
-                buf = ''
-                while len(buf) < 6:
-                    gotdata = self.sock.recv(6-len(buf))
-                    if gotdata == '':
-                        connection_alive = False
-                        break
-                    buf += gotdata
-                if not connection_alive:
+            while True:
+                try:
+                    gotdata = self.sock.recv(FeedbackConnection.RECV_SIZE)
+                except gevent.socket.error as e:
+                    if not e.errno == errno.ECONNRESET:
+                        logger.exception("Caught exception whilst getting feedback")
+                        # If we've already got feedback, stop here: we won't get it again
+                        if num_items == 0:
+                            raise
                     break
-                (ts, toklen) = struct.unpack("!IH", buf)
-                buf = ''
-                while len(buf) < toklen:
-                    gotdata = self.sock.recv(toklen-len(buf))
-                    if gotdata == '':
-                        connection_alive = False
-                        break
-                    buf += gotdata
-                if not connection_alive:
+                except gevent.ssl.SSLError as e:
+                    logger.exception("Caught exception whilst getting feedback")
+                    # If we've already got feedback, stop here: we won't get it again
+                    if num_items == 0:
+                        raise
                     break
-                feedback.append(FeedbackItem(buf, float(ts)))
-        except gevent.socket.error as e:
-            if not e.errno == errno.ECONNRESET:
-                logger.exception("Caught exception whilst getting feedback")
-                # If we've already got feedback, return it: we won't get it again
-                if len(feedback) == 0:
-                    raise
-        except gevent.ssl.SSLError as e:
-            logger.exception("Caught exception whilst getting feedback")
-            # If we've already got feedback, return it: we won't get it again
-            if len(feedback) == 0:
-                raise
-        # NB. we do not catch timeout errors here, ie. we consider them
-        #     to be fatal. If it's taking that long to get a response,
-        #     something is very wrong with our connection to the
-        #     feedback server so we should probaly just come back
-        #     tomorrow.
-        try:
-            self.sock.close()
-        except:
-            logger.exception("Error closing socket")
+                # NB. we do not catch timeout errors here, ie. we consider them
+                #     to be fatal. If it's taking that long to get a response,
+                #     something is very wrong with our connection to the
+                #     feedback server so we should probaly just come back
+                #     tomorrow.
+                if len(gotdata) == 0:
+                    break
+                buf.extend(gotdata)
 
-        logger.info("Returning %d feedback items", len(feedback))
-        return feedback
+                (items, offset) = parse_items(buf)
+                del buf[:offset]
+                for item in items:
+                    num_items += 1
+                    # the device has told Apple this token is no longer valid
+                    self.pushbaby._add_bad_token(item.token)
+                    yield item
+        finally:
+            try:
+                self.sock.close()
+            except:
+                logger.exception("Error closing socket")
 
     def _open_connection(self):
         logger.info("Establishing new feedback connection to %s", self.address)
@@ -97,6 +102,4 @@ class FeedbackConnection:
         # default for certfile so the app would have to explicitly
         # specify None.
         if self.certfile or self.keyfile:
-            self.sock = gevent.ssl.wrap_socket(
-                self.sock, keyfile=self.keyfile, certfile=self.certfile
-            )
+            self.sock = self.pushbaby._wrap_socket(self.sock, self.address)
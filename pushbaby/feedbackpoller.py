@@ -0,0 +1,111 @@
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gevent
+
+import logging
+import random
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class FeedbackPoller:
+    """
+    Periodically fetches feedback and passes it to the pushbaby's
+    on_feedback callback in batches, leaving out tokens we've already
+    reported. Polls are scheduled on the pushbaby's timer wheel, so
+    between them there's no greenlet waiting.
+    """
+    # How long to wait before retrying after an error, doubling each time
+    # up to the polling interval
+    MIN_RETRY_SEC = 60
+    # Maximum number of items passed to on_feedback at once
+    BATCH_SIZE = 1000
+    # How long we remember tokens for to avoid reporting them twice
+    DEDUPE_WINDOW_SEC = 7 * 24 * 60 * 60
+
+    def __init__(self, pushbaby, interval, jitter):
+        self.pushbaby = pushbaby
+        self.interval = interval
+        self.jitter = jitter
+        # token -> timestamp of the latest feedback we've reported for it
+        self.last_seen = {}
+        self.retry_delay = FeedbackPoller.MIN_RETRY_SEC
+        self.running = False
+        # the next poll on the timer wheel, or the greenlet polling now
+        self.timer = None
+        self.greenlet = None
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            self._start_poll()
+
+    def stop(self):
+        self.running = False
+        if self.timer is not None:
+            self.pushbaby.timers.cancel(self.timer)
+            self.timer = None
+        if self.greenlet is not None:
+            self.greenlet.kill()
+            self.greenlet = None
+
+    def _start_poll(self):
+        # we're on the timer wheel's greenlet, which mustn't block
+        self.timer = None
+        self.greenlet = gevent.spawn(self._run)
+
+    def _run(self):
+        try:
+            self.poll()
+            self.retry_delay = FeedbackPoller.MIN_RETRY_SEC
+            delay = self.interval
+        except:
+            logger.exception("Caught exception polling for feedback: retrying in %d seconds", self.retry_delay)
+            delay = self.retry_delay
+            self.retry_delay = min(self.retry_delay * 2, self.interval)
+        self.greenlet = None
+        if self.running:
+            delay *= 1 + random.uniform(-self.jitter, self.jitter)
+            self.timer = self.pushbaby.timers.schedule(delay, self._start_poll)
+
+    def poll(self):
+        """
+        Fetches feedback once and passes any we haven't seen before to
+        on_feedback.
+        """
+        self._forget_old()
+        batch = []
+        for item in self.pushbaby.iter_feedback():
+            if self.last_seen.get(item.token, -1) >= item.ts:
+                continue
+            self.last_seen[item.token] = item.ts
+            batch.append(item)
+            if len(batch) >= FeedbackPoller.BATCH_SIZE:
+                self._deliver(batch)
+                batch = []
+        if len(batch) > 0:
+            self._deliver(batch)
+
+    def _deliver(self, batch):
+        if self.pushbaby.on_feedback:
+            self.pushbaby.on_feedback(batch)
+
+    def _forget_old(self):
+        cutoff = time.time() - FeedbackPoller.DEDUPE_WINDOW_SEC
+        for token, ts in list(self.last_seen.items()):
+            if ts < cutoff:
+                del self.last_seen[token]
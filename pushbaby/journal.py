@@ -0,0 +1,274 @@
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gevent
+
+import json
+import logging
+import os
+import struct
+
+from pushbaby.preparedpayload import PreparedPayload
+
+
+logger = logging.getLogger(__name__)
+
+# record type, journal id and length of the body that follows
+RECORD_HEADER = struct.Struct("!BQI")
+# a push: expiration, priority, token length and identifier length,
+# followed by the token, the identifier as JSON and the payload item
+PUSH_BODY = struct.Struct("!IBHH")
+# a push has settled: its status
+SETTLED_BODY = struct.Struct("!B")
+
+RECORD_PUSH = 1
+RECORD_SETTLED = 2
+
+SEGMENT_PREFIX = 'journal.'
+
+
+class JournalledPush(object):
+    """
+    A push recovered from the journal that was never known to have settled.
+    """
+    __slots__ = ('jid', 'token', 'payload', 'expiration', 'priority', 'identifier')
+
+    def __init__(self, jid, token, payload, expiration, priority, identifier):
+        self.jid = jid
+        self.token = token
+        self.payload = payload
+        self.expiration = expiration
+        self.priority = priority
+        self.identifier = identifier
+
+
+class Journal:
+    """
+    An append-only record, on disk, of every push we've been given and how
+    each one settled, so that pushes which were queued or still in their
+    error window when the process died can be sent again when it restarts.
+
+    Records are buffered and written and fsynced in batches from a
+    background greenlet at most flush_interval seconds after they're made,
+    so sending doesn't wait for the disk. A crash can therefore lose the
+    last flush_interval's worth of records.
+
+    The journal is a directory of numbered segment files. A new segment is
+    started when the current one reaches segment_bytes, and old segments
+    are deleted once every push in them has settled.
+
+    Pushes whose fate we never find out (eg. because the process died
+    whilst they were in flight) are resent on recovery, so some of them
+    may be delivered twice.
+    """
+    def __init__(self, directory, flush_interval=0.2, segment_bytes=64 * 1024 * 1024):
+        """
+        Opens the journal in directory, creating it if it doesn't exist,
+        and reads any pushes left unsettled by a previous run (see
+        recovered()).
+        """
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.segment_bytes = segment_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.next_jid = 1
+        # jid -> number of the segment its push record is in
+        self.unsettled = {}
+        # segment number -> number of unsettled pushes in it
+        self.segment_unsettled = {}
+        self.buf = bytearray()
+        self.flush_greenlet = None
+        self.closed = False
+        self.recovered_pushes = self._read_segments()
+
+        # Never append to an old segment: it may end with a torn write
+        self.segment = max(self.segment_unsettled.keys() or [0]) + 1
+        self.segment_unsettled[self.segment] = 0
+        self.file = open(self._segment_path(self.segment), 'ab')
+        self._delete_settled_segments()
+
+    def recovered(self):
+        """
+        Returns the pushes left unsettled by the previous run as a list of
+        JournalledPush, in the order they were sent, and forgets them so
+        they're only returned once. They stay in the journal until they
+        settle, so if we die again before they do, they'll be recovered
+        again (but never more than once each).
+        """
+        pushes = self.recovered_pushes
+        self.recovered_pushes = []
+        return pushes
+
+    def record_push(self, token, payload, expiration, priority, identifier):
+        """
+        Args:
+            payload (PreparedPayload): The push's payload
+        Returns:
+            The journal id of the push, to pass to record_settled()
+        """
+        if self.closed:
+            return None
+        jid = self.next_jid
+        self.next_jid += 1
+        try:
+            ident_json = json.dumps(identifier).encode('utf8')
+        except (TypeError, ValueError):
+            # we can't keep this one: it'll be recovered as None
+            ident_json = b''
+        self.buf += RECORD_HEADER.pack(
+            RECORD_PUSH, jid, PUSH_BODY.size + len(token) + len(ident_json) + len(payload.item)
+        )
+        self.buf += PUSH_BODY.pack(int(expiration or 0), priority or 0, len(token), len(ident_json))
+        self.buf += token
+        self.buf += ident_json
+        self.buf += payload.item
+        self.unsettled[jid] = self.segment
+        self.segment_unsettled[self.segment] += 1
+        self._schedule_flush()
+        return jid
+
+    def record_settled(self, jid, status):
+        """
+        Records that a push has been delivered or has failed, so it won't be
+        resent. Does nothing if it's already settled.
+        """
+        if self.closed:
+            # anything settling now was still in flight when we closed, so
+            # leave it to be recovered
+            return
+        segment = self.unsettled.pop(jid, None)
+        if segment is None:
+            return
+        self.segment_unsettled[segment] -= 1
+        self.buf += RECORD_HEADER.pack(RECORD_SETTLED, jid, SETTLED_BODY.size)
+        self.buf += SETTLED_BODY.pack(status)
+        self._schedule_flush()
+
+    def close(self):
+        """
+        Writes out anything buffered and closes the journal. Pushes that
+        haven't settled yet stay in the journal to be recovered.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if self.flush_greenlet is not None:
+            # let it finish any write it's in the middle of
+            self.flush_greenlet.join()
+        self._flush()
+        self.file.close()
+
+    def _schedule_flush(self):
+        if self.flush_greenlet is None:
+            self.flush_greenlet = gevent.spawn(self._flush_loop)
+
+    def _flush_loop(self):
+        try:
+            while len(self.buf) > 0:
+                gevent.sleep(self.flush_interval)
+                self._flush()
+        except:
+            logger.exception("Caught exception writing journal")
+        finally:
+            self.flush_greenlet = None
+
+    def _flush(self):
+        if len(self.buf) == 0:
+            return
+        buf = self.buf
+        self.buf = bytearray()
+        # fsync in a thread so we don't block every other greenlet on the disk
+        gevent.get_hub().threadpool.apply(self._write, (buf,))
+        if self.file.tell() >= self.segment_bytes:
+            self.file.close()
+            self.segment += 1
+            self.segment_unsettled[self.segment] = 0
+            self.file = open(self._segment_path(self.segment), 'ab')
+        self._delete_settled_segments()
+
+    def _write(self, buf):
+        self.file.write(buf)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def _delete_settled_segments(self):
+        # Only delete from the oldest segment onwards: a newer segment may
+        # hold the records that older pushes have settled
+        for segment in sorted(self.segment_unsettled.keys()):
+            if self.segment_unsettled[segment] > 0 or segment == self.segment:
+                break
+            logger.debug("Deleting journal segment %d: all settled", segment)
+            del self.segment_unsettled[segment]
+            try:
+                os.unlink(self._segment_path(segment))
+            except OSError:
+                logger.exception("Couldn't delete journal segment %d", segment)
+
+    def _segment_path(self, segment):
+        return os.path.join(self.directory, "%s%08d" % (SEGMENT_PREFIX, segment))
+
+    def _read_segments(self):
+        segments = sorted(
+            int(f[len(SEGMENT_PREFIX):]) for f in os.listdir(self.directory)
+            if f.startswith(SEGMENT_PREFIX) and f[len(SEGMENT_PREFIX):].isdigit()
+        )
+        # jid -> JournalledPush, for pushes not settled yet
+        pushes = {}
+        for segment in segments:
+            self.segment_unsettled[segment] = 0
+            with open(self._segment_path(segment), 'rb') as f:
+                data = f.read()
+            for rtype, jid, body in _iter_records(data):
+                self.next_jid = max(self.next_jid, jid + 1)
+                if rtype == RECORD_PUSH:
+                    if jid in self.unsettled:
+                        # we've seen this one already
+                        continue
+                    pushes[jid] = _parse_push(jid, body)
+                    self.unsettled[jid] = segment
+                    self.segment_unsettled[segment] += 1
+                elif rtype == RECORD_SETTLED and jid in self.unsettled:
+                    self.segment_unsettled[self.unsettled.pop(jid)] -= 1
+                    del pushes[jid]
+
+        if len(pushes) > 0:
+            logger.info("Recovered %d unsettled pushes from journal", len(pushes))
+        return [pushes[jid] for jid in sorted(pushes.keys())]
+
+
+def _iter_records(data):
+    offset = 0
+    while offset + RECORD_HEADER.size <= len(data):
+        (rtype, jid, length) = RECORD_HEADER.unpack_from(data, offset)
+        offset += RECORD_HEADER.size
+        if offset + length > len(data):
+            logger.warning("Journal segment ends with a partial record: ignoring it")
+            return
+        yield rtype, jid, data[offset:offset + length]
+        offset += length
+
+
+def _parse_push(jid, body):
+    (expiration, priority, token_len, ident_len) = PUSH_BODY.unpack_from(body, 0)
+    offset = PUSH_BODY.size
+    token = body[offset:offset + token_len]
+    offset += token_len
+    ident_json = body[offset:offset + ident_len]
+    offset += ident_len
+    identifier = json.loads(ident_json.decode('utf8')) if ident_len > 0 else None
+    return JournalledPush(
+        jid, token, PreparedPayload.from_item(body[offset:]),
+        expiration or None, priority or None, identifier
+    )
@@ -0,0 +1,99 @@
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+
+
+class MetricsSink:
+    """
+    Receives metrics from a PushBaby. This one discards them: subclass it
+    and pass an instance as PushBaby's 'metrics' argument to export them to
+    Prometheus, StatsD etc.
+
+    Counters (passed to increment()):
+        pushes_sent: Pushes written to the network
+        pushes_failed: Pushes the gateway rejected, labelled with 'status'
+        pushes_resent: Pushes being sent again after an error
+        pushes_unacked: Pushes lost when a connection dropped that the
+                        gateway never acknowledged (and so will be resent)
+        pushes_truncated: Payloads that had to be truncated to fit
+        pushes_expired: Pushes dropped because they expired whilst queued
+        connections_opened
+        connections_retired: Connections we stopped sending new pushes on
+        connections_closed
+        connections_reclaimed: Connections a PushHub drained so another app
+                        could have its place in the connection budget
+
+    Distributions (passed to observe()):
+        encode_seconds: Time to truncate and JSON encode a payload
+        enqueue_to_write_seconds: Time from a push being queued to being written
+        handshake_seconds: Time to connect to the gateway, including TLS
+        in_flight: Number of pushes a connection is waiting to hear about,
+                   after each write
+        rate_limit_wait_seconds: Time a write was held back by max_rate or
+                   max_rate_per_connection
+
+    Methods are called on the sending greenlets (or, for AsyncPushBaby,
+    the event loop) so must not block.
+    """
+    def increment(self, name, value=1, labels=None):
+        pass
+
+    def observe(self, name, value, labels=None):
+        pass
+
+
+class MemoryMetricsSink(MetricsSink):
+    """
+    Keeps all metrics in memory: useful for tests and benchmarks. Every
+    observation is kept so this is not suitable for long running processes.
+    Labels are folded into the name, eg. 'pushes_failed{status=8}'.
+    """
+    def __init__(self):
+        self.counters = collections.defaultdict(int)
+        self.observations = collections.defaultdict(list)
+
+    def increment(self, name, value=1, labels=None):
+        self.counters[_labelled(name, labels)] += value
+
+    def observe(self, name, value, labels=None):
+        self.observations[_labelled(name, labels)].append(value)
+
+
+class LabelledMetricsSink(MetricsSink):
+    """
+    Adds labels to every metric before passing it on to another sink, eg.
+    to tell apart the PushBabies of a PushHub.
+    """
+    def __init__(self, sink, labels):
+        self.sink = sink
+        self.labels = labels
+
+    def increment(self, name, value=1, labels=None):
+        self.sink.increment(name, value, self._merge(labels))
+
+    def observe(self, name, value, labels=None):
+        self.sink.observe(name, value, self._merge(labels))
+
+    def _merge(self, labels):
+        merged = dict(self.labels)
+        if labels:
+            merged.update(labels)
+        return merged
+
+
+def _labelled(name, labels):
+    if not labels:
+        return name
+    return "%s{%s}" % (name, ",".join("%s=%s" % (k, labels[k]) for k in sorted(labels)))
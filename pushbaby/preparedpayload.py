@@ -0,0 +1,63 @@
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import struct
+
+from .truncate import truncate_and_encode
+
+# The payload item's header: item id (2) and length
+ITEM_PAYLOAD = 2
+ITEM_PAYLOAD_HEADER = struct.Struct("!BH")
+
+
+class PreparedPayload(object):
+    """
+    A payload that has been truncated and encoded, ready to be sent.
+    Pass one of these to PushBaby.send() (or send_many() etc.) in place of
+    the payload dictionary to send the same payload to many devices
+    without encoding it again for each one.
+    """
+    __slots__ = ('item', 'truncated')
+
+    def __init__(self, payload, max_length=2048):
+        """
+        Args:
+            payload (dict): The dictionary payload of the push
+            max_length (int): The length to truncate the encoded payload to
+        Throws:
+            BodyTooLongException: If the payload body is too long and cannot be truncated to fit
+        """
+        # We don't keep the payload dictionary: the encoded item is all we
+        # need to send (and resend) it
+        _, payload_str, truncated = truncate_and_encode(payload, max_length)
+        object.__setattr__(self, 'truncated', truncated)
+        # the whole payload item, header and all, as it goes in the frame
+        object.__setattr__(
+            self, 'item', ITEM_PAYLOAD_HEADER.pack(ITEM_PAYLOAD, len(payload_str)) + payload_str
+        )
+
+    @classmethod
+    def from_item(cls, item):
+        """
+        Returns a PreparedPayload for an already encoded payload item, as
+        found in the 'item' attribute of another.
+        """
+        prepared = object.__new__(cls)
+        object.__setattr__(prepared, 'truncated', False)
+        object.__setattr__(prepared, 'item', item)
+        return prepared
+
+    def __setattr__(self, name, value):
+        raise AttributeError("PreparedPayload is immutable")
+
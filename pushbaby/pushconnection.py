@@ -19,204 +19,299 @@ import gevent.event
 import gevent.queue
 
 import logging
-import struct
 import time
 import sys
 import errno
-import base64
 
-from pushbaby.truncate import truncate
-from pushbaby.aps import json_for_payload
-import pushbaby.errors
+from pushbaby.truncate import BodyTooLongException
+from pushbaby.sendscheduler import SendScheduler
+from pushbaby.pushprotocol import PushProtocol, ERROR_RESPONSE, _batch_priority
+from pushbaby.pushprotocol import ConnectionDeadException, PushExpiredException
+from pushbaby import tcpinfo
 
 
 logger = logging.getLogger(__name__)
 
 
-class PushConnection:
-    COMMAND_SENDPUSH = 2
-    COMMAND_ERROR = 8
-
-    ITEM_DEVICE_TOKEN = 1
-    ITEM_PAYLOAD = 2
-    ITEM_IDENTIFIER = 3
-    ITEM_EXPIRATION = 4
-    ITEM_PRIORITY = 5
-
-    MAX_ERROR_WAIT_SEC = 60
-    MAX_PUSHES_PER_CONNECTION = 2**31
-    MAX_CONN_IDLE_SEC = 30
-    CONN_TIMEOUT = 10
-
-    class SentMessage:
-        def __init__(self, sendts, token, payload, expiration, priority, identifier):
-            self.sendts = sendts
-            self.token = token
-
-            self.payload = payload
-            self.expiration = expiration
-            self.priority = priority
-            self.identifier = identifier
-
-    def __init__(self, pushbaby, address, certfile, keyfile):
-        self.pushbaby = pushbaby
+class PushConnection(PushProtocol):
+    """
+    A connection to the push gateway that does its I/O with gevent. Pushes
+    are queued and written by one greenlet while another reads errors.
+    """
+    def __init__(self, pushbaby, address, certfile, keyfile, max_queue_size=None, max_in_flight=None,
+                 priority_weights=None, max_rate=None):
+        PushProtocol.__init__(self, pushbaby, max_in_flight=max_in_flight, max_rate=max_rate)
         self.address = address
         self.certfile = certfile
         self.keyfile = keyfile
-        self.seq = -1
         self.sock = None
-        self.alive = True
-        self.useable = True
-        self.send_queue = gevent.queue.Queue()
-        self.sent = {}
-        self.last_push_sent = None
-        self.last_failed_seq = None
+        # Bounded if max_queue_size is given, so senders block rather than
+        # queuing up pushes faster than we can write them
+        self.send_queue = SendScheduler(maxsize=max_queue_size, weights=priority_weights)
         self.open_event = None
+        self.closed_event = gevent.event.Event()
+        # set once we're near MAX_PUSHES_PER_CONNECTION and have asked for
+        # a replacement
+        self.renewing = False
+        # whether we can find out from the kernel which pushes the gateway
+        # has received, so we know what to resend if the connection drops
+        self.track_acks = tcpinfo.TIOCOUTQ is not None
+        # how long a write can block before we give up on the connection,
+        # where TCP_USER_TIMEOUT can't do that for us
+        self.write_timeout = None
 
     def _open_connection(self):
         logger.info("Establishing new connection to %s", self.address)
+        start = time.time()
         mysock = gevent.socket.create_connection(self.address)
         mysock.settimeout(10.0)
-        # attempt to set the TCP_USER_TIMEOUT sockopt (will only work on Linux)
-        # (from /usr/include/linux/tcp.h: #define TCP_USER_TIMEOUT 18)
-        # Without this, connections will take 15 minutes or much, much longer to
-        # time out if the connection drops which is nonideal since we'll be sending
-        # push into the void during that time
-        try:
-            mysock.setsockopt(gevent.socket.IPPROTO_TCP, 18, PushConnection.CONN_TIMEOUT * 1000)
-        except gevent.socket.error:
-            logger.warn(
-                "Couldn't set socket timeout (only works on Linux >= 2.6.37). " +
-                "Unresponsive connections will take a long time to timeout and " +
-                "pushes during that time will be lost."
-            )
+        self._set_keepalive(mysock)
+        if not self._set_user_timeout(mysock):
+            self.write_timeout = PushConnection.CONN_TIMEOUT
         # We use a non-ssled connection if both certfile and keyfile
         # are None. This is useful only for testing. None is not the
         # default for certfile so the app would have to explicitly
         # specify None.
         if self.certfile or self.keyfile:
-            self.sock = gevent.ssl.wrap_socket(
-                mysock, keyfile=self.keyfile, certfile=self.certfile
-            )
+            self.sock = self.pushbaby._wrap_socket(mysock, self.address)
         else:
             self.sock = mysock
+        self.pushbaby.metrics.observe('handshake_seconds', time.time() - start)
+        self.pushbaby.metrics.increment('connections_opened')
+        # The timeout is just for connecting: the reader blocks until there's
+        # something to read and the timer wheel handles idle connections.
+        # Writes to a dead connection will still fail after CONN_TIMEOUT
+        # because of TCP_USER_TIMEOUT or, without it, write_timeout, and
+        # keepalives wake the reader if the peer goes away whilst we're idle.
+        self.sock.settimeout(None)
+        self.opened_at = time.time()
+        self._schedule_lifecycle(PushConnection.MAX_CONN_IDLE_SEC)
         gevent.spawn(self._read_loop)
         gevent.spawn(self._write_loop)
 
+    def _frame_end_offsets(self, pushes, start_offset, end_offset):
+        """
+        Works out where in the TCP stream each push of a write ends, as far
+        as we can without knowing how TLS split the write into records. TLS
+        only ever adds bytes, so the start of the write plus the length of
+        the frames up to and including a push is never past where that push
+        really ends: if the connection drops before then, the gateway never
+        got all of it. The last push ends where the write does.
+        Args:
+            pushes (list): The pushes written, in order
+            start_offset (int): Where the write started in the stream
+            end_offset (int): Where the write ended in the stream
+        Returns:
+            A list of the offset for each push
+        """
+        offsets = []
+        offset = start_offset
+        for push in pushes[:-1]:
+            offset += self._frame_length(
+                push['token'], push['payload'], push['expiration'], push['priority']
+            )
+            offsets.append(offset)
+        offsets.append(end_offset)
+        return offsets
+
     def _close_connection(self):
+        was_useable = self.alive and self.useable
+        if self.alive:
+            self.pushbaby.metrics.increment('connections_closed')
         self.alive = False
         self.useable = False
-        try:
-            self.sock.close()
-        except:
-            logger.exception("Caught exception closing socket")
+        if self.lifecycle_timer is not None:
+            self.pushbaby.timers.cancel(self.lifecycle_timer)
+            self.lifecycle_timer = None
+        # it's never opened if it was drained or reclaimed before its first push
+        if self.sock is not None:
+            try:
+                # now it's received any session ticket the gateway sent
+                self.pushbaby._save_tls_session(self.sock, self.address)
+                self.sock.close()
+            except:
+                logger.exception("Caught exception closing socket")
+        self._fail_in_flight()
+        self.closed_event.set()
+        # the writer runs what's left, which fails, then finishes
+        self.send_queue.close()
+        self.pushbaby._release_slot(self)
+        # a drained connection was given up on purpose (eg. reclaimed by the
+        # hub for another app), so don't open another in its place
+        if was_useable and not self.draining:
+            self.pushbaby._replenish()
 
     def _retire_connection(self):
+        was_useable = self.useable
+        if self.useable:
+            self.pushbaby.metrics.increment('connections_retired')
         self.useable = False
         self.retired_at = time.time()
+        if was_useable and not self.draining:
+            self.pushbaby._replenish()
+
+    def _schedule_lifecycle(self, delay):
+        if self.lifecycle_timer is not None:
+            self.pushbaby.timers.cancel(self.lifecycle_timer)
+        self.lifecycle_timer = self.pushbaby.timers.schedule(delay, self._lifecycle)
+
+    def _keep_open(self):
+        return self.pushbaby._is_warm(self)
+
+    def _resend_later(self, sms):
+        # from another greenlet so we're not blocking this one whilst we do
+        gevent.spawn(self.pushbaby._resend, sms)
+
+    def _write_deadline(self):
+        # a Timeout of None never fires
+        return gevent.timeout.Timeout(
+            self.write_timeout, gevent.socket.timeout("Timed out writing to the gateway")
+        )
 
     def _read_loop(self):
         # This is a little lazy since there is only one command, so
         # we know we'll always have to read exactly 5 bytes after the command
         while self.alive:
-            buf = ''
-            while len(buf) < 6 and self.alive:
-                self.prune_sent()
-
+            buf = b''
+            while len(buf) < ERROR_RESPONSE.size and self.alive:
                 try:
-                    thisbuf = self.sock.recv(6 - len(buf))
-                    if thisbuf == '':
+                    thisbuf = self.sock.recv(ERROR_RESPONSE.size - len(buf))
+                    if len(thisbuf) == 0:
                         logger.info("Connection closed remotely")
-                        self._close_connection()
+                        if self.useable:
+                            # not because of an error we were sent
+                            self._rate_backoff()
+                        self._connection_lost()
                         continue
                     buf += thisbuf
                 except gevent.ssl.SSLError as e:
-                    if e == gevent.ssl._SSLErrorReadTimeout:
-                        pass
-                    else:
-                        # Note that we do not attempt to do any resending if the
-                        # connection drops, even through we could have lost pushes.
-                        # The problem is that we don't really have any way of knowing
-                        # what to resend so we could end up generating lots of dupes.
-                        # One way may be to use TIOCOUTQ to see how much data the
-                        # other side hasn't ACKed.
-                        logger.exception("Caught exception reading from socket: closing")
-                        self._close_connection()
+                    if not self.alive:
+                        # we closed the socket ourselves
                         continue
+                    logger.exception("Caught exception reading from socket: closing")
+                    self._connection_lost()
+                    continue
                 except gevent.socket.error as e:
+                    if not self.alive:
+                        continue
                     if e.errno == errno.ECONNRESET:
                         logger.info("Connection closed remotely")
+                        if self.useable:
+                            self._rate_backoff()
                     else:
                         logger.exception("Caught exception reading from socket: closing")
-                    self._close_connection()
+                    self._connection_lost()
                     continue
                 except:
+                    if not self.alive:
+                        continue
                     logger.exception("Caught exception reading from socket: closing")
-                    self._close_connection()
+                    self._connection_lost()
                     continue
 
-                if self.last_push_sent:
-                    secs_since_last_used = time.time() - self.last_push_sent
-                    if self.useable and secs_since_last_used > PushConnection.MAX_CONN_IDLE_SEC:
-                        logger.info("Connection unused for %f seconds: retiring", secs_since_last_used)
-                        self._retire_connection()
-                    if not self.useable and secs_since_last_used > PushConnection.MAX_ERROR_WAIT_SEC:
-                        # we've waited for as long as we want to for errors, and we're not going to
-                        # send anything else, so our work here is done.
-                        logger.info("Connection retired and last used %f seconds ago: closing", secs_since_last_used)
-                        self._close_connection()
-
             if self.alive:
-                (command, status, seq) = struct.unpack("!BBI", buf)
-                if command != PushConnection.COMMAND_ERROR:
-                    # if we get a command we don't recognise, we must close the connection.
-                    # There's no framing so we can't just skip past anything unknown
-                    # because we'd have no idea how much to skip.
-                    logger.error("Recieved unknown command %d: closing connection", command)
-                    self._close_connection()
+                self._handle_error_response(buf)
 
-                self._push_failed(status, seq)
-                # we now expect the connection to be closed from the other end
+    def _connection_lost(self):
+        """
+        Closes a connection that has dropped. Pushes in flight on it may or
+        may not have reached the gateway: if the kernel can tell us how much
+        of what we wrote the gateway acknowledged, we resend the pushes after
+        that, which it certainly never got. We can't know what happened to
+        the rest (or to any of them, if the kernel can't tell us) so they
+        fail as usual.
+        """
+        lost = []
+        if self.alive and self.track_acks and len(self.sent) > 0:
+            acked = tcpinfo.bytes_acked(self.sock)
+            if acked is not None:
+                lost = self.sent.pop_newest(lambda sm: sm.end_offset is not None and sm.end_offset > acked)
+        self._close_connection()
+        if len(lost) > 0:
+            logger.info("Resending %d pushes the gateway never acknowledged", len(lost))
+            self.pushbaby.metrics.increment('pushes_unacked', len(lost))
+            self._resend_later(lost)
 
     def _write_loop(self):
-        # we keep running while there are things in the queue because
-        # we can't quite and leave things in the queue or they'll end
-        # up blocked forever
-        while self.alive or not self.send_queue.empty():
+        # we keep running until the queue is closed and empty because
+        # we can't quit and leave things in the queue or they'll end
+        # up blocked forever: once the connection's closed, what's left
+        # fails and is retried elsewhere
+        while True:
             try:
-                job = self.send_queue.get(block=True, timeout=10.0)
-                job()
+                job = self.send_queue.get(block=True)
             except gevent.queue.Empty:
-                continue
+                return
+            job()
 
-    def _push_failed(self, status, seq):
-        self.last_failed_seq = seq
-        self.prune_sent()
+    def drain(self):
+        """
+        Stops taking new pushes and closes the connection once all the
+        pushes already queued have been written and the gateway has
+        processed them. Wait on closed_event to find out when that is.
+        """
+        if self.draining or not self.alive:
+            return
+        self.draining = True
+        if not self.sock:
+            # never opened so nothing to wait for
+            self._close_connection()
+            return
+        # This goes after any pushes waiting to be written, in every lane
+        self.send_queue.put_last(self._send_probe)
 
-        # A push connection is no longer useable once we've had an error down
-        # so retire it
+    def _send_probe(self):
+        """
+        Sends the probe (see _pack_probe()) once everything queued has been
+        written.
+        """
         self._retire_connection()
+        if not self.alive:
+            return
+        if len(self.sent) == 0:
+            self._close_connection()
+            return
 
-        if seq in self.sent:
-            failed = self.sent[seq]
-            if status == pushbaby.errors.SHUTDOWN:
-                # we'll retry this one automatically
-                logger.info("Push failed with SHUTDOWN status: retying")
-                self.pushbaby.send(failed.payload, failed.token, failed.priority, failed.expiration, failed.identifier)
-            else:
-                logger.warn("Push to token %s failed with status %d", base64.b64encode(failed.token), status)
-                if self.pushbaby.on_push_failed:
-                    self.pushbaby.on_push_failed(failed.token, failed.identifier, status)
-
-            # Any pushes after a failed one are not processed and need to be resent
-            # we've already pruned out the ones before so if we remove the failed one,
-            # we resend all the remaining ones
-            del self.sent[seq]
-            logger.info("Retrying %d pushes sent after failed push", len(self.sent))
-            for sm in self.sent.values():
-                self.pushbaby.send(sm.payload, sm.token, sm.priority, sm.expiration, sm.identifier)
-        else:
-            logger.error("Got a failure for seq %d that we don't remember!", seq)
+        try:
+            with self._write_deadline():
+                self.sock.sendall(self._pack_probe())
+        except:
+            logger.exception("Caught exception sending probe: closing")
+            self._close_connection()
+
+    def open(self):
+        """
+        Opens the connection now rather than when the first push is sent.
+        Does nothing if it's already open.
+        """
+        self._ensure_open()
+
+    def is_open(self):
+        return self.alive and self.sock is not None
+
+    def is_fresh(self):
+        """
+        Returns True if this connection can take pushes and isn't about to
+        be retired for running out of seqs.
+        """
+        return (
+            self.alive and self.useable and not self.draining and
+            self.seq < PushConnection.MAX_PUSHES_PER_CONNECTION - PushConnection.RENEW_SEQ_MARGIN
+        )
+
+    def queue_depth(self):
+        """
+        Returns the number of pushes waiting to be written to the socket.
+        """
+        return self.send_queue.qsize()
+
+    def load(self):
+        """
+        Returns a measure of how busy this connection is: the number of pushes
+        waiting to be written plus the number we're still waiting to see if
+        errors occur for.
+        """
+        return self.send_queue.qsize() + len(self.sent)
 
     def messages_in_flight(self):
         """
@@ -228,10 +323,89 @@ class PushConnection:
             return True
         return False
 
-    def send(self, payload, token, expiration=None, priority=None, identifier=None):
+    def send(self, payload, token, expiration=None, priority=None, identifier=None, jid=None):
+        # Encode in the calling greenlet so a payload that can't be truncated
+        # to fit is reported to the caller rather than killing the connection
+        push = self._push(self.pushbaby._prepare(payload), token, expiration, priority, identifier, jid=jid)
+        self._ensure_open()
+        return self._run_job(lambda: self._reallysend_many([push]), priority)
+
+    def send_async(self, payload, token, expiration=None, priority=None, identifier=None, result=None,
+                   jid=None):
+        """
+        Queues a push to be sent and returns without waiting for it to be
+        written. Blocks only if the send queue is full.
+        Returns:
+            An AsyncResult that is set to the push's status (see
+            pushbaby.errors) once we know whether it was delivered, which is
+            NO_ERROR if it was accepted. Pushes that are retried keep the same
+            AsyncResult. If the connection dies before we know, the
+            AsyncResult is set to ConnectionDeadException.
+        """
+        if result is None:
+            result = gevent.event.AsyncResult()
+        push = self._push(self.pushbaby._prepare(payload), token, expiration, priority, identifier, result, jid)
+        self._ensure_open()
+
+        def sendpush():
+            try:
+                self._reallysend_many([push])
+            except:
+                logger.exception("Caught exception sending push")
+                result.set_exception(ConnectionDeadException())
+                self.pushbaby._abandon(jid)
+        self.send_queue.put(sendpush, priority)
+        return result
+
+    def resend_many(self, sms):
+        """
+        Sends SentMessages from another connection again, in order, writing
+        them all in one go. The AsyncResults of any sent with send_async
+        carry over.
+        """
+        pushes = [
+            self._push(sm.payload, sm.token, sm.expiration, sm.priority, sm.identifier, sm.result, sm.jid)
+            for sm in sms
+        ]
+        self._ensure_open()
+        self._run_job(lambda: self._reallysend_many(pushes), _batch_priority(pushes))
+
+    def send_many(self, pushes):
+        """
+        Sends a batch of pushes, writing all of their frames to the socket
+        in one go.
+        Args:
+            pushes: list of dicts, each with the keyword arguments to send()
+                    ('payload', 'token' and optionally 'expiration',
+                    'priority', 'identifier' and 'jid')
+        Returns:
+            A list with an entry for each push: None if it was sent or the
+            exception (ie. BodyTooLongException) if it could not be.
+        """
+        results = []
+        prepared = []
+        for push in pushes:
+            try:
+                payload = self.pushbaby._prepare(push['payload'])
+            except BodyTooLongException as e:
+                results.append(e)
+                continue
+            results.append(None)
+            prepared.append(self._push(
+                payload, push['token'],
+                push.get('expiration'), push.get('priority'), push.get('identifier'),
+                jid=push.get('jid')
+            ))
+
+        if len(prepared) > 0:
+            self._ensure_open()
+            self._run_job(lambda: self._reallysend_many(prepared), _batch_priority(prepared))
+        return results
+
+    def _ensure_open(self):
         if not self.alive:
             raise ConnectionDeadException()
-        if not self.useable:
+        if not self.useable or self.draining:
             raise ConnectionDeadException()
         if not self.sock:
             # We'll yield back to the hub whilst the connection is
@@ -241,9 +415,11 @@ class PushConnection:
             if self.open_event is None:
                 self.open_event = gevent.event.Event()
                 try:
+                    self.pushbaby._acquire_slot(self)
                     self._open_connection()
                 except:
                     logger.exception("Caught exception opening connection")
+                    self.pushbaby._release_slot(self)
                     self.alive = False
                     self.useable = False
                     # Don't raise ConnectionDeadException here: this is reserved
@@ -257,96 +433,79 @@ class PushConnection:
                 if not self.sock:
                     raise ConnectionDeadException()
 
+    def _run_job(self, job, priority=None):
+        """
+        Runs job on the writer greenlet, in the lane for priority, and waits
+        for it to finish.
+        """
         sent_event = gevent.event.Event()
         res = {}
 
-        def sendpush():
+        def runjob():
             try:
-                res['ret'] = self._reallysend(payload, token, expiration, priority, identifier)
+                res['ret'] = job()
             except:
                 logger.exception("Caught exception sending push")
                 res['ex'] = sys.exc_info()[1]
             sent_event.set()
-        self.send_queue.put(sendpush)
+        self.send_queue.put(runjob, priority)
         sent_event.wait()
         if 'ex' in res:
             raise ConnectionDeadException()
         else:
             return res['ret']
 
-    def _reallysend(self, payload, token, expiration=None, priority=None, identifier=None):
+    def _reallysend_many(self, pushes):
         """
         Args:
-            payload (dict): The payload dictionary of the push to send
-            descriptor (any): Opaque variable that is passed back to the pushbaby on failure
+            pushes (list): dicts of the arguments for each push, as from _push()
         """
-
         if not self.alive:
             raise ConnectionDeadException()
         if not self.useable:
             raise ConnectionDeadException()
-        seq = self._nextSeq()
-        if seq >= PushConnection.MAX_PUSHES_PER_CONNECTION:
-            # IDs are 4 byte so rather than worry about wrapping IDs, just make a new connection
-            # Note we don't close the connection because we want to wait to see if any errors arrive
-            self._retire_connection()
-
-        payload_str = json_for_payload(truncate(payload))
-        items = ''
-        items += self._apns_item(PushConnection.ITEM_DEVICE_TOKEN, token)
-        items += self._apns_item(PushConnection.ITEM_PAYLOAD, payload_str)
-        items += self._apns_item(PushConnection.ITEM_IDENTIFIER, seq)
-        if expiration:
-            items += self._apns_item(PushConnection.ITEM_EXPIRATION, expiration)
-        if priority:
-            items += self._apns_item(PushConnection.ITEM_PRIORITY, priority)
-
-        apnsFrame = struct.pack("!BI", PushConnection.COMMAND_SENDPUSH, len(items)) + items
+
+        wait = self._rate_wait(len(pushes))
+        if wait > 0:
+            gevent.sleep(wait)
+            if not self.alive or not self.useable:
+                raise ConnectionDeadException()
+
+        pushes = self._drop_expired(pushes)
+        if len(pushes) == 0:
+            return
+
+        (seqs, apnsFrames) = self._pack_pushes(pushes)
+        if (
+            self.useable and not self.renewing and
+            self.seq >= PushConnection.MAX_PUSHES_PER_CONNECTION - PushConnection.RENEW_SEQ_MARGIN
+        ):
+            # open the replacement now so it's ready when we retire
+            self.renewing = True
+            self.pushbaby._replenish()
+
+        start_offset = None
+        if self.track_acks:
+            start_offset = tcpinfo.stream_offset(self.sock)
 
         try:
+            # write from a memoryview so partial writes don't copy the rest of the buffer
+            view = memoryview(apnsFrames)
             written = 0
-            while written < len(apnsFrame):
-                written += self.sock.send(apnsFrame[written:])
+            with self._write_deadline():
+                while written < len(apnsFrames):
+                    written += self.sock.send(view[written:])
         except:
             logger.exception("Caught exception sending push")
             raise
-        self.sent[seq] = PushConnection.SentMessage(
-            time.time(), token, payload, expiration, priority, identifier
-        )
-        self.last_push_sent = time.time()
-
-    def _apns_item(self, item_id, data):
-        if item_id == PushConnection.ITEM_IDENTIFIER:
-            # identifier (4 bytes)
-            # strictly speaking this is just bytes do we could just
-            # send it in host byte order but we may as well keep
-            # everything in network byte order
-            data = struct.pack("!I", data)
-        elif item_id == PushConnection.ITEM_EXPIRATION:
-            # expiration date (4 bytes)
-            data = struct.pack("!I", long(data))
-        elif item_id == PushConnection.ITEM_PRIORITY:
-            # priority (1 byte)
-            data = struct.pack("!B", data)
-        # anything else is raw data and we don't need to pack
-
-        return struct.pack("!BH", item_id, len(data)) + data
-
-    def _nextSeq(self):
-        self.seq += 1
-        return self.seq
-
-    def prune_sent(self):
-        for seq, m in self.sent.items():
-            # We say it's safe to assume that anything we sent more than this
-            # long ago would have failed by now if it was going to fail
-            if m.sendts < time.time() - PushConnection.MAX_ERROR_WAIT_SEC:
-                del self.sent[seq]
-            # If we know a push has failed, we can deduce that all previous
-            # pushes succeeded
-            if self.last_failed_seq and seq < self.last_failed_seq:
-                del self.sent[seq]
-
-
-class ConnectionDeadException(Exception):
-    pass
+
+        end_offsets = None
+        if self.track_acks:
+            end_offset = tcpinfo.stream_offset(self.sock)
+            if start_offset is None or end_offset is None:
+                logger.info("Can't get acknowledged bytes from the kernel: not tracking them")
+                self.track_acks = False
+            else:
+                end_offsets = self._frame_end_offsets(pushes, start_offset, end_offset)
+
+        self._record_sent(seqs, pushes, self.pushbaby.journal, end_offsets)
@@ -0,0 +1,202 @@
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gevent
+import gevent.lock
+
+import collections
+import logging
+
+# only used once the package has finished importing, to avoid a cycle
+import pushbaby
+from pushbaby.metrics import MetricsSink, LabelledMetricsSink
+from pushbaby.timerwheel import TimerWheel
+
+
+logger = logging.getLogger(__name__)
+
+
+class PushHub:
+    """
+    Sends pushes for many apps, each with its own certificate, sharing
+    what they can between them: one timer wheel for all their connections
+    and feedback pollers, and one budget of connections to the gateway.
+
+    Each app gets a PushBaby, so everything it can do works per app. An
+    app only opens connections when there's something to send for it, and
+    they close again once it's idle, so apps with no traffic cost no
+    connections, greenlets or timers.
+
+    When every connection in the budget is open, an app that needs one
+    takes it from another: the app with the most connections gives up its
+    least busy one, which is drained and closed (see PushBaby.drain()).
+    That's only if it would still have more connections than the app
+    taking one, so no app loses its last connection and two busy apps
+    don't keep taking one back and forth. Otherwise the app waits for a
+    connection to close once it's idle. Apps waiting for a connection get
+    one in the order they asked. An app that already has a connection
+    doesn't open more while the budget is used up: it makes do with the
+    ones it has.
+
+        hub = PushHub(max_connections=50)
+        pb = hub.add_app('com.example.app', certfile='app.pem')
+        pb.on_push_failed = on_push_failed
+        hub.send('com.example.app', payload, token)
+    """
+    # How long to wait for a connection to free up before giving up on a push
+    SLOT_WAIT_SEC = 10
+
+    def __init__(self, max_connections=100, metrics=None):
+        """
+        Args:
+            max_connections: Maximum number of connections to the gateway
+                      open at once, for all apps together.
+            metrics: A MetricsSink to report counters and timings to. Those
+                      from each app are labelled with 'app'.
+        """
+        if max_connections < 1:
+            raise ValueError("Need at least one connection")
+        self.max_connections = max_connections
+        self.metrics = metrics if metrics is not None else MetricsSink()
+        self.timers = TimerWheel()
+        # app id -> PushBaby
+        self.apps = {}
+        self.slots = gevent.lock.Semaphore(max_connections)
+        # connections holding one of the slots
+        self.slotted = set()
+
+    def add_app(self, app_id, certfile, keyfile=None, **kwargs):
+        """
+        Adds an app to send pushes for.
+        Args:
+            app_id: Any hashable to refer to the app by, eg. its bundle ID
+            certfile, keyfile and kwargs: As for PushBaby
+        Returns:
+            The app's PushBaby, eg. to set on_push_failed on
+        """
+        if app_id in self.apps:
+            raise ValueError("App %r already added" % (app_id,))
+        if 'metrics' not in kwargs:
+            kwargs['metrics'] = LabelledMetricsSink(self.metrics, {'app': app_id})
+        pb = pushbaby.PushBaby(certfile, keyfile=keyfile, hub=self, **kwargs)
+        self.apps[app_id] = pb
+        return pb
+
+    def remove_app(self, app_id, timeout=None):
+        """
+        Stops sending pushes for an app, draining its connections (see
+        PushBaby.drain()).
+        Returns:
+            True if every push was written and processed, False if we gave
+            up waiting or on any push.
+        """
+        return self.apps.pop(app_id).drain(timeout=timeout)
+
+    def get_app(self, app_id):
+        """
+        Returns the PushBaby for app_id. Throws KeyError if there isn't one.
+        """
+        return self.apps[app_id]
+
+    def send(self, app_id, payload, token, **kwargs):
+        """
+        Sends a push for app_id: see PushBaby.send().
+        """
+        return self.apps[app_id].send(payload, token, **kwargs)
+
+    def send_async(self, app_id, payload, token, **kwargs):
+        """
+        Queues a push for app_id: see PushBaby.send_async().
+        """
+        return self.apps[app_id].send_async(payload, token, **kwargs)
+
+    def send_many(self, app_id, pushes):
+        """
+        Sends many pushes for app_id: see PushBaby.send_many().
+        """
+        return self.apps[app_id].send_many(pushes)
+
+    def messages_in_flight(self):
+        return any(pb.messages_in_flight() for pb in self.apps.values())
+
+    def open_connections(self):
+        """
+        Returns the number of connections open or opening, for all apps.
+        """
+        return len(self.slotted)
+
+    def drain(self, timeout=None):
+        """
+        Drains every app at once (see PushBaby.drain()).
+        Returns:
+            True if every push was written and processed, False if we gave
+            up waiting or on any push.
+        """
+        drains = [gevent.spawn(pb.drain, timeout) for pb in self.apps.values()]
+        gevent.joinall(drains)
+        return all(g.value for g in drains)
+
+    def close(self):
+        for pb in self.apps.values():
+            pb.close()
+
+    def _has_room(self):
+        return not self.slots.locked()
+
+    def _acquire_slot(self, conn):
+        """
+        Blocks until conn can open, taking a connection from another app if
+        the budget is used up.
+        Throws:
+            ConnectionBudgetException: If none frees up in time
+        """
+        if self.slots.locked():
+            self._reclaim(conn.pushbaby)
+        if not self.slots.acquire(timeout=PushHub.SLOT_WAIT_SEC):
+            raise ConnectionBudgetException()
+        self.slotted.add(conn)
+
+    def _release_slot(self, conn):
+        if conn in self.slotted:
+            self.slotted.remove(conn)
+            self.slots.release()
+
+    def _reclaim(self, wanted_by):
+        """
+        Drains a connection of another app, for wanted_by to use: the least
+        busy one of the app with the most connections, if that app has more
+        than wanted_by will once it has this one.
+        """
+        counts = collections.Counter(c.pushbaby for c in self.slotted)
+        candidates = [
+            c for c in self.slotted
+            if (
+                c.pushbaby is not wanted_by and c.is_open() and not c.draining and
+                counts[c.pushbaby] > counts[wanted_by] + 1
+            )
+        ]
+        if len(candidates) == 0:
+            # they're all on their way out already or no app can spare one:
+            # wait for one to close
+            return
+        victim = min(candidates, key=lambda c: (
+            -counts[c.pushbaby], c.load(), c.last_push_sent or c.opened_at
+        ))
+        logger.info("Connection budget used up: reclaiming a connection from another app")
+        self.metrics.increment('connections_reclaimed')
+        victim.drain()
+
+
+class ConnectionBudgetException(Exception):
+    pass
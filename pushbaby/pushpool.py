@@ -0,0 +1,354 @@
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import time
+
+# the exceptions are only used once the package has finished importing,
+# to avoid a cycle
+import pushbaby.errors
+from pushbaby.badtokencache import BadTokenCache
+from pushbaby.metrics import MetricsSink
+from pushbaby.preparedpayload import PreparedPayload
+from pushbaby.ratelimiter import RateLimiter
+from pushbaby.truncate import BodyTooLongException
+
+
+logger = logging.getLogger(__name__)
+
+
+class PushPool:
+    """
+    The parts of a PushBaby that don't depend on how it does its I/O:
+    checking and encoding pushes, picking which connection of the pool to
+    send each on and when to open another, splitting pushes into batches,
+    and deciding which connections to wait for when draining. PushBaby and
+    AsyncPushBaby share these.
+
+    Subclasses do the I/O (sending with the connections to try, waiting
+    for connections to drain), and must provide:
+        _new_connection(): returns a connection for the pool, not yet open
+    and may override:
+        _can_grow(): whether to open more than min_connections
+    """
+    ADDRESSES = {
+        'prod': ('gateway.push.apple.com', 2195),
+        'sandbox': ('gateway.sandbox.push.apple.com', 2195)
+    }
+    FEEDBACK_ADDRESSES = {
+        'prod': ('feedback.push.apple.com', 2196),
+        'sandbox': ('feedback.sandbox.push.apple.com', 2196)
+    }
+    # Open another connection (up to max_connections) once every useable
+    # connection has at least this many pushes waiting to be written
+    POOL_GROW_QUEUE_DEPTH = 8
+    # Maximum number of pushes send_many() writes to a connection at once
+    SEND_MANY_BATCH_SIZE = 1000
+
+    def __init__(self, certfile, keyfile=None, platform='sandbox', feedback_address=None,
+                 min_connections=1, max_connections=4, max_in_flight=None,
+                 bad_token_cache_size=None, bad_token_ttl=None, metrics=None,
+                 max_rate=None, max_rate_per_connection=None, adaptive_rate=False):
+        if min_connections < 1 or max_connections < min_connections:
+            raise ValueError("Need 1 <= min_connections <= max_connections")
+        if adaptive_rate and max_rate is None:
+            raise ValueError("adaptive_rate needs a max_rate to adapt from")
+
+        (self.address, self.fbaddress) = _resolve_platform(platform, feedback_address)
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.conns = []
+        self.min_connections = min_connections
+        self.max_connections = max_connections
+        self.max_in_flight = max_in_flight
+        self.max_rate_per_connection = max_rate_per_connection
+        self.rate_limiter = None
+        if max_rate is not None:
+            self.rate_limiter = RateLimiter(max_rate, adaptive=adaptive_rate)
+        # loaded when we first connect, then shared by all our connections
+        self.ssl_context = None
+        self.metrics = metrics if metrics is not None else MetricsSink()
+        self.journal = None
+        self.on_push_failed = None
+        self.on_push_expired = None
+        # tokens we won't send to: discard() tokens from here if they're
+        # registered again
+        self.bad_tokens = None
+        if bad_token_cache_size:
+            self.bad_tokens = BadTokenCache(bad_token_cache_size, ttl=bad_token_ttl)
+        # set once drain() or close() is called
+        self.closing = False
+        # set if we give up on a push whilst draining, so drain() can say
+        # it didn't finish cleanly
+        self.lost_while_draining = False
+
+    def _prepare(self, payload):
+        if isinstance(payload, PreparedPayload):
+            return payload
+        start = time.time()
+        prepared = PreparedPayload(payload)
+        self.metrics.observe('encode_seconds', time.time() - start)
+        if prepared.truncated:
+            self.metrics.increment('pushes_truncated')
+        return prepared
+
+    def _journal_push(self, payload, token, expiration, priority, identifier):
+        """
+        Records a push in the journal, if we have one, encoding its payload
+        first since that's what's journalled.
+        Returns:
+            A tuple of the payload to send and the journal id (or None)
+        """
+        if self.journal is None:
+            return payload, None
+        payload = self._prepare(payload)
+        return payload, self.journal.record_push(token, payload, expiration, priority, identifier)
+
+    def _abandon(self, jid):
+        """
+        Records in the journal that we've given up on a push (and reported
+        that to the caller) so it won't be resent on recovery.
+        """
+        self._note_lost()
+        if jid is not None and self.journal is not None:
+            self.journal.record_settled(jid, pushbaby.errors.UNKNOWN)
+
+    def _note_lost(self):
+        """
+        Called whenever we give up on a push before finding out whether it
+        was delivered.
+        """
+        if self.closing:
+            self.lost_while_draining = True
+
+    def _check_not_closing(self):
+        if self.closing:
+            raise pushbaby.PushBabyClosedException()
+
+    def _is_bad_token(self, token):
+        return self.bad_tokens is not None and token in self.bad_tokens
+
+    def _add_bad_token(self, token):
+        if self.bad_tokens is not None:
+            self.bad_tokens.add(token)
+
+    def _batches(self, pushes, results):
+        """
+        Checks, journals and groups pushes for send_many().
+        Args:
+            pushes (iterable): dicts with the arguments to send() for each push
+            results (list): Gets an entry appended for each push: None, or
+                        the exception if it can't be sent
+        Returns:
+            A generator of tuples of a batch of pushes to send and the
+            indexes into results of the pushes in it
+        """
+        # indexes into results of the pushes in the batch
+        batch_indexes = []
+        batch = []
+        for push in pushes:
+            if self._is_bad_token(push['token']):
+                results.append(pushbaby.InvalidTokenException())
+                continue
+            try:
+                if self.journal is not None:
+                    payload, jid = self._journal_push(
+                        push['payload'], push['token'],
+                        push.get('expiration'), push.get('priority'), push.get('identifier')
+                    )
+                    push = dict(push, payload=payload, jid=jid)
+                else:
+                    push = dict(push, payload=self._prepare(push['payload']))
+            except BodyTooLongException as e:
+                results.append(e)
+                continue
+            batch_indexes.append(len(results))
+            results.append(None)
+            batch.append(push)
+            if len(batch) >= PushPool.SEND_MANY_BATCH_SIZE:
+                yield batch, batch_indexes
+                batch = []
+                batch_indexes = []
+        if len(batch) > 0:
+            yield batch, batch_indexes
+
+    def _resend_batches(self, sms):
+        """
+        Reports pushes to resend that are to tokens we now know are bad,
+        and splits the others into batches.
+        Args:
+            sms (list): SentMessage objects, in the order they were
+                        originally sent
+        Returns:
+            A list of lists of SentMessages to send again, in order
+        """
+        to_resend = []
+        for sm in sms:
+            if self._is_bad_token(sm.token):
+                # don't kill another connection: just report it as failing again
+                sm.settle(pushbaby.errors.INVALID_TOKEN)
+                if self.on_push_failed:
+                    self.on_push_failed(sm.token, sm.identifier, pushbaby.errors.INVALID_TOKEN)
+            else:
+                to_resend.append(sm)
+        self.metrics.increment('pushes_resent', len(to_resend))
+        return [
+            to_resend[i:i + PushPool.SEND_MANY_BATCH_SIZE]
+            for i in range(0, len(to_resend), PushPool.SEND_MANY_BATCH_SIZE)
+        ]
+
+    def _connections_to_try(self):
+        """
+        Returns a generator of the connections to send a push on: one from
+        the pool, then, each time the caller goes back for another because
+        sending failed, another after removing the last from the pool. It
+        gives up with SendFailedException once it's tried a new connection.
+        """
+        created_conn = False
+        while not created_conn:
+            conn, created_conn = self._get_connection()
+            yield conn
+            logger.info("Connection died: removing")
+            if conn in self.conns:
+                self.conns.remove(conn)
+        raise pushbaby.SendFailedException()
+
+    def _get_connection(self):
+        """
+        Picks the connection to use for the next push: the useable connection
+        with the least work queued and in flight, or a new one if the pool is
+        below min_connections or every connection has a backed up queue.
+        Returns:
+            A tuple of the connection and whether it was newly created.
+        """
+        # Retired connections stay in the list until they're closed since we
+        # still count their pushes in messages_in_flight()
+        self.conns = [c for c in self.conns if c.alive]
+        useable = [c for c in self.conns if c.useable and not c.draining]
+
+        best = None
+        if len(useable) > 0:
+            # prefer connections that are already open to ones we'd have to
+            # wait for
+            best = min(useable, key=lambda c: (not c.is_open(), c.load()))
+
+        if (
+            best is None or
+            len(useable) < self.min_connections or
+            (
+                len(useable) < self.max_connections and
+                best.queue_depth() >= PushPool.POOL_GROW_QUEUE_DEPTH and
+                self._can_grow()
+            )
+        ):
+            logger.info("Opening new connection (%d useable in pool)", len(useable))
+            conn = self._new_connection()
+            self.conns.append(conn)
+            return conn, True
+        return best, False
+
+    def _can_grow(self):
+        return True
+
+    def messages_in_flight(self):
+        """
+        Returns True if there are messages waiting to be sent or that we're
+        still waiting to see if errors occur for.
+        This can be used to determine whether it is safe to shut down the
+        application.
+        """
+        for c in self.conns:
+            if c.messages_in_flight():
+                return True
+        return False
+
+    def in_flight_footprint(self):
+        """
+        Returns roughly how many bytes of memory are being used to remember
+        pushes in case they need to be resent.
+        """
+        return sum(c.in_flight_footprint() for c in self.conns)
+
+    def _start_drain(self, timeout):
+        """
+        Stops taking new pushes.
+        Returns:
+            When to give up draining, as from time.time(), or None
+        """
+        self.closing = True
+        if timeout is None:
+            return None
+        return time.time() + timeout
+
+    def _drain_step(self, deadline):
+        """
+        Asks every open connection to drain. Call this until it returns no
+        connections, waiting for those it does return to close in between:
+        retries of failed pushes can open new connections whilst we wait.
+        Args:
+            deadline (float): When to give up, as from time.time(), or None
+        Returns:
+            A tuple of the connections to wait for (empty once we're done or
+            out of time) and how long to wait for them at most, or None
+        """
+        conns = [c for c in self.conns if c.alive]
+        if len(conns) == 0:
+            return [], None
+        for c in conns:
+            c.drain()
+        remaining = None
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return [], None
+        return conns, remaining
+
+    def _finish_drain(self):
+        drained = not self.lost_while_draining and not any(c.alive for c in self.conns)
+        self.close()
+        return drained
+
+    def _close_connections(self):
+        for c in self.conns:
+            if c.alive:
+                c._close_connection()
+        self.conns = []
+
+
+def _resolve_platform(platform, feedback_address):
+    """
+    Returns:
+        A tuple of the gateway address and the feedback service address (or
+        None if we don't know it) for the platform and feedback_address
+        arguments to PushBaby.
+    """
+    fbaddress = None
+    if isinstance(platform, str):
+        if platform in PushPool.ADDRESSES:
+            address = PushPool.ADDRESSES[platform]
+            fbaddress = PushPool.FEEDBACK_ADDRESSES[platform]
+        else:
+            address = (platform, 2195)
+    else:
+        address = platform
+
+    if feedback_address:
+        fbaddress = feedback_address
+
+    if not fbaddress:
+        logger.warning(
+            "gateway address manually configured but no feedback_address " +
+            "supplied. Fetching feedback will not work"
+        )
+    return address, fbaddress
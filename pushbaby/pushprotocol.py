@@ -0,0 +1,583 @@
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import base64
+import collections
+import logging
+import socket
+import struct
+import sys
+import time
+
+from pushbaby.preparedpayload import PreparedPayload
+from pushbaby.sentwindow import SentWindow
+from pushbaby.ratelimiter import RateLimiter
+import pushbaby.errors
+
+
+logger = logging.getLogger(__name__)
+
+# command and length of a frame
+FRAME_HEADER = struct.Struct("!BI")
+# item id and length of an item of variable length
+ITEM_HEADER = struct.Struct("!BH")
+# fixed length items including their headers:
+# identifier (4 bytes)
+ITEM_IDENTIFIER = struct.Struct("!BHI")
+# expiration date (4 bytes)
+ITEM_EXPIRATION = struct.Struct("!BHI")
+# priority (1 byte)
+ITEM_PRIORITY = struct.Struct("!BHB")
+# command, status and seq of the failed push: the only thing the gateway sends us
+ERROR_RESPONSE = struct.Struct("!BBI")
+
+# from /usr/include/linux/tcp.h
+TCP_USER_TIMEOUT = 18
+
+
+class PushProtocol:
+    """
+    The parts of a connection to the push gateway that don't depend on how
+    it does its I/O: framing pushes, numbering them, remembering them until
+    we know whether they were accepted, and deciding what to do when the
+    gateway says one failed or the connection falls idle. The gevent and
+    asyncio connections share these.
+
+    Subclasses do the I/O, and must provide:
+        _close_connection(): closes the connection, failing anything still in flight
+        _retire_connection(): stops sending new pushes on the connection
+        _schedule_lifecycle(delay): runs _lifecycle() in delay seconds
+        _resend_later(sms): resends SentMessages on another connection
+            without holding up the caller
+    and may override _keep_open().
+    """
+    COMMAND_SENDPUSH = 2
+    COMMAND_ERROR = 8
+
+    ITEM_DEVICE_TOKEN = 1
+    ITEM_PAYLOAD = 2
+    ITEM_IDENTIFIER = 3
+    ITEM_EXPIRATION = 4
+    ITEM_PRIORITY = 5
+
+    MAX_ERROR_WAIT_SEC = 60
+    MAX_PUSHES_PER_CONNECTION = 2**31
+    # Start opening a replacement connection this many pushes before we
+    # run out of seqs
+    RENEW_SEQ_MARGIN = 100000
+    MAX_CONN_IDLE_SEC = 30
+    CONN_TIMEOUT = 10
+
+    class SentMessage(object):
+        # We keep one of these for every push in flight, so keep them small
+        __slots__ = (
+            'sendts', 'token', 'payload', 'expiration', 'priority', 'identifier', 'result',
+            'jid', 'journal', 'end_offset'
+        )
+
+        def __init__(self, sendts, token, payload, expiration, priority, identifier, result=None,
+                     jid=None, journal=None, end_offset=None):
+            self.sendts = sendts
+            self.token = token
+
+            self.payload = payload
+            self.expiration = expiration
+            self.priority = priority
+            self.identifier = identifier
+            # AsyncResult for pushes sent with send_async (or anything with
+            # the same ready(), set() and set_exception())
+            self.result = result
+            # where to record how the push settled, if we're keeping a journal
+            self.jid = jid
+            self.journal = journal
+            # where the write this push was in ended in the TCP stream (see
+            # pushbaby.tcpinfo), or None if we can't tell
+            self.end_offset = end_offset
+
+        def settle(self, status):
+            if self.result is not None and not self.result.ready():
+                self.result.set(status)
+            if self.journal is not None:
+                self.journal.record_settled(self.jid, status)
+
+        def fail(self, ex):
+            if self.result is not None and not self.result.ready():
+                self.result.set_exception(ex)
+            if self.journal is not None:
+                # we've given up on it so it mustn't be resent on recovery
+                self.journal.record_settled(self.jid, pushbaby.errors.UNKNOWN)
+
+        def footprint(self):
+            """
+            Returns roughly how many bytes of memory this push is keeping
+            alive. The payload may be shared with other pushes, in which case
+            this is an overestimate.
+            """
+            return (
+                sys.getsizeof(self) + sys.getsizeof(self.token) +
+                sys.getsizeof(self.payload) + len(self.payload.item)
+            )
+
+    def __init__(self, pushbaby, max_in_flight=None, max_rate=None):
+        self.pushbaby = pushbaby
+        self.seq = -1
+        self.alive = True
+        self.useable = True
+        self.sent = SentWindow()
+        self.max_in_flight = max_in_flight
+        # (seq, sendts, jid, journal) of journalled pushes we've stopped
+        # remembering because of max_in_flight, so we can still settle them
+        self.forgotten = collections.deque()
+        self.rate_limiter = None
+        if max_rate is not None:
+            self.rate_limiter = RateLimiter(max_rate)
+        self.last_push_sent = None
+        self.last_failed_seq = None
+        self.opened_at = None
+        # checks whether to retire / close the connection and expires old
+        # pushes from self.sent
+        self.lifecycle_timer = None
+        # set when we've stopped taking new pushes and are closing once the
+        # gateway has processed the ones we've sent
+        self.draining = False
+        # seq of the push we send when draining that we know will fail
+        self.probe_seq = None
+
+    def _set_user_timeout(self, sock):
+        """
+        Attempts to set the TCP_USER_TIMEOUT sockopt (will only work on Linux).
+        Without this, connections will take 15 minutes or much, much longer to
+        time out if the connection drops which is nonideal since we'll be sending
+        push into the void during that time
+        Returns:
+            True if it was set, False if the caller needs to time out writes
+            itself.
+        """
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, TCP_USER_TIMEOUT, PushProtocol.CONN_TIMEOUT * 1000)
+            return True
+        except socket.error:
+            logger.warning(
+                "Couldn't set socket timeout (only works on Linux >= 2.6.37): " +
+                "falling back to write timeouts"
+            )
+            return False
+
+    def _set_keepalive(self, sock):
+        """
+        Turns on TCP keepalives so a dead peer is noticed whilst the
+        connection is idle, as warm connections can be for as long as they
+        live: TCP_USER_TIMEOUT only applies once there's something to send.
+        Keepalives don't help whilst there's unacknowledged data, which is
+        what TCP_USER_TIMEOUT (or, without it, a write timeout) is for.
+        """
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            # TCP_KEEPALIVE is the macOS name for TCP_KEEPIDLE
+            idle_opt = getattr(socket, 'TCP_KEEPIDLE', getattr(socket, 'TCP_KEEPALIVE', None))
+            for opt, val in (
+                (idle_opt, PushProtocol.CONN_TIMEOUT),
+                (getattr(socket, 'TCP_KEEPINTVL', None), PushProtocol.CONN_TIMEOUT),
+                (getattr(socket, 'TCP_KEEPCNT', None), 3),
+            ):
+                if opt is not None:
+                    sock.setsockopt(socket.IPPROTO_TCP, opt, val)
+        except socket.error:
+            logger.warning("Couldn't enable TCP keepalives: dead connections may take a long time to notice")
+
+    def _lifecycle(self):
+        """
+        Expires old pushes and retires or closes the connection once it's
+        been idle for long enough, then schedules itself for the next time
+        there's something to do.
+        """
+        self.lifecycle_timer = None
+        if not self.alive:
+            return
+        self.prune_sent()
+
+        now = time.time()
+        secs_since_last_used = now - (self.last_push_sent or self.opened_at)
+        idle = secs_since_last_used >= PushProtocol.MAX_CONN_IDLE_SEC
+        if self.useable and idle and not self._keep_open():
+            logger.info("Connection unused for %f seconds: retiring", secs_since_last_used)
+            self._retire_connection()
+        if not self.useable and len(self.sent) == 0 and len(self.forgotten) == 0:
+            logger.info("Connection retired with nothing in flight: closing")
+            self._close_connection()
+            return
+        if not self.useable and secs_since_last_used >= PushProtocol.MAX_ERROR_WAIT_SEC:
+            # we've waited for as long as we want to for errors, and we're not going to
+            # send anything else, so our work here is done.
+            logger.info("Connection retired and last used %f seconds ago: closing", secs_since_last_used)
+            self._close_connection()
+            return
+
+        if self.useable and idle:
+            # kept open: see if that's still the case later
+            next_check = PushProtocol.MAX_CONN_IDLE_SEC
+        elif self.useable:
+            next_check = PushProtocol.MAX_CONN_IDLE_SEC - secs_since_last_used
+        else:
+            next_check = PushProtocol.MAX_ERROR_WAIT_SEC - secs_since_last_used
+        oldest = self.sent.oldest()
+        if oldest is not None:
+            next_check = min(next_check, oldest.sendts + PushProtocol.MAX_ERROR_WAIT_SEC - now)
+        self._schedule_lifecycle(next_check)
+
+    def _keep_open(self):
+        """
+        Returns True if the connection should stay open even though it's
+        idle. Subclasses override this for warm connections.
+        """
+        return False
+
+    def _handle_error_response(self, buf):
+        """
+        Handles the ERROR_RESPONSE.size bytes the gateway sends when a push fails.
+        """
+        (command, status, seq) = ERROR_RESPONSE.unpack(buf)
+        if command != PushProtocol.COMMAND_ERROR:
+            # if we get a command we don't recognise, we must close the connection.
+            # There's no framing so we can't just skip past anything unknown
+            # because we'd have no idea how much to skip.
+            logger.error("Recieved unknown command %d: closing connection", command)
+            self._close_connection()
+
+        self._push_failed(status, seq)
+        # we now expect the connection to be closed from the other end
+
+    def _push_failed(self, status, seq):
+        self.last_failed_seq = seq
+        self.prune_sent()
+
+        if seq == self.probe_seq:
+            # Everything before the probe has been processed, and pruned
+            # above, so we're done
+            logger.info("Connection drained: closing")
+            self._close_connection()
+            return
+
+        # A push connection is no longer useable once we've had an error down
+        # so retire it
+        self._retire_connection()
+
+        failed = self.sent.pop(seq)
+        if failed is None:
+            # We stopped remembering it (see max_in_flight) or it failed after
+            # we'd assumed it was accepted. We can't tell anyone which push it
+            # was, but the gateway still hasn't processed anything after it.
+            logger.error("Got a failure for seq %d that we don't remember: resending later pushes", seq)
+            self.pushbaby.metrics.increment('pushes_failed', labels={'status': status})
+            if len(self.forgotten) > 0 and self.forgotten[0][0] == seq:
+                (_, _, jid, journal) = self.forgotten.popleft()
+                journal.record_settled(jid, status)
+            to_resend = self.sent.values()
+            self.sent.clear()
+            if len(to_resend) > 0:
+                self._resend_later(to_resend)
+        else:
+            # Any pushes after a failed one are not processed and need to be resent
+            # we've already pruned out the ones before so if we remove the failed one,
+            # we resend all the remaining ones
+            to_resend = []
+            if status in (pushbaby.errors.SHUTDOWN, pushbaby.errors.PROCESSING):
+                # the gateway is struggling: slow down
+                self._rate_backoff()
+            if status == pushbaby.errors.SHUTDOWN:
+                # we'll retry this one automatically
+                logger.info("Push failed with SHUTDOWN status: retying")
+                to_resend.append(failed)
+            else:
+                logger.warning("Push to token %s failed with status %d", base64.b64encode(failed.token), status)
+                if status == pushbaby.errors.INVALID_TOKEN:
+                    self.pushbaby._add_bad_token(failed.token)
+                failed.settle(status)
+                self.pushbaby.metrics.increment('pushes_failed', labels={'status': status})
+                if self.pushbaby.on_push_failed:
+                    self.pushbaby.on_push_failed(failed.token, failed.identifier, status)
+
+            logger.info("Retrying %d pushes sent after failed push", len(self.sent))
+            to_resend.extend(self.sent.values())
+            self.sent.clear()
+            # Resend them all in one go, in their original order, without
+            # blocking whoever is handling this error
+            if len(to_resend) > 0:
+                self._resend_later(to_resend)
+
+    def _fail_in_flight(self):
+        """
+        Gives up on everything we haven't heard about, when the connection
+        closes: we'll never find out whether it was delivered.
+        """
+        if len(self.sent) > 0 or len(self.forgotten) > 0:
+            self.pushbaby._note_lost()
+        for sm in self.sent.values():
+            sm.fail(ConnectionDeadException())
+        for (_, _, jid, journal) in self.forgotten:
+            journal.record_settled(jid, pushbaby.errors.UNKNOWN)
+        self.forgotten.clear()
+
+    def _pack_probe(self):
+        """
+        Returns the frame of a push with no token, which the gateway will
+        reject. Errors are reported in order, so when the error for this one
+        arrives we know every push we sent before it was accepted.
+        """
+        payload = PreparedPayload({})
+        probe = bytearray(self._frame_length(b'', payload, None, None))
+        self.probe_seq = self._nextSeq()
+        self._pack_frame(probe, 0, self.probe_seq, b'', payload, None, None)
+        return probe
+
+    def in_flight_footprint(self):
+        """
+        Returns roughly how many bytes of memory are being used to remember
+        pushes in case they need resending, or to settle their journal
+        entries.
+        """
+        footprint = self.sent.footprint
+        if len(self.forgotten) > 0:
+            footprint += len(self.forgotten) * sys.getsizeof(self.forgotten[0])
+        return footprint
+
+    def _push(self, payload, token, expiration=None, priority=None, identifier=None, result=None,
+              jid=None):
+        """
+        Args:
+            payload (PreparedPayload): The payload of the push to send
+            identifier (any): Opaque variable that is passed back to the pushbaby on failure
+            result (AsyncResult): Set when the push succeeds or fails, for send_async
+            jid (int): The push's id in the pushbaby's journal, if it has one
+        """
+        return {
+            'payload': payload,
+            'token': token,
+            'expiration': expiration,
+            'priority': priority,
+            'identifier': identifier,
+            'result': result,
+            'jid': jid,
+            'enqueued': time.time(),
+        }
+
+    def _rate_wait(self, n):
+        """
+        Takes n pushes from this connection's rate limit and the pushbaby's.
+        Returns:
+            How many seconds to wait before writing them
+        """
+        wait = 0
+        for limiter in (self.rate_limiter, self.pushbaby.rate_limiter):
+            if limiter is not None:
+                wait = max(wait, limiter.take(n))
+        if wait > 0:
+            self.pushbaby.metrics.observe('rate_limit_wait_seconds', wait)
+        return wait
+
+    def _rate_backoff(self):
+        if self.pushbaby.rate_limiter is not None:
+            self.pushbaby.rate_limiter.backoff()
+            logger.info("Gateway overloaded: slowing down to %f pushes/sec", self.pushbaby.rate_limiter.rate)
+
+    def _drop_expired(self, pushes):
+        """
+        Returns the pushes that haven't expired whilst they were queued,
+        reporting the ones that have to on_push_expired. There's no point
+        sending them since the gateway would just discard them.
+        """
+        now = time.time()
+        live = []
+        for push in pushes:
+            if push['expiration'] and push['expiration'] < now:
+                self.pushbaby.metrics.increment('pushes_expired')
+                if push['jid'] is not None:
+                    self.pushbaby._abandon(push['jid'])
+                if push['result'] is not None and not push['result'].ready():
+                    push['result'].set_exception(PushExpiredException())
+                if self.pushbaby.on_push_expired:
+                    self.pushbaby.on_push_expired(push['token'], push['identifier'])
+            else:
+                live.append(push)
+        if len(live) < len(pushes):
+            logger.info("Dropped %d pushes that expired whilst queued", len(pushes) - len(live))
+        return live
+
+    def _pack_pushes(self, pushes):
+        """
+        Gives each push a seq and packs all of their frames into one buffer,
+        retiring the connection if that uses up the last of its seqs.
+        Args:
+            pushes (list): dicts of the arguments for each push, as from _push()
+        Returns:
+            A tuple of the list of seqs and a bytearray of the frames
+        """
+        seqs = []
+        framelen = 0
+        for push in pushes:
+            seqs.append(self._nextSeq())
+            framelen += self._frame_length(
+                push['token'], push['payload'], push['expiration'], push['priority']
+            )
+
+        if self.seq >= PushProtocol.MAX_PUSHES_PER_CONNECTION:
+            # IDs are 4 byte so rather than worry about wrapping IDs, just make a new connection
+            # Note we don't close the connection because we want to wait to see if any errors arrive
+            self._retire_connection()
+
+        apnsFrames = bytearray(framelen)
+        offset = 0
+        for seq, push in zip(seqs, pushes):
+            offset = self._pack_frame(
+                apnsFrames, offset,
+                seq, push['token'], push['payload'], push['expiration'], push['priority']
+            )
+        return seqs, apnsFrames
+
+    def _record_sent(self, seqs, pushes, journal=None, end_offsets=None):
+        """
+        Remembers pushes that have just been written, in case they fail.
+        Args:
+            seqs (list): The seqs they were sent with, from _pack_pushes()
+            pushes (list): dicts of the arguments for each push, as from _push()
+            journal (Journal): Where to record how they settle, if anywhere
+            end_offsets (list): Where each push ended in the TCP stream, if
+                        we're tracking that
+        """
+        now = time.time()
+        metrics = self.pushbaby.metrics
+        metrics.increment('pushes_sent', len(pushes))
+        for i, (seq, push) in enumerate(zip(seqs, pushes)):
+            metrics.observe('enqueue_to_write_seconds', now - push['enqueued'])
+            self.sent.add(seq, PushProtocol.SentMessage(
+                now, push['token'], push['payload'],
+                push['expiration'], push['priority'], push['identifier'], push['result'],
+                push['jid'], journal, end_offsets[i] if end_offsets is not None else None
+            ))
+        self.last_push_sent = now
+        metrics.observe('in_flight', len(self.sent))
+
+        if self.max_in_flight is not None and len(self.sent) > self.max_in_flight:
+            # The oldest pushes are the ones least likely to still fail, so
+            # stop waiting for errors on them to stay under the limit. We
+            # don't know yet whether they were accepted, and if one does fail
+            # we can't resend it, so their results are set to UNKNOWN. Their
+            # journal entries stay unsettled until we find out.
+            num = len(self.sent) - self.max_in_flight
+            logger.debug("Too many pushes in flight: forgetting the oldest %d", num)
+            for _ in range(num):
+                seq = self.sent.oldest_seq()
+                m = self.sent.pop(seq)
+                if m.result is not None and not m.result.ready():
+                    m.result.set(pushbaby.errors.UNKNOWN)
+                if m.journal is not None:
+                    self.forgotten.append((seq, m.sendts, m.jid, m.journal))
+            # Those are small, but not free: beyond max_in_flight of them we
+            # give up on finding out what happened, as for any push we give
+            # up on, so they aren't resent on recovery
+            while len(self.forgotten) > self.max_in_flight:
+                (_, _, jid, journal) = self.forgotten.popleft()
+                journal.record_settled(jid, pushbaby.errors.UNKNOWN)
+
+    def _frame_length(self, token, payload, expiration, priority):
+        length = (
+            FRAME_HEADER.size +
+            ITEM_HEADER.size + len(token) +
+            len(payload.item) +
+            ITEM_IDENTIFIER.size
+        )
+        if expiration:
+            length += ITEM_EXPIRATION.size
+        if priority:
+            length += ITEM_PRIORITY.size
+        return length
+
+    def _pack_frame(self, buf, offset, seq, token, payload, expiration, priority):
+        """
+        Packs a command 2 frame for the push into buf at offset.
+        Returns:
+            The offset of the end of the frame
+        """
+        start = offset
+        offset += FRAME_HEADER.size
+
+        ITEM_HEADER.pack_into(buf, offset, PushProtocol.ITEM_DEVICE_TOKEN, len(token))
+        offset += ITEM_HEADER.size
+        buf[offset:offset + len(token)] = token
+        offset += len(token)
+
+        # the payload item comes ready encoded, header and all
+        buf[offset:offset + len(payload.item)] = payload.item
+        offset += len(payload.item)
+
+        # strictly speaking the identifier is just bytes do we could just
+        # send it in host byte order but we may as well keep
+        # everything in network byte order
+        ITEM_IDENTIFIER.pack_into(buf, offset, PushProtocol.ITEM_IDENTIFIER, 4, seq)
+        offset += ITEM_IDENTIFIER.size
+
+        if expiration:
+            ITEM_EXPIRATION.pack_into(buf, offset, PushProtocol.ITEM_EXPIRATION, 4, int(expiration))
+            offset += ITEM_EXPIRATION.size
+        if priority:
+            ITEM_PRIORITY.pack_into(buf, offset, PushProtocol.ITEM_PRIORITY, 1, priority)
+            offset += ITEM_PRIORITY.size
+
+        FRAME_HEADER.pack_into(
+            buf, start, PushProtocol.COMMAND_SENDPUSH, offset - start - FRAME_HEADER.size
+        )
+        return offset
+
+    def _nextSeq(self):
+        self.seq += 1
+        return self.seq
+
+    def prune_sent(self):
+        pruned = []
+        cutoff = time.time() - PushProtocol.MAX_ERROR_WAIT_SEC
+        # If we know a push has failed, we can deduce that all previous
+        # pushes succeeded
+        if self.last_failed_seq:
+            pruned.extend(self.sent.pop_before_seq(self.last_failed_seq))
+        # We say it's safe to assume that anything we sent more than this
+        # long ago would have failed by now if it was going to fail
+        pruned.extend(self.sent.pop_sent_before(cutoff))
+        while len(self.forgotten) > 0:
+            (seq, sendts, jid, journal) = self.forgotten[0]
+            if sendts >= cutoff and (self.last_failed_seq is None or seq >= self.last_failed_seq):
+                break
+            self.forgotten.popleft()
+            journal.record_settled(jid, pushbaby.errors.NO_ERROR)
+        for m in pruned:
+            m.settle(pushbaby.errors.NO_ERROR)
+        if len(pruned) > 0 and self.pushbaby.rate_limiter is not None:
+            self.pushbaby.rate_limiter.succeeded(len(pruned))
+
+
+def _batch_priority(pushes):
+    """
+    Returns the priority to queue a batch of pushes with: that of its most
+    urgent push.
+    """
+    if any(p['priority'] is None for p in pushes):
+        return None
+    return max(p['priority'] for p in pushes)
+
+
+class ConnectionDeadException(Exception):
+    pass
+
+
+class PushExpiredException(Exception):
+    pass
@@ -0,0 +1,101 @@
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gevent
+
+import time
+
+
+class RateLimiter:
+    """
+    A token bucket limiting how many pushes per second we write.
+    Callers take tokens before writing and sleep if there aren't enough.
+    A batch bigger than the bucket takes it into debt, so large batches
+    don't wait forever: the next caller waits for the debt to be paid off.
+
+    In adaptive mode, the rate is halved (down to MIN_RATE_FRACTION of the
+    maximum) whenever the gateway shows signs of being overloaded, and grows
+    back by a fraction of the maximum as pushes are accepted.
+    """
+    # Never adapt the rate down below this fraction of the maximum
+    MIN_RATE_FRACTION = 0.05
+    # Multiply the rate by this on each sign of overload
+    DECREASE_FACTOR = 0.5
+    # Number of accepted pushes it takes to grow back from zero to the maximum
+    RECOVERY_PUSHES = 10000
+
+    def __init__(self, max_rate, burst=None, adaptive=False):
+        """
+        Args:
+            max_rate (float): Pushes per second
+            burst (int): Most pushes that can be written at once after a
+                         quiet period. Defaults to one second's worth.
+            adaptive (bool): Whether to adapt the rate to how the gateway copes
+        """
+        if max_rate <= 0:
+            raise ValueError("Rate must be positive")
+        self.max_rate = float(max_rate)
+        self.rate = self.max_rate
+        self.burst = burst if burst is not None else max(1, int(max_rate))
+        self.adaptive = adaptive
+        self.tokens = float(self.burst)
+        self.last_refill = time.time()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def take(self, n=1):
+        """
+        Takes n tokens without waiting for them.
+        Returns:
+            The number of seconds the caller must wait before going ahead,
+            until the tokens have been paid for
+        """
+        self._refill()
+        self.tokens -= n
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+    def acquire(self, n=1):
+        """
+        Takes n tokens, blocking the current greenlet until they've been
+        paid for.
+        Returns:
+            The number of seconds we waited
+        """
+        wait = self.take(n)
+        if wait > 0:
+            gevent.sleep(wait)
+        return wait
+
+    def backoff(self):
+        """
+        Slows down after the gateway has shown signs of being overloaded.
+        """
+        if not self.adaptive:
+            return
+        self._refill()
+        self.rate = max(self.max_rate * RateLimiter.MIN_RATE_FRACTION, self.rate * RateLimiter.DECREASE_FACTOR)
+
+    def succeeded(self, n):
+        """
+        Speeds back up after n pushes were accepted.
+        """
+        if not self.adaptive or self.rate >= self.max_rate:
+            return
+        self._refill()
+        self.rate = min(self.max_rate, self.rate + self.max_rate * n / RateLimiter.RECOVERY_PUSHES)
@@ -0,0 +1,158 @@
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gevent.event
+import gevent.lock
+import gevent.queue
+
+import collections
+
+from pushbaby.pushprotocol import ConnectionDeadException
+
+
+# APNS priorities: send now, or send when it's convenient for the device's battery
+PRIORITY_IMMEDIATE = 10
+PRIORITY_CONSERVE_POWER = 5
+
+# How many jobs to take from each lane for every round of the others
+DEFAULT_WEIGHTS = {
+    PRIORITY_IMMEDIATE: 4,
+    PRIORITY_CONSERVE_POWER: 1,
+}
+
+
+class SendScheduler:
+    """
+    The queue of jobs waiting for a connection's writer, with a lane for
+    each APNS priority so that urgent pushes don't wait behind a backlog of
+    bulk ones.
+    Lanes are served in weighted round robin: in each round, up to the
+    lane's weight in jobs are taken from each lane, highest priority first,
+    so lower priorities are delayed but never starved. Jobs in the same lane
+    come out in the order they were put in.
+    Like gevent.queue.Queue, put() blocks when maxsize jobs are waiting and
+    get() raises gevent.queue.Empty if it times out.
+    Once close() is called, put() raises ConnectionDeadException and get()
+    raises gevent.queue.Empty as soon as the jobs already queued have gone.
+    """
+    def __init__(self, maxsize=None, weights=None):
+        """
+        Args:
+            maxsize (int): Maximum number of jobs waiting, or None for no limit
+            weights (dict): Weight of each lane, keyed by APNS priority
+        """
+        if weights is None:
+            weights = DEFAULT_WEIGHTS
+        if len(weights) == 0 or min(weights.values()) < 1:
+            raise ValueError("Need at least one lane and weights of at least 1")
+        self.weights = dict(weights)
+        # highest priority first
+        self.priorities = sorted(self.weights.keys(), reverse=True)
+        self.lanes = dict((p, collections.deque()) for p in self.priorities)
+        # jobs left in this round for each lane
+        self.credits = dict(self.weights)
+        # jobs that run once every lane is empty
+        self.final = collections.deque()
+        self.count = 0
+        self.not_empty = gevent.event.Event()
+        self.slots = None
+        if maxsize is not None:
+            self.slots = gevent.lock.Semaphore(maxsize)
+        self.closed = False
+
+    def qsize(self):
+        return self.count + len(self.final)
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def lane_for(self, priority):
+        """
+        Returns the lane for pushes of the given priority: pushes without
+        one get the highest priority, as APNS gives them, and priorities
+        without a lane of their own go in the next lane down.
+        """
+        if priority is None:
+            return self.priorities[0]
+        for p in self.priorities:
+            if p <= priority:
+                return p
+        return self.priorities[-1]
+
+    def put(self, job, priority=None):
+        """
+        Queues a job in the lane for priority, blocking while the queue is full.
+        Throws:
+            ConnectionDeadException: If the queue is closed, including whilst
+                we were waiting for room
+        """
+        if self.slots is not None:
+            self.slots.acquire()
+        if self.closed:
+            if self.slots is not None:
+                # wake the next one waiting so it finds out too
+                self.slots.release()
+            raise ConnectionDeadException()
+        self.lanes[self.lane_for(priority)].append(job)
+        self.count += 1
+        self.not_empty.set()
+
+    def put_last(self, job):
+        """
+        Queues a job to run once every job in every lane has run, including
+        ones queued after this. This never blocks.
+        """
+        if self.closed:
+            raise ConnectionDeadException()
+        self.final.append(job)
+        self.not_empty.set()
+
+    def get(self, block=True, timeout=None):
+        while self.empty():
+            if self.closed or not block or not self.not_empty.wait(timeout):
+                raise gevent.queue.Empty()
+
+        if self.count == 0:
+            job = self.final.popleft()
+        else:
+            job = self._next_job()
+            self.count -= 1
+            if self.slots is not None:
+                self.slots.release()
+        if self.empty():
+            self.not_empty.clear()
+        return job
+
+    def close(self):
+        """
+        Stops taking jobs, when the connection has closed. Jobs already queued
+        can still be taken with get(), which stops blocking once there are
+        none left, so whoever's waiting on them finds out.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.not_empty.set()
+        if self.slots is not None:
+            # wakes anyone blocked in put(), who wakes the next in turn
+            self.slots.release()
+
+    def _next_job(self):
+        while True:
+            for p in self.priorities:
+                if self.credits[p] > 0 and len(self.lanes[p]) > 0:
+                    self.credits[p] -= 1
+                    return self.lanes[p].popleft()
+            # every lane with jobs has had its share: start a new round
+            self.credits = dict(self.weights)
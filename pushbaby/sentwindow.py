@@ -0,0 +1,154 @@
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+class SentWindow:
+    """
+    The pushes sent on a connection that we're still waiting to see if
+    errors occur for, ordered by seq.
+    Seqs only ever go up, so this is a list indexed by seq minus the seq
+    of the oldest push, which lets us look up a push by seq and drop
+    pushes off the front in (amortised) constant time. Seqs that were
+    never sent (or have been removed) hold None.
+    Pushes must be added in order of seq and send time, and have a
+    footprint() method giving their approximate size in bytes.
+    """
+    def __init__(self):
+        self.items = []
+        # index into items of the oldest push
+        self.head = 0
+        # seq of items[head]
+        self.base = 0
+        self.count = 0
+        # approximate bytes of memory used by the pushes in the window
+        self.footprint = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, seq, sm):
+        if self.count == 0:
+            self.clear()
+            self.base = seq
+        elif seq < self.base + len(self.items) - self.head:
+            raise ValueError("Pushes must be added in order of seq")
+        while self.base + len(self.items) - self.head < seq:
+            self.items.append(None)
+        self.items.append(sm)
+        self.count += 1
+        self.footprint += sm.footprint()
+
+    def get(self, seq):
+        i = seq - self.base + self.head
+        if seq < self.base or i >= len(self.items):
+            return None
+        return self.items[i]
+
+    def oldest(self):
+        if self.count == 0:
+            return None
+        return self.items[self.head]
+
+    def oldest_seq(self):
+        if self.count == 0:
+            return None
+        return self.base
+
+    def pop(self, seq):
+        sm = self.get(seq)
+        if sm is not None:
+            self.items[seq - self.base + self.head] = None
+            self.count -= 1
+            self.footprint -= sm.footprint()
+            self._drop_empty()
+        return sm
+
+    def pop_before_seq(self, seq):
+        """
+        Removes and returns all the pushes with seq less than the one given.
+        """
+        popped = []
+        while self.count > 0 and self.base < seq:
+            self._pop_front(popped)
+        return popped
+
+    def pop_sent_before(self, ts):
+        """
+        Removes and returns all the pushes sent before the given time.
+        """
+        popped = []
+        while self.count > 0 and self.items[self.head].sendts < ts:
+            self._pop_front(popped)
+        return popped
+
+    def pop_oldest(self, num):
+        """
+        Removes and returns the num oldest pushes.
+        """
+        popped = []
+        while self.count > 0 and len(popped) < num:
+            self._pop_front(popped)
+        return popped
+
+    def pop_newest(self, pred):
+        """
+        Removes and returns, oldest first, the newest pushes for which pred
+        is true, stopping at the first one for which it isn't.
+        """
+        popped = []
+        while self.count > 0:
+            sm = self.items[-1]
+            if sm is not None:
+                if not pred(sm):
+                    break
+                popped.append(sm)
+                self.count -= 1
+                self.footprint -= sm.footprint()
+            self.items.pop()
+        if self.count == 0:
+            self.clear()
+        popped.reverse()
+        return popped
+
+    def values(self):
+        return [sm for sm in self.items[self.head:] if sm is not None]
+
+    def clear(self):
+        self.items = []
+        self.head = 0
+        self.count = 0
+        self.footprint = 0
+
+    def _pop_front(self, popped):
+        sm = self.items[self.head]
+        self.items[self.head] = None
+        self.head += 1
+        self.base += 1
+        if sm is not None:
+            popped.append(sm)
+            self.count -= 1
+            self.footprint -= sm.footprint()
+        self._drop_empty()
+
+    def _drop_empty(self):
+        # skip past seqs with nothing in so the head is always a push
+        while self.head < len(self.items) and self.items[self.head] is None:
+            self.head += 1
+            self.base += 1
+        if self.count == 0:
+            self.clear()
+        elif self.head > 1024 and self.head * 2 > len(self.items):
+            # throw away the dead space at the front once it's most of the list
+            del self.items[:self.head]
+            self.head = 0
@@ -0,0 +1,92 @@
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Asks the (Linux) kernel how much of what we've written to a TCP socket the
+other end has acknowledged, so that when a connection dies we can tell which
+pushes never made it.
+
+Both functions measure in the same units: bytes of the TCP stream, including
+any TLS framing, counted from the start of the connection. Call
+stream_offset() before and after a write to find where that write starts
+and ends, and bytes_acked() once the connection has died to find how much of the stream
+the other end got: anything written after that was lost.
+On other platforms, and kernels older than 4.1, both return None.
+"""
+
+import logging
+import socket
+import struct
+
+try:
+    import fcntl
+    import termios
+    # aka. SIOCOUTQ: bytes written to the socket but not yet acknowledged
+    TIOCOUTQ = termios.TIOCOUTQ
+except (ImportError, AttributeError):
+    TIOCOUTQ = None
+
+logger = logging.getLogger(__name__)
+
+TCP_INFO = getattr(socket, 'TCP_INFO', None)
+# tcpi_bytes_acked is a __u64 at this offset in struct tcp_info (see
+# linux/tcp.h): it counts the SYN too, but we only ever compare it with
+# itself so that doesn't matter.
+TCPI_BYTES_ACKED_OFFSET = 120
+TCPI_BYTES_ACKED = struct.Struct("=Q")
+TCP_INFO_LENGTH = TCPI_BYTES_ACKED_OFFSET + TCPI_BYTES_ACKED.size
+
+OUTQ = struct.Struct("i")
+
+
+def bytes_acked(sock):
+    """
+    Returns how many bytes of the stream the other end has acknowledged.
+    This still works once the connection has been reset.
+    """
+    if TCP_INFO is None:
+        return None
+    try:
+        info = sock.getsockopt(socket.IPPROTO_TCP, TCP_INFO, TCP_INFO_LENGTH)
+    except (socket.error, EnvironmentError):
+        logger.debug("Couldn't get TCP_INFO", exc_info=True)
+        return None
+    if len(info) < TCP_INFO_LENGTH:
+        # kernel too old to report it
+        return None
+    return TCPI_BYTES_ACKED.unpack_from(info, TCPI_BYTES_ACKED_OFFSET)[0]
+
+
+def stream_offset(sock):
+    """
+    Returns the offset in the stream of the end of everything written to the
+    socket so far: the bytes acknowledged plus the ones still in the send
+    queue.
+    """
+    if TIOCOUTQ is None:
+        return None
+    # Read what's been acknowledged first: if more gets acknowledged before
+    # we read the send queue, we underestimate the offset, so those pushes
+    # look acknowledged and fail as usual if the connection dies. The other
+    # way round we'd overestimate it and resend pushes the gateway got,
+    # which would deliver them twice.
+    acked = bytes_acked(sock)
+    if acked is None:
+        return None
+    try:
+        outq = OUTQ.unpack(fcntl.ioctl(sock.fileno(), TIOCOUTQ, OUTQ.pack(0)))[0]
+    except (socket.error, EnvironmentError):
+        logger.debug("Couldn't get SIOCOUTQ", exc_info=True)
+        return None
+    return acked + outq
@@ -0,0 +1,94 @@
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gevent
+
+import logging
+import math
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class Timer(object):
+    __slots__ = ('callback', 'slot', 'rounds')
+
+    def __init__(self, callback, slot, rounds):
+        self.callback = callback
+        self.slot = slot
+        self.rounds = rounds
+
+
+class TimerWheel:
+    """
+    A hashed timer wheel: a single greenlet that runs callbacks after a
+    delay, to the nearest tick. Lots of connections can share one of
+    these rather than each waking up periodically to check the time.
+    The greenlet only runs while there are timers scheduled.
+    """
+    def __init__(self, tick=1.0, num_slots=64):
+        self.tick = tick
+        self.slots = [set() for _ in range(num_slots)]
+        self.pos = 0
+        self.count = 0
+        self.greenlet = None
+
+    def schedule(self, delay, callback):
+        """
+        Runs callback (with no arguments) in delay seconds (rounded up to
+        the next tick). Callbacks run on the timer wheel's greenlet so
+        should not block.
+        Returns:
+            A handle that can be passed to cancel()
+        """
+        ticks = max(1, int(math.ceil(delay / self.tick)))
+        slot = (self.pos + ticks) % len(self.slots)
+        timer = Timer(callback, slot, (ticks - 1) // len(self.slots))
+        self.slots[slot].add(timer)
+        self.count += 1
+        if self.greenlet is None:
+            self.greenlet = gevent.spawn(self._run)
+        return timer
+
+    def cancel(self, timer):
+        if timer in self.slots[timer.slot]:
+            self.slots[timer.slot].remove(timer)
+            self.count -= 1
+
+    def __len__(self):
+        return self.count
+
+    def _run(self):
+        next_tick = time.time() + self.tick
+        try:
+            while self.count > 0:
+                gevent.sleep(max(0, next_tick - time.time()))
+                next_tick += self.tick
+                self.pos = (self.pos + 1) % len(self.slots)
+                due = []
+                for timer in list(self.slots[self.pos]):
+                    if timer.rounds > 0:
+                        timer.rounds -= 1
+                    else:
+                        self.slots[self.pos].remove(timer)
+                        self.count -= 1
+                        due.append(timer)
+                for timer in due:
+                    try:
+                        timer.callback()
+                    except:
+                        logger.exception("Caught exception running timer")
+        finally:
+            self.greenlet = None
@@ -12,8 +12,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import heapq
+
 from .aps import json_for_payload
 
+# str and unicode on Python 2, bytes and str on Python 3
+TEXT_TYPES = (bytes, type(u''))
+
+# The most bytes one character can take up in our JSON encoding
+# (a control character escaped as \uXXXX)
+MAX_ENCODED_CHAR_LENGTH = 6
+
 
 class BodyTooLongException(Exception):
     pass
@@ -30,36 +39,120 @@ def is_too_long(payload, max_length=2048):
 
 
 def truncate(payload, max_length=2048):
+    return truncate_and_encode(payload, max_length)[0]
+
+
+def truncate_and_encode(payload, max_length=2048):
+    """
+    Truncates the payload as truncate() does and also returns its encoding,
+    saving encoding it again.
+    Returns:
+        A tuple of the truncated payload, its JSON encoding and whether it
+        needed truncating.
+    """
     payload = payload.copy()
     if 'aps' not in payload:
-        if is_too_long(payload, max_length):
+        encoded = json_for_payload(payload)
+        if len(encoded) > max_length:
             raise BodyTooLongException()
         else:
-            return payload
-    aps = payload['aps']
+            return payload, encoded, False
+    # copy the parts of the aps dictionary we might change so we don't
+    # truncate the caller's payload
+    aps = _copy_aps(payload['aps'])
+    payload['aps'] = aps
 
     # first ensure all our choppables are unicode objects.
     # We need them to be for truncating to work and this
     # makes more sense than checking every time.
-    for c in _choppables_for_aps(aps):
+    choppables = _choppables_for_aps(aps)
+    for c in choppables:
         val = _choppable_get(aps, c)
-        if isinstance(val, str):
+        if isinstance(val, bytes):
             _choppable_put(aps, c, val.decode('utf8'))
 
-    # chop off whole unicode characters until it fits (or we run out of chars)
-    while is_too_long(payload, max_length):
-        longest = _longest_choppable(aps)
-        if longest is None:
-            raise BodyTooLongException()
+    encoded = json_for_payload(payload)
+    overshoot = len(encoded) - max_length
+    if overshoot <= 0:
+        return payload, encoded, False
+
+    # We chop off whole unicode characters, one at a time from whichever
+    # choppable is longest, until it fits. Rather than encoding the payload
+    # after every character, work out the order the characters would be
+    # chopped in and binary search for the fewest chops that make it fit.
+    originals = [_choppable_get(aps, c) for c in choppables]
+    chop_order = _chop_order(originals)
+
+    def chop(num_chops):
+        lengths = [len(o) for o in originals]
+        for i in chop_order[:num_chops]:
+            lengths[i] -= 1
+        for c, o, l in zip(choppables, originals, lengths):
+            # Note that python's support for this is actually broken on some OSes
+            # (see test_truncate.py)
+            _choppable_put(aps, c, o[:l])
+
+    # Every character we chop makes the JSON at most
+    # MAX_ENCODED_CHAR_LENGTH bytes shorter, so we need at least this many
+    lo = min(len(chop_order), (overshoot - 1) // MAX_ENCODED_CHAR_LENGTH + 1)
+    hi = len(chop_order)
+    chop(hi)
+    if is_too_long(payload, max_length):
+        raise BodyTooLongException()
+
+    # invariant: chopping hi characters fits, chopping fewer than lo doesn't
+    while lo < hi:
+        mid = (lo + hi) // 2
+        chop(mid)
+        if is_too_long(payload, max_length):
+            lo = mid + 1
+        else:
+            hi = mid
+    chop(hi)
+
+    return payload, json_for_payload(payload), True
+
 
-        txt = _choppable_get(aps, longest)
-        # Note that python's support for this is actually broken on some OSes
-        # (see test_truncate.py)
-        txt = txt[:-1]
-        _choppable_put(aps, longest, txt)
-        payload['aps'] = aps
+def _copy_aps(aps):
+    aps = aps.copy()
+    if isinstance(aps.get('alert'), dict):
+        aps['alert'] = aps['alert'].copy()
+        if 'loc-args' in aps['alert']:
+            aps['alert']['loc-args'] = list(aps['alert']['loc-args'])
+    return aps
 
-    return payload
+
+def _chop_order(vals):
+    """
+    Returns a list of the indexes into vals of the strings we would chop
+    a character from, in order, if we repeatedly chopped the last character
+    off the longest (in UTF-8 bytes) string, picking the first in the list
+    if several are the longest.
+    """
+    char_lengths = [[_utf8_len(ch) for ch in v] for v in vals]
+    heap = [(-sum(lens), i) for i, lens in enumerate(char_lengths) if len(lens) > 0]
+    heapq.heapify(heap)
+    order = []
+    while heap:
+        neg_len, i = heapq.heappop(heap)
+        order.append(i)
+        lens = char_lengths[i]
+        remaining = -neg_len - lens.pop()
+        if len(lens) > 0:
+            heapq.heappush(heap, (-remaining, i))
+    return order
+
+
+def _utf8_len(ch):
+    cp = ord(ch)
+    if cp < 0x80:
+        return 1
+    elif cp < 0x800:
+        return 2
+    elif cp < 0x10000:
+        return 3
+    else:
+        return 4
 
 
 def _choppables_for_aps(aps):
@@ -68,7 +161,7 @@ def _choppables_for_aps(aps):
         return ret
 
     alert = aps['alert']
-    if isinstance(alert, str) or isinstance(alert, unicode):
+    if isinstance(alert, TEXT_TYPES):
         ret.append(('alert',))
     elif isinstance(alert, dict):
         if 'body' in alert:
@@ -95,15 +188,3 @@ def _choppable_put(aps, choppable, val):
         aps['alert']['body'] = val
     elif choppable[0] == 'alert.loc-args':
         aps['alert']['loc-args'][choppable[1]] = val
-
-
-def _longest_choppable(aps):
-    longest = None
-    length_of_longest = 0
-    for c in _choppables_for_aps(aps):
-        val = _choppable_get(aps, c)
-        val_len = len(val.encode('utf8'))
-        if val_len > length_of_longest:
-            longest = c
-            length_of_longest = val_len
-    return longest
@@ -0,0 +1,198 @@
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from pushbaby import InvalidTokenException
+from pushbaby.fakegateway import FRAME_HEADER, _parse_frame
+import pushbaby.errors
+
+try:
+    import asyncio
+    from pushbaby.aio import AsyncPushBaby
+except (ImportError, SyntaxError):
+    # Python 2
+    asyncio = None
+
+import json
+import struct
+
+
+class GatewayProtocol(asyncio.Protocol if asyncio is not None else object):
+    def __init__(self, gateway):
+        self.gateway = gateway
+        self.buf = bytearray()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.gateway.transports.add(transport)
+
+    def connection_lost(self, exc):
+        self.gateway.transports.discard(self.transport)
+
+    def data_received(self, data):
+        self.buf.extend(data)
+        while len(self.buf) >= FRAME_HEADER.size:
+            (command, framelen) = FRAME_HEADER.unpack_from(self.buf, 0)
+            if len(self.buf) < FRAME_HEADER.size + framelen:
+                return
+            push = _parse_frame(bytes(self.buf[FRAME_HEADER.size:FRAME_HEADER.size + framelen]))
+            del self.buf[:FRAME_HEADER.size + framelen]
+            if not push.get('token'):
+                status = pushbaby.errors.MISSING_TOKEN
+            else:
+                self.gateway.pushes.append(push)
+                status = self.gateway.fail_seqs.pop(push['seq'], None)
+            if status is not None:
+                self.transport.write(struct.pack("!BBI", 8, status, push['seq']))
+                self.transport.close()
+                return
+
+
+class AsyncFakeGateway:
+    """
+    Enough of FakeGateway, on an asyncio loop, to test AsyncPushBaby with.
+    """
+    def __init__(self, loop, protocol=GatewayProtocol):
+        self.loop = loop
+        self.protocol = protocol
+        self.pushes = []
+        self.fail_seqs = {}
+        self.transports = set()
+        self.server = None
+
+    def start(self):
+        self.server = self.loop.run_until_complete(
+            self.loop.create_server(lambda: self.protocol(self), 'localhost', 0)
+        )
+
+    def stop(self):
+        self.server.close()
+        for t in list(self.transports):
+            t.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+
+    def get_addr(self):
+        return self.server.sockets[0].getsockname()[:2]
+
+
+class FeedbackProtocol(asyncio.Protocol if asyncio is not None else object):
+    def __init__(self, gateway):
+        self.gateway = gateway
+
+    def connection_made(self, transport):
+        transport.write(b''.join([struct.pack("!IH", ts, len(tok)) + tok for (tok, ts) in self.gateway.pushes]))
+        transport.close()
+
+
+@unittest.skipIf(asyncio is None, "the asyncio backend needs Python 3")
+class AsyncPushBabyTestCase(unittest.TestCase):
+    def on_push_failed(self, token, identifier, status):
+        self.failures.append((token, identifier, status))
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.srv = AsyncFakeGateway(self.loop)
+        self.srv.start()
+        self.failures = []
+        self.pushbabies = []
+
+    def tearDown(self):
+        for pb in self.pushbabies:
+            pb.close()
+        self.srv.stop()
+        # let the transports finish closing
+        self.wait(0)
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def complete(self, coro):
+        return self.loop.run_until_complete(asyncio.wait_for(coro, 1))
+
+    def call_on_loop(self, fn):
+        """
+        Returns what fn returns when called on the running loop, as
+        send_async() has to be.
+        """
+        result = self.loop.create_future()
+        self.loop.call_soon(lambda: result.set_result(fn()))
+        return self.loop.run_until_complete(result)
+
+    def wait(self, secs=0.1):
+        self.loop.run_until_complete(asyncio.sleep(secs))
+
+    def make_pushbaby(self, **kwargs):
+        pb = AsyncPushBaby(certfile=None, platform=self.srv.get_addr(), **kwargs)
+        pb.on_push_failed = self.on_push_failed
+        self.pushbabies.append(pb)
+        return pb
+
+    def test_send(self):
+        pb = self.make_pushbaby()
+        self.complete(pb.send({'aps': {'alert': u'1'}}, b'1', priority=10))
+        self.wait()
+        self.assertEqual(1, len(self.srv.pushes))
+        p = self.srv.pushes[0]
+        self.assertEqual(b'1', p['token'])
+        self.assertEqual(u'1', json.loads(p['payload'].decode('utf8'))['aps']['alert'])
+        self.assertEqual(10, p['priority'])
+        self.assertEqual(0, p['seq'])
+
+    def test_fail_seq(self):
+        pb = self.make_pushbaby(bad_token_cache_size=10)
+        self.srv.fail_seqs[1] = pushbaby.errors.INVALID_TOKEN
+        results = self.complete(pb.send_many([
+            {'payload': {'aps': {'alert': u'%d' % i}}, 'token': str(i).encode('ascii'), 'identifier': i}
+            for i in range(3)
+        ]))
+        self.assertEqual([None, None, None], results)
+        self.wait()
+        self.assertEqual([(b'1', 1, pushbaby.errors.INVALID_TOKEN)], self.failures)
+        # the push after the failed one is sent again on a new connection
+        self.assertEqual([b'0', b'1', b'2'], [p['token'] for p in self.srv.pushes])
+        self.assertEqual(0, self.srv.pushes[-1]['seq'])
+        with self.assertRaises(InvalidTokenException):
+            self.complete(pb.send({'aps': {}}, b'1'))
+
+    def test_send_async(self):
+        pb = self.make_pushbaby()
+        self.srv.fail_seqs[0] = pushbaby.errors.INVALID_TOKEN
+        res = self.call_on_loop(lambda: pb.send_async({'aps': {'alert': u'1'}}, b'1'))
+        self.assertEqual(pushbaby.errors.INVALID_TOKEN, self.complete(res))
+
+    def test_drain(self):
+        pb = self.make_pushbaby()
+        results = self.call_on_loop(lambda: [
+            pb.send_async({'aps': {'alert': u'%d' % i}}, str(i).encode('ascii')) for i in range(3)
+        ])
+        self.wait()
+        self.assertTrue(pb.messages_in_flight())
+        self.assertTrue(self.complete(pb.drain(timeout=1)))
+        self.assertEqual([pushbaby.errors.NO_ERROR] * 3, [r.result() for r in results])
+        self.assertEqual(3, len(self.srv.pushes))
+        self.assertFalse(pb.messages_in_flight())
+
+    def test_feedback(self):
+        fbsrv = AsyncFakeGateway(self.loop, protocol=FeedbackProtocol)
+        fbsrv.pushes = [(b'a', 1000), (b'b', 1001)]
+        fbsrv.start()
+        pb = self.make_pushbaby(bad_token_cache_size=10)
+        pb.fbaddress = fbsrv.get_addr()
+        try:
+            got = self.complete(pb.get_all_feedback())
+        finally:
+            fbsrv.stop()
+        self.assertEqual([(b'a', 1000.0), (b'b', 1001.0)], [(fb.token, fb.ts) for fb in got])
+        self.assertTrue(pb._is_bad_token(b'a'))
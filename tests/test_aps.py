@@ -29,4 +29,4 @@ class ApsTestCase(unittest.TestCase):
         # doesn't put unneccesary space after commas and colons.
         shortest_encoding = u"{\"aps\":{\"alert\":\"\U0001F414\"}}".encode('utf8')
 
-        self.assertEquals(shortest_encoding, json_with_multibyte)
+        self.assertEqual(shortest_encoding, json_with_multibyte)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from pushbaby import PushBaby
+from pushbaby.feedbackpoller import FeedbackPoller
+
+import gevent
+import gevent.socket
+
+import struct
+import time
+
+
+class DummyFeedbackServer:
+    """
+    dummy (non-ssl) feedback server that sends some feedback to the
+    first client and hangs up
+    """
+
+    def __init__(self, items, chunk_size):
+        self.items = items
+        self.chunk_size = chunk_size
+
+    def start(self):
+        self.sock = gevent.socket.socket(gevent.socket.AF_INET, gevent.socket.SOCK_STREAM)
+        self.sock.bind(('localhost', 0))
+        self.sock.listen(1)
+        self.greenlet = gevent.spawn(self.serve)
+
+    def stop(self):
+        self.greenlet.kill()
+        self.sock.close()
+
+    def serve(self):
+        (clisock, addr) = self.sock.accept()
+        data = b''.join([struct.pack("!IH", ts, len(tok)) + tok for (tok, ts) in self.items])
+        for i in range(0, len(data), self.chunk_size):
+            clisock.sendall(data[i:i + self.chunk_size])
+            gevent.sleep(0)
+        clisock.close()
+
+    def get_addr(self):
+        return self.sock.getsockname()
+
+
+class FeedbackTestCase(unittest.TestCase):
+    def test_iter_feedback(self):
+        items = [(('%032d' % i).encode('ascii'), 1000 + i) for i in range(500)]
+        # send in chunks that split items down the middle
+        srv = DummyFeedbackServer(items, 7)
+        srv.start()
+        try:
+            pb = PushBaby(certfile=None, platform=('localhost', 2195), feedback_address=srv.get_addr())
+            got = [(fb.token, fb.ts) for fb in pb.iter_feedback()]
+        finally:
+            srv.stop()
+        self.assertEqual([(tok, float(ts)) for (tok, ts) in items], got)
+
+    def test_poller_dedupes(self):
+        now = int(time.time())
+        items = [(b'a', now), (b'b', now), (b'a', now), (b'a', now + 1)]
+        srv = DummyFeedbackServer(items, 100)
+        srv.start()
+        batches = []
+        try:
+            pb = PushBaby(certfile=None, platform=('localhost', 2195), feedback_address=srv.get_addr())
+            pb.on_feedback = batches.append
+            poller = FeedbackPoller(pb, 3600, 0)
+            poller.poll()
+        finally:
+            srv.stop()
+        self.assertEqual(1, len(batches))
+        self.assertEqual([(b'a', now), (b'b', now), (b'a', now + 1)], [(fb.token, fb.ts) for fb in batches[0]])
+
+        # we don't report the same feedback again in the next run
+        srv = DummyFeedbackServer(items + [(b'c', now)], 100)
+        srv.start()
+        try:
+            pb.fbaddress = srv.get_addr()
+            poller.poll()
+        finally:
+            srv.stop()
+        self.assertEqual([(b'c', now)], [(fb.token, fb.ts) for fb in batches[1]])
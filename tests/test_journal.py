@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from pushbaby.journal import Journal
+from pushbaby.preparedpayload import PreparedPayload
+
+import os
+import shutil
+import tempfile
+
+
+class JournalTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_recover(self):
+        journal = Journal(self.dir)
+        payload = PreparedPayload({'aps': {'alert': u'hello'}})
+        jids = [
+            journal.record_push(b'tok%d' % i, payload, 1234567890, 10, {'n': i})
+            for i in range(3)
+        ]
+        journal.record_settled(jids[1], 0)
+        journal.close()
+
+        journal = Journal(self.dir)
+        recovered = journal.recovered()
+        self.assertEqual([jids[0], jids[2]], [jp.jid for jp in recovered])
+        self.assertEqual(b'tok0', recovered[0].token)
+        self.assertEqual(payload.item, recovered[0].payload.item)
+        self.assertEqual(1234567890, recovered[0].expiration)
+        self.assertEqual(10, recovered[0].priority)
+        self.assertEqual({'n': 0}, recovered[0].identifier)
+        # only handed out once
+        self.assertEqual([], journal.recovered())
+
+        # settling recovered pushes works across restarts, and new pushes
+        # don't reuse their ids
+        journal.record_settled(jids[0], 0)
+        jid = journal.record_push(b'tok3', payload, None, None, object())
+        self.assertTrue(jid > jids[2])
+        journal.close()
+
+        journal = Journal(self.dir)
+        recovered = journal.recovered()
+        self.assertEqual([jids[2], jid], [jp.jid for jp in recovered])
+        self.assertIsNone(recovered[1].expiration)
+        self.assertIsNone(recovered[1].identifier)
+        journal.close()
+
+    def test_segments(self):
+        journal = Journal(self.dir, segment_bytes=1)
+        payload = PreparedPayload({'aps': {'alert': u'hello'}})
+        first = journal.record_push(b'tok', payload, None, None, None)
+        journal._flush()
+        second = journal.record_push(b'tok', payload, None, None, None)
+        journal._flush()
+        self.assertEqual(3, len(os.listdir(self.dir)))
+
+        # the second push's segment can't go before the first's: newer
+        # segments may have records of older pushes settling
+        journal.record_settled(second, 0)
+        journal._flush()
+        self.assertEqual(4, len(os.listdir(self.dir)))
+        journal.record_settled(first, 0)
+        journal._flush()
+        self.assertEqual(1, len(os.listdir(self.dir)))
+        journal.close()
+
+        journal = Journal(self.dir)
+        self.assertEqual([], journal.recovered())
+        journal.close()
@@ -15,93 +15,32 @@
 
 import unittest
 
-from pushbaby import PushBaby
+from pushbaby import PushBaby, PreparedPayload, InvalidTokenException, PushBabyClosedException
+from pushbaby import PushExpiredException
+from pushbaby.truncate import BodyTooLongException
+from pushbaby.metrics import MemoryMetricsSink
+from pushbaby.fakegateway import FakeGateway, make_self_signed_cert
+from pushbaby.journal import Journal
+from pushbaby.pushconnection import PushConnection
+from pushbaby.pushprotocol import PushProtocol, ConnectionDeadException
+import pushbaby.errors
+import pushbaby.pushconnection
+import pushbaby.tcpinfo
 
-import gevent.socket
+import gevent
 import gevent.event
+import gevent.ssl
 
-import struct
 import logging
 import json
+import shutil
+import socket
+import tempfile
 import time
 
 logging.basicConfig(level=logging.DEBUG)
 
 
-class DummyPushServer:
-    """
-    dummy (non-ssl) push server
-    """
-
-    def __init__(self, ut):
-        self.ut = ut
-        self.cs = None
-        self.csevent = gevent.event.Event()
-        self.listen_greenlet = None
-        self.reject_code = None
-
-    def start(self):
-        self.sock = gevent.socket.socket(gevent.socket.AF_INET, gevent.socket.SOCK_STREAM)
-        self.sock.bind(('localhost', 0))
-        self.sock.listen(1)
-        self.listen_greenlet = gevent.spawn(self.listen_loop)
-
-    def stop(self):
-        self.listen_greenlet.kill()
-        self.sock.close()
-        if self.cs:
-            self.cs.close()
-
-    def listen_loop(self):
-        while True:
-            (clisock, addr) = self.sock.accept()
-            self.cs = clisock
-            self.csevent.set()
-
-    def get_push(self):
-        self.csevent.wait(timeout=0.1)
-        command = struct.unpack("!B", self.cs.recv(1))[0]
-        if command != 2:
-            self.ut.fail("Got unknown command: %d" % (command,))
-        rawlen = self.cs.recv(4)
-        framelen = struct.unpack("!I", rawlen)[0]
-        frame = self.cs.recv(framelen)
-        offset = 0
-        push = {}
-        rawid = None
-        while offset < framelen:
-            itemid = struct.unpack("!B", frame[offset])[0]
-            offset += 1
-            itemdatalen = struct.unpack("!H", frame[offset:offset+2])[0]
-            offset += 2
-            itemdata = frame[offset:offset+itemdatalen]
-            offset += itemdatalen
-            if itemid == 1:
-                push['token'] = itemdata
-            elif itemid == 2:
-                push['payload'] = itemdata
-            elif itemid == 3:
-                rawid = itemdata
-            elif itemid == 4:
-                push['expiration'] = struct.unpack("!I", itemdata)[0]
-            elif itemid == 5:
-                push['priority'] = struct.unpack("!B", itemdata)[0]
-
-        if self.reject_code is not None:
-            self.cs.send(struct.pack("!BB", 8, self.reject_code)+rawid)
-            self.cs.close()
-            self.cs = None
-            self.csevent.clear()
-
-        return push
-
-    def get_addr(self):
-        return self.sock.getsockname()
-
-    def set_reject_code(self, rc):
-        self.reject_code = rc
-
-
 class ConnectionTestCase(unittest.TestCase):
     def on_push_failed(self, token, identifier, status):
         self.failure = (status, token, identifier, status)
@@ -110,7 +49,7 @@ class ConnectionTestCase(unittest.TestCase):
     def setUp(self):
         self.failure_event = gevent.event.Event()
         self.failure = None
-        self.srv = DummyPushServer(self)
+        self.srv = FakeGateway()
         self.srv.start()
 
     def tearDown(self):
@@ -119,43 +58,496 @@ class ConnectionTestCase(unittest.TestCase):
     def test_retry(self):
         pb = PushBaby(certfile=None, platform=self.srv.get_addr())
         pb.on_push_failed = self.on_push_failed
-        pb.send({'aps': {'alert': u'1'}}, '1')
+        pb.send({'aps': {'alert': u'1'}}, b'1')
         self.srv.get_push()
-        self.assertEquals(None, self.failure)
+        self.assertEqual(None, self.failure)
         self.srv.set_reject_code(10)
-        pb.send({'aps': {'alert': u'2'}}, '2')
-        pb.send({'aps': {'alert': u'3'}}, '3')
+        pb.send({'aps': {'alert': u'2'}}, b'2')
+        pb.send({'aps': {'alert': u'3'}}, b'3')
         self.assertIsNotNone(self.srv.get_push())
         self.srv.set_reject_code(None)
         # we should not be notified about this failure,
         # it should just get resent
-        self.assertEquals(None, self.failure)
+        self.assertEqual(None, self.failure)
         p = self.srv.get_push()
         aps = json.loads(p['payload'])['aps']
-        self.assertEquals(u'2', aps['alert'])
-        self.assertEquals(u'2', p['token'])
+        self.assertEqual(u'2', aps['alert'])
+        self.assertEqual(b'2', p['token'])
         # as should the one we sent subsequently
         p = self.srv.get_push()
         aps = json.loads(p['payload'])['aps']
-        self.assertEquals(u'3', aps['alert'])
-        self.assertEquals(u'3', p['token'])
+        self.assertEqual(u'3', aps['alert'])
+        self.assertEqual(b'3', p['token'])
 
     def test_failure(self):
         pb = PushBaby(certfile=None, platform=self.srv.get_addr())
         pb.on_push_failed = self.on_push_failed
         myid = 'some identifier'
         self.srv.set_reject_code(8)
-        pb.send({'aps': {'alert': u'1'}}, '1', identifier=myid)
+        pb.send({'aps': {'alert': u'1'}}, b'1', identifier=myid)
         self.srv.get_push()
         self.failure_event.wait(timeout=0.1)
         self.assertIsNotNone(self.failure)
         self.assertIs(myid, self.failure[2])
 
+    def test_fail_seq(self):
+        pb = PushBaby(certfile=None, platform=self.srv.get_addr())
+        pb.on_push_failed = self.on_push_failed
+        self.srv.fail_seq(1, 8)
+        pb.send_many([
+            {'payload': {'aps': {'alert': u'%d' % i}}, 'token': str(i).encode('ascii'), 'identifier': i}
+            for i in range(3)
+        ])
+        self.assertEqual([b'0', b'1'], [self.srv.get_push()['token'] for i in range(2)])
+        self.failure_event.wait(timeout=0.1)
+        self.assertEqual(1, self.failure[2])
+        # the push after the failed one is sent again on a new connection
+        p = self.srv.get_push()
+        self.assertEqual(b'2', p['token'])
+        self.assertEqual(0, p['seq'])
+
+    def test_bad_token_cache(self):
+        pb = PushBaby(certfile=None, platform=self.srv.get_addr(), bad_token_cache_size=10)
+        pb.on_push_failed = self.on_push_failed
+        self.srv.set_reject_code(8)
+        pb.send({'aps': {'alert': u'1'}}, b'1')
+        self.srv.get_push()
+        self.failure_event.wait(timeout=0.1)
+        self.assertIsNotNone(self.failure)
+        self.assertRaises(InvalidTokenException, pb.send, {'aps': {'alert': u'2'}}, b'1')
+        self.assertEqual(8, pb.send_async({'aps': {'alert': u'2'}}, b'1').get(timeout=0))
+        pb.bad_tokens.discard(b'1')
+        self.assertFalse(pb._is_bad_token(b'1'))
+
+    def test_async_failure(self):
+        pb = PushBaby(certfile=None, platform=self.srv.get_addr())
+        pb.on_push_failed = self.on_push_failed
+        self.srv.set_reject_code(8)
+        res = pb.send_async({'aps': {'alert': u'1'}}, b'1')
+        self.srv.get_push()
+        self.assertEqual(8, res.get(timeout=0.1))
+
+    def test_prepared_payload(self):
+        pb = PushBaby(certfile=None, platform=self.srv.get_addr())
+        pb.on_push_failed = self.on_push_failed
+        prepared = PreparedPayload({'aps': {'alert': u'1'}})
+        pb.send(prepared, b'1')
+        pb.send_many([{'payload': prepared, 'token': b'2'}])
+        for token in [b'1', b'2']:
+            p = self.srv.get_push()
+            self.assertEqual(token, p['token'])
+            self.assertEqual(u'1', json.loads(p['payload'])['aps']['alert'])
+
+    def test_metrics(self):
+        metrics = MemoryMetricsSink()
+        pb = PushBaby(certfile=None, platform=self.srv.get_addr(), metrics=metrics)
+        pb.on_push_failed = self.on_push_failed
+        pb.send({'aps': {'alert': u'1' * 4096}}, b'1')
+        self.srv.get_push()
+        self.srv.set_reject_code(8)
+        pb.send({'aps': {'alert': u'2'}}, b'2')
+        self.srv.get_push()
+        self.failure_event.wait(timeout=0.1)
+        self.assertEqual(2, metrics.counters['pushes_sent'])
+        self.assertEqual(1, metrics.counters['pushes_truncated'])
+        self.assertEqual(1, metrics.counters['pushes_failed{status=8}'])
+        self.assertEqual(1, metrics.counters['connections_opened'])
+        self.assertEqual(1, metrics.counters['connections_retired'])
+        self.assertEqual(2, len(metrics.observations['enqueue_to_write_seconds']))
+        self.assertEqual(1, len(metrics.observations['handshake_seconds']))
+
+    def test_drain(self):
+        pb = PushBaby(certfile=None, platform=self.srv.get_addr())
+        pb.on_push_failed = self.on_push_failed
+        res = [pb.send_async({'aps': {'alert': u'%d' % i}}, str(i).encode('ascii')) for i in range(3)]
+        start = time.time()
+        self.assertTrue(pb.drain(timeout=5))
+        # we don't wait for the error window to pass
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual([0, 0, 0], [r.get(timeout=0) for r in res])
+        self.assertEqual(3, self.srv.num_pushes)
+        self.assertFalse(pb.messages_in_flight())
+        self.assertRaises(PushBabyClosedException, pb.send, {'aps': {'alert': u'4'}}, b'4')
+
+    def test_drain_connection_dropped(self):
+        pb = PushBaby(certfile=None, platform=self.srv.get_addr())
+        res = [pb.send_async({'aps': {'alert': u'%d' % i}}, str(i).encode('ascii')) for i in range(3)]
+        for _ in range(3):
+            self.srv.get_push()
+        # the connection drops rather than the gateway failing the probe
+        conn = pb.conns[0]
+        conn._send_probe = conn._close_connection
+        self.assertFalse(pb.drain(timeout=5))
+        for r in res:
+            self.assertRaises(ConnectionDeadException, r.get, timeout=0)
+
+    def test_warm_connections(self):
+        metrics = MemoryMetricsSink()
+        pb = PushBaby(certfile=None, platform=self.srv.get_addr(), metrics=metrics, warm_connections=1)
+        self.assertEqual(1, len(pb.conns))
+        warm = pb.conns[0]
+        while not warm.is_open():
+            gevent.sleep(0.01)
+
+        pb.send({'aps': {'alert': u'1'}}, b'1')
+        self.srv.get_push()
+        self.assertEqual(1, metrics.counters['connections_opened'])
+
+        # a replacement is opened as soon as the connection retires
+        warm._retire_connection()
+        self.assertEqual(2, len(pb.conns))
+        replacement = pb.conns[1]
+        while not replacement.is_open():
+            gevent.sleep(0.01)
+        pb.send({'aps': {'alert': u'2'}}, b'2')
+        self.assertEqual(b'2', self.srv.get_push()['token'])
+        self.assertEqual(2, metrics.counters['connections_opened'])
+        self.assertEqual(0, replacement.seq)
+
+    def test_idle_warm_connections(self):
+        metrics = MemoryMetricsSink()
+        orig_idle = PushProtocol.MAX_CONN_IDLE_SEC
+        PushProtocol.MAX_CONN_IDLE_SEC = 1
+        try:
+            pb = PushBaby(certfile=None, platform=self.srv.get_addr(), metrics=metrics, warm_connections=2)
+            gevent.sleep(2.5)
+            # the warm connections aren't retired when idle, so we don't
+            # keep reconnecting
+            self.assertEqual(2, metrics.counters['connections_opened'])
+            self.assertEqual(0, metrics.counters['connections_retired'])
+            self.assertTrue(all(c.useable for c in pb.conns))
+            # and keepalives notice if the gateway goes away meanwhile
+            for c in pb.conns:
+                self.assertNotEqual(0, c.sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE))
+
+            # others are, and close straight away with nothing in flight
+            extra = pb._new_connection()
+            pb.conns.append(extra)
+            extra.open()
+            extra.opened_at -= 2
+            extra._lifecycle()
+            self.assertFalse(extra.alive)
+            self.assertEqual(1, metrics.counters['connections_retired'])
+            # and aren't replaced since there are enough warm ones
+            self.assertEqual(3, metrics.counters['connections_opened'])
+            pb.close()
+        finally:
+            PushProtocol.MAX_CONN_IDLE_SEC = orig_idle
+
+    def test_drained_warm_connection(self):
+        metrics = MemoryMetricsSink()
+        pb = PushBaby(certfile=None, platform=self.srv.get_addr(), metrics=metrics, warm_connections=1)
+        warm = pb.conns[0]
+        while not warm.is_open():
+            gevent.sleep(0.01)
+        # as when the hub reclaims it: it's not replaced
+        warm.drain()
+        warm.closed_event.wait(timeout=1)
+        gevent.sleep(0.1)
+        self.assertFalse(warm.alive)
+        self.assertEqual(1, metrics.counters['connections_opened'])
+        pb.close()
+
+    def test_drain_unopened(self):
+        pb = PushBaby(certfile=None, platform=self.srv.get_addr())
+        conn = PushConnection(pb, pb.address, None, None)
+        errors = []
+        orig_exception = pushbaby.pushconnection.logger.exception
+        pushbaby.pushconnection.logger.exception = lambda *args, **kwargs: errors.append(args)
+        try:
+            conn.drain()
+        finally:
+            pushbaby.pushconnection.logger.exception = orig_exception
+        self.assertFalse(conn.alive)
+        self.assertEqual([], errors)
+
+    def test_no_user_timeout(self):
+        pb = PushBaby(certfile=None, platform=self.srv.get_addr())
+        pb._new_connection = lambda: NoUserTimeoutConnection(pb, pb.address, None, None)
+        pb.send({'aps': {'alert': u'1'}}, b'1')
+        self.assertEqual(b'1', self.srv.get_push()['token'])
+        conn = pb.conns[0]
+        # without TCP_USER_TIMEOUT we fall back to keepalives and timing out writes
+        self.assertNotEqual(0, conn.sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE))
+        self.assertEqual(PushConnection.CONN_TIMEOUT, conn.write_timeout)
+
+    @unittest.skipUnless(hasattr(gevent.ssl.SSLSocket, 'session'), "TLS sessions need Python 3.6")
+    def test_tls_session_resumed(self):
+        certdir = tempfile.mkdtemp()
+        try:
+            certfile, keyfile = make_self_signed_cert(certdir)
+            srv = FakeGateway(certfile=certfile, keyfile=keyfile)
+            srv.start()
+            try:
+                pb = PushBaby(certfile=certfile, keyfile=keyfile, platform=srv.get_addr())
+                reused = []
+                for i in range(3):
+                    pb.send({'aps': {'alert': u'%d' % i}}, str(i).encode('ascii'))
+                    srv.get_push()
+                    conn = pb.conns[0]
+                    reused.append(conn.sock.session_reused)
+                    # TLS 1.3 session tickets arrive after the handshake
+                    while not conn.sock.session.has_ticket:
+                        gevent.sleep(0.01)
+                    conn._close_connection()
+                    gevent.sleep(0)
+                self.assertEqual([False, True, True], reused)
+            finally:
+                srv.stop()
+        finally:
+            shutil.rmtree(certdir)
+
+    def test_expired(self):
+        pb = PushBaby(certfile=None, platform=self.srv.get_addr())
+        expired = []
+        pb.on_push_expired = lambda token, identifier: expired.append((token, identifier))
+        res = pb.send_async({'aps': {'alert': u'1'}}, b'1', expiration=time.time() - 1, identifier='x')
+        pb.send({'aps': {'alert': u'2'}}, b'2', expiration=time.time() + 3600)
+        self.assertEqual(b'2', self.srv.get_push()['token'])
+        self.assertRaises(PushExpiredException, res.get, timeout=0)
+        self.assertEqual([(b'1', 'x')], expired)
+        self.assertEqual(1, self.srv.num_pushes)
+
+    def test_journal_recover(self):
+        jdir = tempfile.mkdtemp()
+        try:
+            # a previous run that died with a push unsettled
+            journal = Journal(jdir)
+            journal.record_push(b'1', PreparedPayload({'aps': {'alert': u'1'}}), None, None, 'x')
+            journal.close()
+
+            pb = PushBaby(certfile=None, platform=self.srv.get_addr(), journal=Journal(jdir))
+            self.assertEqual(1, pb.recover())
+            p = self.srv.get_push()
+            self.assertEqual(b'1', p['token'])
+            pb.send({'aps': {'alert': u'2'}}, b'2')
+            self.srv.get_push()
+            self.assertTrue(pb.drain(timeout=5))
+
+            journal = Journal(jdir)
+            self.assertEqual([], journal.recovered())
+            journal.close()
+        finally:
+            shutil.rmtree(jdir)
+
     def test_params(self):
         pb = PushBaby(certfile=None, platform=self.srv.get_addr())
         pb.on_push_failed = self.on_push_failed
         exp = time.time() + 3600
-        pb.send({'aps': {'alert': u'1'}}, '1', priority=5, expiration=exp)
+        pb.send({'aps': {'alert': u'1'}}, b'1', priority=5, expiration=exp)
         p = self.srv.get_push()
-        self.assertEquals(5, p['priority'])
-        self.assertEquals(long(exp), p['expiration'])
+        self.assertEqual(5, p['priority'])
+        self.assertEqual(int(exp), p['expiration'])
+
+    def test_send_many(self):
+        pb = PushBaby(certfile=None, platform=self.srv.get_addr())
+        pb.on_push_failed = self.on_push_failed
+        res = pb.send_many([
+            {'payload': {'aps': {'alert': u'1'}}, 'token': b'1'},
+            {'payload': {'toolong': 'x' * 4096}, 'token': b'2'},
+            {'payload': {'aps': {'alert': u'3'}}, 'token': b'3', 'priority': 10},
+        ])
+        self.assertIsNone(res[0])
+        self.assertIsInstance(res[1], BodyTooLongException)
+        self.assertIsNone(res[2])
+        self.assertEqual(b'1', self.srv.get_push()['token'])
+        p = self.srv.get_push()
+        self.assertEqual(b'3', p['token'])
+        self.assertEqual(10, p['priority'])
+
+
+class BoundedQueueTestCase(unittest.TestCase):
+    def test_connection_dropped(self):
+        pb = PushBaby(certfile=None, platform=('localhost', 2195))
+        conn = PushConnection(pb, pb.address, None, None, max_queue_size=1)
+        conn.sock = StubSocket()
+        # the writer isn't running, so the queue stays full
+        queued = conn.send_async({'aps': {}}, b'0')
+        senders = [gevent.spawn(conn.send_async, {'aps': {}}, str(i).encode('ascii')) for i in range(1, 4)]
+        gevent.sleep(0)
+        self.assertFalse(any(g.ready() for g in senders))
+
+        conn._close_connection()
+        gevent.joinall(senders, timeout=1)
+        # everyone waiting for room finds out, so they can try elsewhere
+        for g in senders:
+            self.assertIsInstance(g.exception, ConnectionDeadException)
+        # and the writer fails what was queued, then finishes
+        writer = gevent.spawn(conn._write_loop)
+        writer.join(timeout=1)
+        self.assertTrue(writer.ready())
+        self.assertRaises(ConnectionDeadException, queued.get, timeout=0)
+
+
+class NoUserTimeoutConnection(PushConnection):
+    def _set_user_timeout(self, sock):
+        return False
+
+
+class StubSocket:
+    def send(self, data):
+        return len(data)
+
+    def close(self):
+        pass
+
+
+class ConnectionLostTestCase(unittest.TestCase):
+    def setUp(self):
+        self.orig_bytes_acked = pushbaby.tcpinfo.bytes_acked
+        self.orig_stream_offset = pushbaby.tcpinfo.stream_offset
+        pushbaby.tcpinfo.bytes_acked = lambda sock: 250
+
+    def tearDown(self):
+        pushbaby.tcpinfo.bytes_acked = self.orig_bytes_acked
+        pushbaby.tcpinfo.stream_offset = self.orig_stream_offset
+
+    def test_resend_unacked(self):
+        pb = PushBaby(certfile=None, platform=('localhost', 2195))
+        resent = []
+        pb._resend = resent.extend
+        conn = PushConnection(pb, pb.address, None, None)
+        conn.sock = StubSocket()
+        conn.track_acks = True
+        payload = PreparedPayload({})
+        sms = [
+            PushConnection.SentMessage(
+                time.time(), str(i).encode('ascii'), payload, None, None, None,
+                result=gevent.event.AsyncResult(), end_offset=(i + 1) * 100
+            )
+            for i in range(4)
+        ]
+        for i, sm in enumerate(sms):
+            conn.sent.add(i, sm)
+
+        conn._connection_lost()
+        gevent.sleep(0)
+        self.assertFalse(conn.alive)
+        # the gateway acknowledged the first two so we can't tell what
+        # happened to them, but it never got the others
+        self.assertEqual(sms[2:], resent)
+        for sm in sms[:2]:
+            self.assertRaises(Exception, sm.result.get, timeout=0)
+        for sm in sms[2:]:
+            self.assertFalse(sm.result.ready())
+
+    def test_ack_within_write(self):
+        pb = PushBaby(certfile=None, platform=('localhost', 2195))
+        resent = []
+        pb._resend = resent.extend
+        conn = PushConnection(pb, pb.address, None, None)
+        conn.sock = StubSocket()
+        conn.track_acks = True
+        results = [gevent.event.AsyncResult() for _ in range(4)]
+        pushes = [
+            conn._push(PreparedPayload({}), str(i).encode('ascii'), result=results[i])
+            for i in range(4)
+        ]
+        framelen = conn._frame_length(b'0', pushes[0]['payload'], None, None)
+        # all four go in one write, which TLS makes a bit longer
+        offsets = [1000, 1000 + 4 * framelen + 50]
+        pushbaby.tcpinfo.stream_offset = lambda sock: offsets.pop(0)
+        conn._reallysend_many(pushes)
+
+        # the gateway acknowledged the first two pushes of the write
+        pushbaby.tcpinfo.bytes_acked = lambda sock: 1000 + 2 * framelen + 10
+        conn._connection_lost()
+        gevent.sleep(0)
+        self.assertEqual([b'2', b'3'], [sm.token for sm in resent])
+        for r in results[:2]:
+            self.assertRaises(Exception, r.get, timeout=0)
+
+
+class StubJournal:
+    def __init__(self):
+        self.settled = {}
+
+    def record_settled(self, jid, status):
+        self.settled[jid] = status
+
+
+class MaxInFlightTestCase(unittest.TestCase):
+    def test_forgotten_push_fails(self):
+        pb = PushBaby(certfile=None, platform=('localhost', 2195))
+        resent = []
+        pb._resend = resent.extend
+        journal = StubJournal()
+        conn = PushConnection(pb, pb.address, None, None, max_in_flight=2)
+        conn.sock = StubSocket()
+        results = [gevent.event.AsyncResult() for _ in range(4)]
+        pushes = [
+            conn._push(PreparedPayload({}), str(i).encode('ascii'), result=results[i], jid=i)
+            for i in range(4)
+        ]
+        seqs, _ = conn._pack_pushes(pushes)
+        conn._record_sent(seqs, pushes, journal)
+        # we stopped waiting to hear about the oldest two, so don't know
+        # whether they were accepted
+        self.assertEqual([pushbaby.errors.UNKNOWN] * 2, [r.get(timeout=0) for r in results[:2]])
+        self.assertEqual({}, journal.settled)
+
+        conn._push_failed(pushbaby.errors.INVALID_TOKEN, 1)
+        gevent.sleep(0)
+        self.assertFalse(conn.useable)
+        # the gateway didn't process anything after the failed push
+        self.assertEqual([b'2', b'3'], [sm.token for sm in resent])
+        self.assertEqual({0: pushbaby.errors.NO_ERROR, 1: pushbaby.errors.INVALID_TOKEN}, journal.settled)
+
+    def test_forgotten_bounded(self):
+        pb = PushBaby(certfile=None, platform=('localhost', 2195))
+        journal = StubJournal()
+        conn = PushConnection(pb, pb.address, None, None, max_in_flight=2)
+        pushes = [
+            conn._push(PreparedPayload({}), str(i).encode('ascii'), jid=i)
+            for i in range(7)
+        ]
+        seqs, _ = conn._pack_pushes(pushes)
+        conn._record_sent(seqs, pushes, journal)
+        # we keep the journal ids of only as many forgotten pushes as
+        # max_in_flight, giving up on the oldest
+        self.assertEqual(2, len(conn.forgotten))
+        self.assertEqual({i: pushbaby.errors.UNKNOWN for i in range(3)}, journal.settled)
+        self.assertGreater(conn.in_flight_footprint(), conn.sent.footprint)
+
+
+class StubConnection:
+    def __init__(self, queued, in_flight, useable=True):
+        self.queued = queued
+        self.in_flight = in_flight
+        self.alive = True
+        self.useable = useable
+        self.draining = False
+
+    def is_open(self):
+        return True
+
+    def queue_depth(self):
+        return self.queued
+
+    def load(self):
+        return self.queued + self.in_flight
+
+
+class PoolTestCase(unittest.TestCase):
+    def test_least_loaded(self):
+        pb = PushBaby(certfile=None, platform=('localhost', 2195), max_connections=3)
+        busy = StubConnection(2, 100)
+        quiet = StubConnection(1, 10)
+        retired = StubConnection(0, 0, useable=False)
+        pb.conns = [busy, quiet, retired]
+        conn, created = pb._get_connection()
+        self.assertIs(quiet, conn)
+        self.assertFalse(created)
+        # retired connections are kept while they're alive
+        self.assertEqual(3, len(pb.conns))
+
+    def test_grow_and_cap(self):
+        pb = PushBaby(certfile=None, platform=('localhost', 2195), max_connections=2)
+        pb.conns = [StubConnection(PushBaby.POOL_GROW_QUEUE_DEPTH, 0)]
+        conn, created = pb._get_connection()
+        self.assertTrue(created)
+        self.assertEqual(2, len(pb.conns))
+
+        pb.conns = [StubConnection(PushBaby.POOL_GROW_QUEUE_DEPTH, 0)] * 2
+        conn, created = pb._get_connection()
+        self.assertFalse(created)
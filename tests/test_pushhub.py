@@ -0,0 +1,117 @@
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from pushbaby import PushHub
+from pushbaby.pushhub import ConnectionBudgetException
+from pushbaby.metrics import MemoryMetricsSink
+from pushbaby.fakegateway import FakeGateway
+
+import gevent
+
+
+class PushHubTestCase(unittest.TestCase):
+    def setUp(self):
+        self.srv = FakeGateway()
+        self.srv.start()
+        self.metrics = MemoryMetricsSink()
+        self.hub = None
+
+    def tearDown(self):
+        if self.hub is not None:
+            self.hub.close()
+        self.srv.stop()
+
+    def make_hub(self, app_ids, **kwargs):
+        self.hub = PushHub(metrics=self.metrics, **kwargs)
+        for app_id in app_ids:
+            self.hub.add_app(app_id, certfile=None, platform=self.srv.get_addr())
+        return self.hub
+
+    def test_send(self):
+        hub = self.make_hub(['a', 'b', 'idle'])
+        hub.send('a', {'aps': {'alert': u'1'}}, b'1')
+        self.assertEqual(b'1', self.srv.get_push()['token'])
+        hub.send('b', {'aps': {'alert': u'2'}}, b'2')
+        self.assertEqual(b'2', self.srv.get_push()['token'])
+
+        # the apps share one timer wheel and idle ones have no connections
+        self.assertIs(hub.timers, hub.get_app('a').timers)
+        self.assertIs(hub.timers, hub.get_app('idle').timers)
+        self.assertEqual([], hub.get_app('idle').conns)
+        self.assertEqual(2, hub.open_connections())
+        self.assertEqual(1, self.metrics.counters['connections_opened{app=a}'])
+        self.assertEqual(1, self.metrics.counters['pushes_sent{app=b}'])
+        self.assertRaises(ValueError, hub.add_app, 'a', certfile=None)
+        # warm connections would sit on the budget
+        self.assertRaises(ValueError, hub.add_app, 'warm', certfile=None, warm_connections=1)
+
+    def open_extra(self, pb):
+        """
+        Opens another connection for pb, as it would when busy.
+        """
+        conn = pb._new_connection()
+        pb.conns.append(conn)
+        conn.open()
+        return conn
+
+    def test_reclaim(self):
+        hub = self.make_hub(['a', 'b'], max_connections=2)
+        hub.send('a', {'aps': {'alert': u'1'}}, b'1')
+        self.srv.get_push()
+        a = hub.get_app('a')
+        self.open_extra(a)
+        a_conns = list(a.conns)
+
+        # b has no connection, so takes one of a's two
+        hub.send('b', {'aps': {'alert': u'2'}}, b'2')
+        self.assertEqual(b'2', self.srv.get_push()['token'])
+        self.assertEqual(1, len([c for c in a_conns if c.alive]))
+        self.assertEqual(2, hub.open_connections())
+        self.assertEqual(1, self.metrics.counters['connections_reclaimed'])
+
+    def test_no_reclaim_back_and_forth(self):
+        orig_wait = PushHub.SLOT_WAIT_SEC
+        PushHub.SLOT_WAIT_SEC = 0.1
+        try:
+            hub = self.make_hub(['a', 'b'], max_connections=3)
+            hub.send('a', {'aps': {'alert': u'1'}}, b'1')
+            hub.send('b', {'aps': {'alert': u'2'}}, b'2')
+            self.open_extra(hub.get_app('a'))
+            conns = set(hub.slotted)
+
+            # b would only end up with as many as a, so waits rather than
+            # taking one, and a mustn't take b's last one either
+            self.assertRaises(ConnectionBudgetException, self.open_extra, hub.get_app('b'))
+            self.assertRaises(ConnectionBudgetException, self.open_extra, hub.get_app('a'))
+            self.assertEqual(conns, hub.slotted)
+            self.assertTrue(all(c.alive for c in conns))
+            self.assertEqual(0, self.metrics.counters['connections_reclaimed'])
+        finally:
+            PushHub.SLOT_WAIT_SEC = orig_wait
+
+    def test_drain(self):
+        hub = self.make_hub(['a', 'b'])
+        res = [
+            hub.send_async(app_id, {'aps': {'alert': u'1'}}, b'1')
+            for app_id in ['a', 'b']
+        ]
+        self.assertTrue(hub.drain(timeout=5))
+        self.assertEqual([0, 0], [r.get(timeout=0) for r in res])
+        self.assertFalse(hub.messages_in_flight())
+        self.assertEqual(0, hub.open_connections())
+        # the timer wheel stops once nothing needs it
+        gevent.sleep(0)
+        self.assertEqual(0, len(hub.timers))
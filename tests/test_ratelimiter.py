@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from pushbaby.ratelimiter import RateLimiter
+
+
+class RateLimiterTestCase(unittest.TestCase):
+    def test_bucket(self):
+        limiter = RateLimiter(100, burst=10)
+        self.assertEqual(0, limiter.acquire(10))
+        # a batch bigger than the bucket goes into debt rather than waiting forever
+        waited = limiter.acquire(20)
+        self.assertAlmostEqual(0.2, waited, delta=0.02)
+
+    def test_adaptive(self):
+        limiter = RateLimiter(1000, adaptive=True)
+        limiter.backoff()
+        self.assertEqual(500, limiter.rate)
+        for _ in range(10):
+            limiter.backoff()
+        self.assertEqual(1000 * RateLimiter.MIN_RATE_FRACTION, limiter.rate)
+        limiter.succeeded(RateLimiter.RECOVERY_PUSHES // 2)
+        self.assertEqual(550, limiter.rate)
+        limiter.succeeded(RateLimiter.RECOVERY_PUSHES)
+        self.assertEqual(1000, limiter.rate)
+
+        fixed = RateLimiter(1000)
+        fixed.backoff()
+        self.assertEqual(1000, fixed.rate)
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+import gevent
+import gevent.queue
+
+from pushbaby.sendscheduler import SendScheduler
+from pushbaby.pushprotocol import ConnectionDeadException
+
+
+class SendSchedulerTestCase(unittest.TestCase):
+    def test_weighted_lanes(self):
+        sched = SendScheduler(weights={10: 2, 5: 1})
+        for i in range(4):
+            sched.put('bulk%d' % i, 5)
+        for i in range(4):
+            sched.put('alert%d' % i, 10)
+        sched.put_last('probe')
+        # unknown priorities go in the next lane down, no priority in the top one
+        sched.put('alert4', None)
+        sched.put('bulk4', 7)
+        self.assertEqual(11, sched.qsize())
+
+        got = [sched.get(block=False) for _ in range(11)]
+        self.assertEqual([
+            'alert0', 'alert1', 'bulk0',
+            'alert2', 'alert3', 'bulk1',
+            'alert4', 'bulk2', 'bulk3', 'bulk4',
+            'probe',
+        ], got)
+        self.assertTrue(sched.empty())
+        self.assertRaises(gevent.queue.Empty, sched.get, timeout=0.01)
+
+    def test_close(self):
+        sched = SendScheduler(maxsize=1)
+        sched.put('job0')
+        putters = [gevent.spawn(sched.put, 'job%d' % i) for i in range(1, 4)]
+        gevent.sleep(0)
+        sched.close()
+        gevent.joinall(putters, timeout=1)
+        # everyone waiting for room is woken to find the queue closed
+        for g in putters:
+            self.assertIsInstance(g.exception, ConnectionDeadException)
+        self.assertRaises(ConnectionDeadException, sched.put, 'job4')
+        # what was queued can still be taken, then get() stops blocking
+        self.assertEqual('job0', sched.get())
+        self.assertRaises(gevent.queue.Empty, sched.get)
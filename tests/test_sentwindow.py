@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from pushbaby.sentwindow import SentWindow
+
+
+class Sent:
+    def __init__(self, sendts):
+        self.sendts = sendts
+
+    def footprint(self):
+        return 10
+
+
+class SentWindowTestCase(unittest.TestCase):
+    def test_get_and_pop(self):
+        w = SentWindow()
+        sms = [Sent(i) for i in range(5)]
+        for i, sm in enumerate(sms):
+            w.add(i + 10, sm)
+        self.assertEqual(5, len(w))
+        self.assertIs(sms[2], w.get(12))
+        self.assertIsNone(w.get(9))
+        self.assertIsNone(w.get(15))
+        self.assertIs(sms[2], w.pop(12))
+        self.assertIsNone(w.get(12))
+        self.assertEqual(4, len(w))
+        self.assertEqual([sms[0], sms[1], sms[3], sms[4]], w.values())
+
+    def test_gaps(self):
+        w = SentWindow()
+        a = Sent(1)
+        b = Sent(2)
+        w.add(3, a)
+        w.add(7, b)
+        self.assertEqual(2, len(w))
+        self.assertIs(b, w.get(7))
+        w.pop(3)
+        self.assertEqual([b], w.values())
+        self.assertIs(b, w.get(7))
+
+    def test_pop_before(self):
+        w = SentWindow()
+        sms = [Sent(i) for i in range(3000)]
+        for i, sm in enumerate(sms):
+            w.add(i, sm)
+        self.assertEqual(30000, w.footprint)
+        self.assertEqual(sms[:1500], w.pop_sent_before(1500))
+        self.assertEqual(sms[1500:2000], w.pop_before_seq(2000))
+        self.assertEqual(1000, len(w))
+        self.assertEqual(10000, w.footprint)
+        self.assertIs(sms[2500], w.get(2500))
+        self.assertEqual(sms[2000:2010], w.pop_oldest(10))
+        self.assertEqual(sms[2010:], w.pop_sent_before(5000))
+        self.assertEqual(0, len(w))
+        w.add(5000, sms[0])
+        self.assertIs(sms[0], w.get(5000))
+
+    def test_pop_newest(self):
+        w = SentWindow()
+        sms = [Sent(i) for i in range(10)]
+        for i, sm in enumerate(sms):
+            w.add(i, sm)
+        w.pop(9)
+        self.assertEqual(sms[6:9], w.pop_newest(lambda sm: sm.sendts >= 6))
+        self.assertEqual(6, len(w))
+        self.assertEqual(60, w.footprint)
+        w.add(10, sms[9])
+        self.assertIs(sms[9], w.get(10))
+        self.assertEqual(sms[:6] + [sms[9]], w.pop_newest(lambda sm: True))
+        self.assertEqual(0, len(w))
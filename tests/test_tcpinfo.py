@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+import pushbaby.tcpinfo
+
+import socket
+import time
+
+
+class TcpInfoTestCase(unittest.TestCase):
+    def test_offsets(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('localhost', 0))
+        listener.listen(1)
+        client = socket.create_connection(listener.getsockname())
+        server, _ = listener.accept()
+        try:
+            start = pushbaby.tcpinfo.stream_offset(client)
+            if start is None:
+                self.skipTest("Kernel can't report acknowledged bytes")
+            client.sendall(b'x' * 1000)
+            self.assertEqual(start + 1000, pushbaby.tcpinfo.stream_offset(client))
+            time.sleep(0.1)
+            self.assertEqual(start + 1000, pushbaby.tcpinfo.bytes_acked(client))
+        finally:
+            server.close()
+            client.close()
+            listener.close()
+
+    @unittest.skipIf(pushbaby.tcpinfo.TIOCOUTQ is None, "Kernel can't report the send queue")
+    def test_offset_never_overestimated(self):
+        # 100 bytes are in flight and get acknowledged whilst we're asking
+        state = {'acked': 1000, 'outq': 100}
+
+        def ack():
+            state['acked'], state['outq'] = 1100, 0
+
+        def bytes_acked(sock):
+            acked = state['acked']
+            ack()
+            return acked
+
+        class StubFcntl:
+            @staticmethod
+            def ioctl(fd, req, buf):
+                outq = state['outq']
+                ack()
+                return pushbaby.tcpinfo.OUTQ.pack(outq)
+
+        orig = (pushbaby.tcpinfo.bytes_acked, pushbaby.tcpinfo.fcntl)
+        pushbaby.tcpinfo.bytes_acked = bytes_acked
+        pushbaby.tcpinfo.fcntl = StubFcntl
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                # at worst we think less has been written than has, so we
+                # never resend what the other end got
+                self.assertLessEqual(pushbaby.tcpinfo.stream_offset(sock), 1100)
+            finally:
+                sock.close()
+        finally:
+            (pushbaby.tcpinfo.bytes_acked, pushbaby.tcpinfo.fcntl) = orig
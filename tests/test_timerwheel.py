@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+import gevent
+
+from pushbaby.timerwheel import TimerWheel
+
+
+class TimerWheelTestCase(unittest.TestCase):
+    def test_order_and_cancel(self):
+        wheel = TimerWheel(tick=0.01, num_slots=4)
+        fired = []
+        wheel.schedule(0.05, lambda: fired.append('late'))
+        wheel.schedule(0.01, lambda: fired.append('early'))
+        cancelled = wheel.schedule(0.02, lambda: fired.append('cancelled'))
+        wheel.cancel(cancelled)
+        self.assertEqual(2, len(wheel))
+        gevent.sleep(0.1)
+        self.assertEqual(['early', 'late'], fired)
+        self.assertEqual(0, len(wheel))
+        # the wheel's greenlet stops when there's nothing left to run
+        self.assertIsNone(wheel.greenlet)
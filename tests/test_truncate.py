@@ -22,12 +22,12 @@ import string
 
 
 def simplestring(length, offset=0):
-    return unicode(''.join([string.lowercase[(i+offset) % len(string.lowercase)] for i in xrange(length)]))
+    return u''.join([string.ascii_lowercase[(i+offset) % len(string.ascii_lowercase)] for i in range(length)])
 
 
 def sillystring(length, offset=0):
     chars = [u"\U0001F430", u"\U0001F431", u"\U0001F432", u"\U0001F433"]
-    return u''.join([chars[(i+offset) % len(chars)] for i in xrange(length)])
+    return u''.join([chars[(i+offset) % len(chars)] for i in range(length)])
 
 
 def payload_for_aps(aps):
@@ -41,7 +41,7 @@ class TruncateTestCase(unittest.TestCase):
         aps = {
             'alert': txt
         }
-        self.assertEquals(txt, truncate(payload_for_aps(aps), 256)['aps']['alert'])
+        self.assertEqual(txt, truncate(payload_for_aps(aps), 256)['aps']['alert'])
 
     def test_truncate_alert(self):
         overhead = len(json_for_payload(payload_for_aps({'alert': ''})))
@@ -49,7 +49,7 @@ class TruncateTestCase(unittest.TestCase):
         aps = {
             'alert': txt
         }
-        self.assertEquals(txt[:5], truncate(payload_for_aps(aps), overhead+5)['aps']['alert'])
+        self.assertEqual(txt[:5], truncate(payload_for_aps(aps), overhead+5)['aps']['alert'])
 
     def test_truncate_alert_body(self):
         overhead = len(json_for_payload(payload_for_aps({'alert': {'body': ''}})))
@@ -59,7 +59,7 @@ class TruncateTestCase(unittest.TestCase):
                 'body': txt
             }
         }
-        self.assertEquals(txt[:5], truncate(payload_for_aps(aps), overhead+5)['aps']['alert']['body'])
+        self.assertEqual(txt[:5], truncate(payload_for_aps(aps), overhead+5)['aps']['alert']['body'])
 
     def test_truncate_loc_arg(self):
         overhead = len(json_for_payload(payload_for_aps({'alert': {'loc-args': ['']}})))
@@ -69,7 +69,7 @@ class TruncateTestCase(unittest.TestCase):
                 'loc-args': [txt]
             }
         }
-        self.assertEquals(txt[:5], truncate(payload_for_aps(aps), overhead+5)['aps']['alert']['loc-args'][0])
+        self.assertEqual(txt[:5], truncate(payload_for_aps(aps), overhead+5)['aps']['alert']['loc-args'][0])
 
     def test_truncate_loc_args(self):
         overhead = len(json_for_payload(payload_for_aps({'alert': {'loc-args': ['', '']}})))
@@ -80,8 +80,8 @@ class TruncateTestCase(unittest.TestCase):
                 'loc-args': [txt, txt2]
             }
         }
-        self.assertEquals(txt[:5], truncate(payload_for_aps(aps), overhead+10)['aps']['alert']['loc-args'][0])
-        self.assertEquals(txt2[:5], truncate(payload_for_aps(aps), overhead+10)['aps']['alert']['loc-args'][1])
+        self.assertEqual(txt[:5], truncate(payload_for_aps(aps), overhead+10)['aps']['alert']['loc-args'][0])
+        self.assertEqual(txt2[:5], truncate(payload_for_aps(aps), overhead+10)['aps']['alert']['loc-args'][1])
 
     def test_python_unicode_support(self):
         # a one character unicode string should have a length of one, even if it's one
@@ -104,7 +104,7 @@ class TruncateTestCase(unittest.TestCase):
         }
         # NB. The number of characters of the string we get is dependent
         # on the json encoding used.
-        self.assertEquals(txt[:17], truncate(payload_for_aps(aps), overhead+20)['aps']['alert'])
+        self.assertEqual(txt[:17], truncate(payload_for_aps(aps), overhead+20)['aps']['alert'])
 
     def test_truncate_multibyte(self):
         overhead = len(json_for_payload(payload_for_aps({'alert': ''})))
@@ -115,7 +115,24 @@ class TruncateTestCase(unittest.TestCase):
         trunc = truncate(payload_for_aps(aps), overhead+30)
         # The string is all 4 byte characters so the trunctaed UTF-8 string
         # should be a multiple of 4 bytes long
-        self.assertEquals(len(trunc['aps']['alert'].encode('utf8')) % 4, 0)
+        self.assertEqual(len(trunc['aps']['alert'].encode('utf8')) % 4, 0)
         # NB. The number of characters of the string we get is dependent
         # on the json encoding used.
-        self.assertEquals(txt[:7], trunc['aps']['alert'])
+        self.assertEqual(txt[:7], trunc['aps']['alert'])
+
+    def test_truncate_long_body(self):
+        overhead = len(json_for_payload(payload_for_aps({'alert': {'body': '', 'loc-args': ['']}})))
+        body = simplestring(10000)
+        arg = simplestring(50, 1)
+        aps = {
+            'alert': {
+                'body': body,
+                'loc-args': [arg]
+            }
+        }
+        payload = payload_for_aps(aps)
+        trunc = truncate(payload, overhead+2000)
+        self.assertEqual(body[:1950], trunc['aps']['alert']['body'])
+        self.assertEqual(arg, trunc['aps']['alert']['loc-args'][0])
+        # the caller's payload is left alone
+        self.assertEqual(body, payload['aps']['alert']['body'])